@@ -51,12 +51,15 @@ class NNParameterInversion(object):
         # Bands to be used:
         self.b_ind = np.array([1, 2, 3, 4, 5, 6, 7, 8])
 
-    def invert_observations(self, data, date, state_mask=None):
+    def invert_observations(self, data, date, state_mask=None, packed=False):
         """Main method to invert observations using a NN inverter. Takes a 
         date and a data object. The data object could be one defined in 
         s2_observations.py, for example, where we have a `read_granule` method
         that when called with a data with observations returns the reflectance,
-        mask, angles and uncertainty."""
+        mask, angles and uncertainty. If `packed`, the parameters are only
+        returned for the pixels in the state mask (all of them if there's
+        no state mask), as an `(n_params, n_active)` array, rather than on
+        the `(n_params, ny, nx)` grid."""
         LOG.info(f"Extracting data for {str(date):s}...")
         # Read in the data and return a bunch of numpy arrays
         rho, mask, sza, vza, raa, rho_unc = data.read_granule(date)
@@ -90,6 +93,12 @@ class NNParameterInversion(object):
             # OK, so we have the parameters. Re-arrange them on a 3D array
             # (params, ny, nx)
             n_cells, n_params = retval.shape
+            if packed:
+                active = (np.ones((ny, nx), dtype=bool) if state_mask is None
+                          else state_mask.astype(bool))
+                params = np.zeros((n_params, active.sum()))
+                params[:, mask[active]] = retval.T
+                return params
             params = np.zeros((n_params, ny, nx))
             for i in range(n_params):
                 params[i, mask] = retval[:, i]
@@ -11,6 +11,7 @@ from .NNParameterInversion import NNParameterInversion
 from .inverters import get_emulators, get_emulator
 from .inverters import get_inverters, get_inverter
 from .kaska import KaSKA
+from .kaska_sar import KaSKASAR
 from .s2_observations import Sentinel2Observations
 from .utils import get_chunks, define_temporal_grid
-from .inference_runner import kaska_runner
+from .inference_runner import kaska_runner, kaska_sar_runner
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""Solving the KaSKA variational problem for many pixels at once.
+
+Rather than calling `scipy.optimize.minimize` pixel by pixel, the pixels
+of a tile are stacked and minimised together with a batched L-BFGS. All
+the pixels move in lockstep, so every iteration is a single call to the
+cost function (and hence to the emulator), but each pixel keeps its own
+curvature history, line search step and convergence flag. Pixels that
+have converged drop out of the active set, and the solver stops once no
+pixels are left.
+"""
+import logging
+import time
+from collections import namedtuple
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+BatchSolution = namedtuple("BatchSolution", "x cost converged failed n_iter")
+
+# The transformed PROSAIL parameters the S2 emulator expects (in order)
+PROSAIL_PARAMETERS = ["n", "cab", "car", "cbrown", "cw", "cm",
+                      "lai", "ala", "bsoil", "psoil"]
+
+# Default prior (in the transformed emulator space) and bounds for the
+# PROSAIL parameters
+PROSAIL_PRIOR_MEAN = np.array([2.1, np.exp(-60./100.), np.exp(-7./100.),
+                               0.1, np.exp(-50*0.0176), np.exp(-100.*0.002),
+                               np.exp(-4./2.), 70./90., 0.5, 0.9])
+PROSAIL_PRIOR_SIGMA = np.array([0.01, 0.2, 0.01, 0.05, 0.01, 0.01,
+                                0.5, 0.1, 0.1, 0.1])
+PROSAIL_BOUNDS = (np.array([1.0, 0.01, 0.01, 0.0, 0.01, 0.01,
+                            0.01, 0.0, 0.0, 0.0]),
+                  np.array([2.5, 1.0, 1.0, 1.0, 1.0, 1.0,
+                            1.0, 1.0, 2.0, 1.0]))
+
+# Output parameters as given by `KaSKA._run_smoother`: the position in the
+# per time step state vector, the transformation from physical units to
+# the emulator space and back.
+ParameterTransform = namedtuple("ParameterTransform",
+                                "index to_state from_state")
+PROSAIL_OUTPUTS = {
+    "lai": ParameterTransform(6, lambda p: np.exp(-p/2.),
+                              lambda x: -2*np.log(x)),
+    "cab": ParameterTransform(1, lambda p: np.exp(-p/100.),
+                              lambda x: -100*np.log(x)),
+    "cbrown": ParameterTransform(3, lambda p: p, lambda x: x),
+}
+
+
+def _project(x, bounds):
+    if bounds is None:
+        return x
+    return np.clip(x, bounds[0], bounds[1])
+
+
+def _projected_gradient_norm(x, grad, bounds):
+    """Infinity norm of the projected gradient, per pixel"""
+    return np.max(np.abs(x - _project(x - grad, bounds)), axis=1)
+
+
+def _subset(bounds, pixels):
+    """The bounds of some of the pixels"""
+    if bounds is None:
+        return None
+    return (bounds[0][pixels], bounds[1][pixels])
+
+
+def _binding(x, grad, bounds):
+    """Variables sitting on a bound, with the gradient pushing them out"""
+    if bounds is None:
+        return np.zeros(x.shape, dtype=bool)
+    return (((x <= bounds[0]) & (grad > 0)) |
+            ((x >= bounds[1]) & (grad < 0)))
+
+
+def _lbfgs_direction(grad, s_hist, y_hist, rho_hist, h0, newest):
+    """L-BFGS two loop recursion, for a stack of pixels. Pairs that
+    failed the curvature condition have `rho=0` and drop out."""
+    n_hist = s_hist.shape[0]
+    order = [(newest - i) % n_hist for i in range(n_hist)]
+    q = grad.copy()
+    alpha = np.zeros((n_hist, grad.shape[0]))
+    for i in order:
+        alpha[i] = rho_hist[i]*np.sum(s_hist[i]*q, axis=1)
+        q -= alpha[i][:, None]*y_hist[i]
+    r = h0[:, None]*q
+    for i in order[::-1]:
+        beta = rho_hist[i]*np.sum(y_hist[i]*r, axis=1)
+        r += s_hist[i]*(alpha[i] - beta)[:, None]
+    return -r
+
+
+def minimize_batch(cost_wrapper, x0, bounds=None, n_corrections=10,
+                   max_iter=200, gtol=1e-5, ftol=1e-9, max_backtrack=20,
+                   max_time=None):
+    """Minimises a `BatchCostWrapper` cost function for all its pixels
+    with a batched (and optionally bounded) L-BFGS. With bounds, the
+    variables sitting on a bound with the gradient pushing them out are
+    held fixed, the L-BFGS direction is worked out for the free
+    variables, and the line search follows its projection on the bounds
+    (as in L-BFGS-B).
+
+    Parameters
+    ----------
+    cost_wrapper : BatchCostWrapper
+        The cost function. Needs a `calc_cost(x, pixels)` method returning
+        per pixel costs and gradients.
+    x0 : array
+        Starting point, `(n_pix, n_state)`.
+    bounds : tuple, optional
+        `(lower, upper)` bounds, broadcastable to `x0`.
+    n_corrections : int, optional
+        Number of L-BFGS correction pairs, by default 10.
+    max_iter : int, optional
+        Maximum number of iterations, by default 200.
+    gtol : float, optional
+        A pixel has converged when its projected gradient infinity norm
+        falls below `gtol`...
+    ftol : float, optional
+        ... or when its relative cost reduction falls below `ftol`.
+    max_backtrack : int, optional
+        Number of step halvings in the line search before giving up on a
+        pixel.
+    max_time : float, optional
+        Wall clock budget (in seconds). When used up, the solver stops
+        and returns the current estimate, with the unfinished pixels
+        flagged as not converged.
+
+    Returns
+    -------
+    BatchSolution
+        Solution `x`, cost per pixel, per pixel convergence flag, per
+        pixel failure flag (the line search found no acceptable step)
+        and number of iterations per pixel.
+    """
+    tic = time.time()
+    x = _project(np.array(x0, dtype=float), bounds)
+    n_pix, n_state = x.shape
+    f, grad = cost_wrapper.calc_cost(x, np.arange(n_pix))
+    if bounds is not None:
+        bounds = (np.broadcast_to(bounds[0], x.shape),
+                  np.broadcast_to(bounds[1], x.shape))
+    converged = _projected_gradient_norm(x, grad, bounds) < gtol
+    failed = np.zeros(n_pix, dtype=bool)
+    n_iter = np.zeros(n_pix, dtype=int)
+
+    s_hist = np.zeros((n_corrections, n_pix, n_state))
+    y_hist = np.zeros((n_corrections, n_pix, n_state))
+    rho_hist = np.zeros((n_corrections, n_pix))
+    # Initial inverse Hessian scaling: the first step is a unit length
+    # steepest descent one
+    h0 = 1./np.maximum(np.linalg.norm(grad, axis=1), 1e-12)
+    newest = -1
+    for iteration in range(max_iter):
+        active = np.flatnonzero(~(converged | failed))
+        if active.size == 0:
+            break
+        if max_time is not None and (time.time() - tic) > max_time:
+            LOG.info(f"Time budget used up with {active.size:d} " +
+                     "pixels still iterating")
+            break
+        newest = (newest + 1) % n_corrections
+        act_bounds = _subset(bounds, active)
+        # The binding variables don't move
+        free = ~_binding(x[active], grad[active], act_bounds)
+        free_grad = np.where(free, grad[active], 0.)
+        direction = _lbfgs_direction(free_grad, s_hist[:, active],
+                                     y_hist[:, active], rho_hist[:, active],
+                                     h0[active], (newest - 1) % n_corrections)
+        direction[~free] = 0.
+        # Reset the pixels where we didn't get a descent direction
+        uphill = np.sum(direction*grad[active], axis=1) >= 0
+        if uphill.any():
+            direction[uphill] = -(h0[active[uphill]][:, None] *
+                                  free_grad[uphill])
+            rho_hist[:, active[uphill]] = 0.
+
+        # Backtracking (Armijo) line search, only re-evaluating the pixels
+        # that haven't found an acceptable step yet
+        step = np.ones(active.size)
+        x_new = x[active].copy()
+        f_new = f[active].copy()
+        g_new = grad[active].copy()
+        searching = np.arange(active.size)
+        for _ in range(max_backtrack):
+            pxls = active[searching]
+            x_try = _project(x[pxls] + step[searching][:, None] *
+                             direction[searching], _subset(bounds, pxls))
+            f_try, g_try = cost_wrapper.calc_cost(x_try, pxls)
+            decrease = np.sum(grad[pxls]*(x_try - x[pxls]), axis=1)
+            ok = f_try <= f[pxls] + 1e-4*decrease
+            x_new[searching[ok]] = x_try[ok]
+            f_new[searching[ok]] = f_try[ok]
+            g_new[searching[ok]] = g_try[ok]
+            searching = searching[~ok]
+            if searching.size == 0:
+                break
+            step[searching] *= 0.5
+        # Pixels where the line search failed, although their projected
+        # gradient isn't small
+        stalled = np.zeros(active.size, dtype=bool)
+        stalled[searching] = True
+        failed[active[stalled]] = True
+
+        s = x_new - x[active]
+        y = g_new - grad[active]
+        sy = np.sum(s*y, axis=1)
+        curvature = sy > 1e-10
+        s_hist[newest, active] = s
+        y_hist[newest, active] = y
+        rho_hist[newest, active] = np.where(curvature,
+                                            1./np.where(curvature, sy, 1.),
+                                            0.)
+        h0[active[curvature]] = (sy[curvature] /
+                                 np.sum(y[curvature]**2, axis=1))
+
+        f_old = f[active]
+        x[active] = x_new
+        f[active] = f_new
+        grad[active] = g_new
+        n_iter[active] += 1
+        small_change = (f_old - f_new) <= ftol*np.maximum(
+            np.maximum(np.abs(f_old), np.abs(f_new)), 1.)
+        small_grad = _projected_gradient_norm(x_new, g_new,
+                                              act_bounds) < gtol
+        converged[active[~stalled & (small_change | small_grad)]] = True
+    LOG.info(f"Batch L-BFGS: {converged.sum():d}/{n_pix:d} pixels " +
+             f"converged, {failed.sum():d} failed, " +
+             f"{n_iter.max():d} iterations")
+    return BatchSolution(x, f, converged, failed, n_iter)
+
+
+def state_to_parameters(x, state_mask, n_tsteps, n_params,
+                        outputs=PROSAIL_OUTPUTS):
+    """Takes the solutions for the pixels in a stack and puts them back
+    on the state grid (or leaves them packed), converting them to
+    physical units. The output is the same as `KaSKA._run_smoother`.
+
+    Parameters
+    ----------
+    x : array
+        Solved state, `(n_pix, n_tsteps*n_params)`, with pixels taken from
+        `state_mask` in C order.
+    state_mask : array
+        Boolean `(ny, nx)` array with the pixels in the stack. If None,
+        the outputs are left packed.
+    n_tsteps : int
+        Number of time steps.
+    n_params : int
+        Number of parameters per time step.
+    outputs : dict, optional
+        Output parameter names and `ParameterTransform` objects.
+
+    Returns
+    -------
+    tuple
+        A list of parameter names and a list of `(n_tsteps, ny, nx)`
+        arrays, with the pixels outside the mask set to 0, or of packed
+        `(n_tsteps, n_pix)` arrays.
+    """
+    x_grid = x.reshape(-1, n_tsteps, n_params)
+    parameter_names = list(outputs.keys())
+    parameter_data = []
+    for name in parameter_names:
+        transform = outputs[name]
+        packed = transform.from_state(x_grid[:, :, transform.index]).T
+        if state_mask is None:
+            parameter_data.append(packed)
+            continue
+        output = np.zeros((n_tsteps, ) + state_mask.shape)
+        output[:, state_mask] = packed
+        parameter_data.append(output)
+    return parameter_names, parameter_data
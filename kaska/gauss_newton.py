@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+"""A Gauss-Newton solver for the KaSKA variational cost function.
+
+The cost function in `kaska_cost.py` adds up observation terms (which
+only couple the parameters within a time step), a second order
+difference smoothness term (which couples each parameter with itself
+up to two time steps away) and a prior, which is usually diagonal or
+banded. With the state ordered time step by time step, the Gauss-Newton
+Hessian is a banded matrix with a half bandwidth of `2*n_params`. We
+store it in LAPACK-style lower banded form, `ab[k, j] = H[j+k, j]`, and
+factorise it with a banded Cholesky decomposition, so that every
+Gauss-Newton step is O(n_tsteps) per pixel. The same factor gives the
+diagonal of the inverse Hessian (the posterior variance) through the
+Takahashi recursion, without ever forming the full inverse.
+
+The numerical kernels are compiled with numba, and loop over the pixels
+of a stack in parallel.
+"""
+import logging
+import time
+from collections import namedtuple
+
+import numpy as np
+import scipy.sparse as sp
+
+from numba import jit, prange
+
+LOG = logging.getLogger(__name__)
+
+GaussNewtonSolution = namedtuple("GaussNewtonSolution",
+                                 "x cost converged failed n_iter variance")
+
+
+@jit(nopython=True, parallel=True)
+def cholesky_banded_batch(ab):
+    """Cholesky factorisation of a stack of symmetric positive definite
+    banded matrices, stored in lower banded form.
+
+    Parameters
+    ----------
+    ab : array
+        `(n_pix, u+1, n)` array, with `ab[:, k, j] = H[:, j+k, j]`.
+
+    Returns
+    -------
+    tuple
+        The factors `L` in the same storage as `ab`, and a boolean array
+        flagging the pixels where the matrix wasn't positive definite.
+    """
+    n_pix, n_band, n = ab.shape
+    u = n_band - 1
+    chol = np.zeros_like(ab)
+    failed = np.zeros(n_pix, dtype=np.bool_)
+    for pix in prange(n_pix):
+        L = chol[pix]
+        for j in range(n):
+            k0 = max(0, j - u)
+            d = ab[pix, 0, j]
+            for k in range(k0, j):
+                d -= L[j - k, k]**2
+            if d <= 0.:
+                failed[pix] = True
+                break
+            L[0, j] = np.sqrt(d)
+            for i in range(j + 1, min(n, j + u + 1)):
+                v = ab[pix, i - j, j]
+                for k in range(max(0, i - u), j):
+                    v -= L[i - k, k]*L[j - k, k]
+                L[i - j, j] = v/L[0, j]
+    return chol, failed
+
+
+@jit(nopython=True, parallel=True)
+def cho_solve_banded_batch(chol, b):
+    """Solves `H x = b` for a stack of pixels, given the banded Cholesky
+    factors of `H` from `cholesky_banded_batch`.
+
+    Parameters
+    ----------
+    chol : array
+        `(n_pix, u+1, n)` lower banded Cholesky factors.
+    b : array
+        `(n_pix, n)` right hand sides.
+
+    Returns
+    -------
+    array
+        `(n_pix, n)` solutions.
+    """
+    n_pix, n_band, n = chol.shape
+    u = n_band - 1
+    x = np.empty_like(b)
+    for pix in prange(n_pix):
+        L = chol[pix]
+        # Forward substitution, L y = b
+        for i in range(n):
+            v = b[pix, i]
+            for k in range(max(0, i - u), i):
+                v -= L[i - k, k]*x[pix, k]
+            x[pix, i] = v/L[0, i]
+        # Back substitution, L^T x = y
+        for i in range(n - 1, -1, -1):
+            v = x[pix, i]
+            for k in range(i + 1, min(n, i + u + 1)):
+                v -= L[k - i, i]*x[pix, k]
+            x[pix, i] = v/L[0, i]
+    return x
+
+
+@jit(nopython=True, parallel=True)
+def inverse_diagonal_banded_batch(chol):
+    """Diagonal of the inverse of a stack of banded matrices from their
+    Cholesky factors (Takahashi's recursion). Only the elements of the
+    inverse within the band are computed, so this costs
+    O(n*u**2) per pixel.
+
+    Parameters
+    ----------
+    chol : array
+        `(n_pix, u+1, n)` lower banded Cholesky factors.
+
+    Returns
+    -------
+    array
+        `(n_pix, n)` diagonal of the inverse.
+    """
+    n_pix, n_band, n = chol.shape
+    u = n_band - 1
+    diag = np.empty((n_pix, n))
+    for pix in prange(n_pix):
+        L = chol[pix]
+        # Inverse elements within the band, sigma[k, j] = S[j+k, j]
+        sigma = np.zeros((n_band, n))
+        for j in range(n - 1, -1, -1):
+            last = min(n - 1, j + u)
+            for i in range(last, j - 1, -1):
+                v = 0.
+                for k in range(j + 1, last + 1):
+                    if i >= k:
+                        s_ik = sigma[i - k, k]
+                    else:
+                        s_ik = sigma[k - i, i]
+                    v += L[k - j, j]*s_ik
+                if i == j:
+                    sigma[0, j] = 1./L[0, j]**2 - v/L[0, j]
+                else:
+                    sigma[i - j, j] = -v/L[0, j]
+        diag[pix] = sigma[0]
+    return diag
+
+
+@jit(nopython=True, parallel=True)
+def _freeze_active_batch(x, grad, lower, upper, ab, rhs):
+    """Takes the variables sitting on a bound (with the gradient pushing
+    them out) out of a stack of banded Gauss-Newton systems: their rows
+    and columns of `ab` are replaced by those of the identity (in place),
+    and their right hand side is zero, so their step is zero. `rhs` is
+    filled in with the gradient for the other variables."""
+    n_pix, n_band, n = ab.shape
+    for pix in prange(n_pix):
+        for j in range(n):
+            rhs[pix, j] = grad[pix, j]
+            if not ((x[pix, j] <= lower[pix, j] and grad[pix, j] > 0.) or
+                    (x[pix, j] >= upper[pix, j] and grad[pix, j] < 0.)):
+                continue
+            rhs[pix, j] = 0.
+            ab[pix, 0, j] = 1.
+            # Column j below the diagonal, and row j left of it
+            for k in range(1, min(n_band, n - j)):
+                ab[pix, k, j] = 0.
+            for k in range(1, min(n_band, j + 1)):
+                ab[pix, k, j - k] = 0.
+
+
+def _sparse_to_banded(matrix, n_band):
+    """Lower banded storage of a symmetric (sparse or dense) matrix"""
+    coo = sp.coo_matrix(matrix)
+    lower = coo.row >= coo.col
+    rows, cols, vals = coo.row[lower], coo.col[lower], coo.data[lower]
+    ab = np.zeros((n_band, matrix.shape[0]))
+    np.add.at(ab, (rows - cols, cols), vals)
+    return ab
+
+
+def _bandwidth(matrix):
+    coo = sp.coo_matrix(matrix)
+    if coo.nnz == 0:
+        return 0
+    return int(np.max(np.abs(coo.row - coo.col)))
+
+
+def _static_hessian(cost_wrapper, n_band):
+    """The part of the Hessian that doesn't depend on the state: the
+    prior and smoothness terms, in lower banded storage."""
+    n_tsteps, n_params = cost_wrapper.n_tsteps, cost_wrapper.n_params
+    ab = _sparse_to_banded(cost_wrapper.c_prior_inv, n_band)
+    # D^T D for a second order difference operator over time...
+    D = sp.diags([-1., 2., -1.], [0, 1, 2], shape=(n_tsteps - 2, n_tsteps))
+    DtD = (D.T@D).toarray()
+    gamma = np.broadcast_to(cost_wrapper._gamma, (n_params, ))
+    # ... sits on the diagonals 0, n_params and 2*n_params of the state
+    for lag in range(3):
+        for param in range(n_params):
+            cols = np.arange(n_tsteps - lag)*n_params + param
+            ab[lag*n_params, cols] += gamma[param]*np.diag(DtD, -lag)
+    return ab
+
+
+def _obs_hessian(cost_wrapper, ab_static, inv_var, dH_fwd):
+    """Adds the Gauss-Newton observation term `J^T C_obs^{-1} J` (a block
+    per time step) to the static part of the Hessian."""
+    n_tsteps, n_params = cost_wrapper.n_tsteps, cost_wrapper.n_params
+    n_sel = dH_fwd.shape[0]
+    # (n_sel, n_obs, n_params, n_params) blocks per observation, added up
+    # into their time step
+    blocks = np.einsum("sobp,sob,sobq->sopq", dH_fwd, inv_var, dH_fwd)
+    blocks = np.einsum("to,sopq->stpq", cost_wrapper.obs_to_tstep, blocks)
+    ab = np.repeat(ab_static[None], n_sel, axis=0)
+    tsteps = np.arange(n_tsteps)*n_params
+    for p in range(n_params):
+        for q in range(p + 1):
+            ab[:, p - q, tsteps + q] += blocks[:, :, p, q]
+    return ab
+
+
+def gauss_newton_batch(cost_wrapper, x0, bounds=None, max_iter=10,
+                       ftol=1e-8, xtol=1e-6, max_backtrack=10,
+                       max_time=None, calc_variance=True):
+    """Minimises a `BatchCostWrapper` cost function with Gauss-Newton,
+    for all its pixels at once. Each iteration solves the banded
+    Gauss-Newton system with a banded Cholesky factorisation, and takes
+    a backtracking step (projected on the bounds) along the
+    Gauss-Newton direction. Variables sitting on a bound, with the
+    gradient pushing them out, are held fixed: their rows and columns
+    are taken out of the system, and the Gauss-Newton step is solved for
+    the free variables only.
+
+    Parameters
+    ----------
+    cost_wrapper : BatchCostWrapper
+        The cost function.
+    x0 : array
+        Starting point, `(n_pix, n_state)`.
+    bounds : tuple, optional
+        `(lower, upper)` bounds, broadcastable to `x0`.
+    max_iter : int, optional
+        Maximum number of Gauss-Newton iterations, by default 10.
+    ftol : float, optional
+        A pixel has converged when its relative cost reduction (or the
+        one predicted by the Gauss-Newton model) falls below `ftol`...
+    xtol : float, optional
+        ... or when its largest state update falls below `xtol`.
+    max_backtrack : int, optional
+        Number of step halvings before giving up on a pixel.
+    max_time : float, optional
+        Wall clock budget (in seconds), after which the solver stops and
+        returns the current estimate.
+    calc_variance : bool, optional
+        Whether to calculate the posterior variance at the solution.
+
+    Returns
+    -------
+    GaussNewtonSolution
+        Solution `x`, cost per pixel, per pixel convergence flag, per
+        pixel failure flag (the Gauss-Newton Hessian wasn't positive
+        definite, or no step along the Gauss-Newton direction lowered the
+        cost), number of iterations per pixel and the posterior variance
+        (the diagonal of the inverse Gauss-Newton Hessian,
+        `(n_pix, n_state)`, or `None` if `calc_variance` is False).
+    """
+    tic = time.time()
+    x = np.array(x0, dtype=float)
+    if bounds is not None:
+        x = np.clip(x, bounds[0], bounds[1])
+        lower = np.broadcast_to(np.asarray(bounds[0], dtype=float), x.shape)
+        upper = np.broadcast_to(np.asarray(bounds[1], dtype=float), x.shape)
+    n_pix, n_state = x.shape
+    n_band = max(2*cost_wrapper.n_params,
+                 _bandwidth(cost_wrapper.c_prior_inv)) + 1
+    ab_static = _static_hessian(cost_wrapper, n_band)
+
+    pixels = np.arange(n_pix)
+    f, grad, (_, inv_var, dH_fwd) = cost_wrapper.calc_cost_jacobian(
+        x, pixels)
+    converged = np.zeros(n_pix, dtype=bool)
+    failed = np.zeros(n_pix, dtype=bool)
+    n_iter = np.zeros(n_pix, dtype=int)
+    for iteration in range(max_iter):
+        active = np.flatnonzero(~(converged | failed))
+        if active.size == 0:
+            break
+        if max_time is not None and (time.time() - tic) > max_time:
+            LOG.info(f"Time budget used up with {active.size:d} " +
+                     "pixels still iterating")
+            break
+        ab = _obs_hessian(cost_wrapper, ab_static, inv_var, dH_fwd)
+        rhs = grad[active].copy()
+        if bounds is not None:
+            _freeze_active_batch(x[active], grad[active], lower[active],
+                                 upper[active], ab, rhs)
+        chol, singular = cholesky_banded_batch(ab)
+        direction = -cho_solve_banded_batch(chol, rhs)
+        # Pixels with a singular Hessian fail, and those where the
+        # Gauss-Newton model can't lower the cost any further have
+        # converged
+        predicted = -0.5*np.sum(rhs*direction, axis=1)
+        flat = ~singular & (predicted <= ftol*np.maximum(np.abs(f[active]),
+                                                         1.))
+        if singular.any():
+            LOG.info(f"{singular.sum():d} pixels with a singular Hessian")
+        failed[active[singular]] = True
+        converged[active[flat]] = True
+        keep = ~(singular | flat)
+        active, direction = active[keep], direction[keep]
+        inv_var, dH_fwd = inv_var[keep], dH_fwd[keep]
+        if active.size == 0:
+            break
+
+        step = np.ones(active.size)
+        x_new = x[active].copy()
+        f_new = f[active].copy()
+        g_new = grad[active].copy()
+        iv_new, dH_new = inv_var.copy(), dH_fwd.copy()
+        searching = np.arange(active.size)
+        for _ in range(max_backtrack):
+            pxls = active[searching]
+            x_try = x[pxls] + step[searching][:, None]*direction[searching]
+            if bounds is not None:
+                x_try = np.clip(x_try, lower[pxls], upper[pxls])
+            f_try, g_try, (_, iv_try, dH_try) = \
+                cost_wrapper.calc_cost_jacobian(x_try, pxls)
+            ok = f_try < f[pxls]
+            accepted = searching[ok]
+            x_new[accepted] = x_try[ok]
+            f_new[accepted] = f_try[ok]
+            g_new[accepted] = g_try[ok]
+            iv_new[accepted] = iv_try[ok]
+            dH_new[accepted] = dH_try[ok]
+            searching = searching[~ok]
+            if searching.size == 0:
+                break
+            step[searching] *= 0.5
+        # No improvement along the Gauss-Newton direction, even though
+        # the model predicts one
+        stalled = np.zeros(active.size, dtype=bool)
+        stalled[searching] = True
+        failed[active[stalled]] = True
+
+        f_old = f[active]
+        dx = np.max(np.abs(x_new - x[active]), axis=1)
+        x[active] = x_new
+        f[active] = f_new
+        grad[active] = g_new
+        n_iter[active[~stalled]] += 1
+        small_change = (f_old - f_new) <= ftol*np.maximum(np.abs(f_old), 1.)
+        done = ~stalled & (small_change | (dx < xtol))
+        converged[active[done]] = True
+        # Only keep the Jacobians of the pixels still iterating
+        going = ~(stalled | done)
+        inv_var, dH_fwd = iv_new[going], dH_new[going]
+    LOG.info(f"Gauss-Newton: {converged.sum():d}/{n_pix:d} pixels " +
+             f"converged, {failed.sum():d} failed, " +
+             f"{n_iter.max():d} iterations")
+
+    variance = None
+    if calc_variance:
+        _, _, (_, inv_var, dH_fwd) = cost_wrapper.calc_cost_jacobian(
+            x, pixels)
+        chol, var_failed = cholesky_banded_batch(
+            _obs_hessian(cost_wrapper, ab_static, inv_var, dH_fwd))
+        variance = inverse_diagonal_banded_batch(chol)
+        variance[var_failed] = np.nan
+    return GaussNewtonSolution(x, f, converged, failed, n_iter, variance)
@@ -19,10 +19,21 @@ from osgeo import gdal
 
 from .utils import get_chunks, define_temporal_grid
 from .s2_observations import Sentinel2Observations
+from .s1_observations import Sentinel1Observations
+from .s1_cache import CachedSentinel1Observations
 from .kaska import KaSKA
+from .kaska_sar import KaSKASAR
 
 Config = namedtuple(
-    "Config", "s2_obs temporal_grid state_mask inverter output_folder"
+    "Config", "s2_obs temporal_grid state_mask inverter output_folder " +
+    "refine refine_time_budget smoother",
+    defaults=(False, None, "smoothn")
+)
+
+SARConfig = namedtuple(
+    "SARConfig", "s1_obs temporal_grid state_mask s2_lai output_folder " +
+    "warm_start",
+    defaults=(None, )
 )
 
 LOG = logging.getLogger(__name__)
@@ -178,6 +189,9 @@ def process_tile(the_chunk, config):
             config.inverter,
             config.output_folder,
             chunk=hex(chunk_no),
+            refine=config.refine,
+            refine_time_budget=config.refine_time_budget,
+            smoother=config.smoother,
         )
         parameter_names, parameter_data = kaska.run_retrieval()
         kaska.save_s2_output(parameter_names, parameter_data)
@@ -195,7 +209,10 @@ def kaska_runner(
     output_folder,
     dask_client=None,
     block_size= [256, 256],
-    chunk=None
+    chunk=None,
+    refine=False,
+    refine_time_budget=None,
+    smoother="smoothn"
 ):
     """Runs a KaSKA problem for S2 producing parameter estimates between
     `start_date` and `end_date` with a temporal spacing `temporal_grid_space`.
@@ -228,6 +245,15 @@ def kaska_runner(
     chunk: int, optional
         The chunk number to run the processing for. Doesn't loop over all
         chunks, just runs one chunk. By default, set to `None`.
+    refine: bool, optional
+        Whether to refine the smoothed first pass retrievals against the
+        observations using the emulator. By default, `False`.
+    refine_time_budget: float, optional
+        Time budget (in seconds) for the refinement of each tile. By
+        default, there is no limit.
+    smoother: str, optional
+        The temporal smoother, either "smoothn" (default) or "whittaker"
+        (see `KaSKA._run_whittaker`).
 
     Returns
     -------
@@ -249,8 +275,43 @@ def kaska_runner(
     output_folder.mkdir(parents=True, exist_ok=True)
     # "s2_obs temporal_grid state_mask inverter output_folder"
     config = Config(
-        s2_obs, temporal_grid, state_mask, approx_inverter, output_folder
+        s2_obs, temporal_grid, state_mask, approx_inverter, output_folder,
+        refine, refine_time_budget, smoother
     )
+    wrapper = partial(process_tile, config=config)
+    return run_chunks(wrapper, state_mask, output_folder,
+                      dask_client=dask_client, block_size=block_size,
+                      chunk=chunk)
+
+
+def run_chunks(wrapper, state_mask, output_folder, dask_client=None,
+               block_size=[256, 256], chunk=None):
+    """Splits the state mask into tiles, runs `wrapper` on each of them
+    (optionally distributing them over a dask cluster) and stitches the
+    outputs.
+
+    Parameters
+    ----------
+    wrapper : callable
+        A function that takes a chunk (as produced by `get_chunks`), and
+        returns the list of saved parameters, or `None` if nothing was
+        processed (e.g. `process_tile` with a configuration).
+    state_mask : str
+        The state mask filename.
+    output_folder : str
+        The folder where the tiles are saved.
+    dask_client : dask, optional
+        A dask client. If `None`, the tiles are processed sequentially.
+    block_size : int list[2], optional
+        The size of the tiles (in pixels).
+    chunk: int, optional
+        If given, only process this chunk, and don't stitch.
+
+    Returns
+    -------
+    list
+        A list of the processed parameters files.
+    """
     # Avoid reading mask in memory in case we fill it up
     g = gdal.Open(state_mask)
     ny, nx = g.RasterYSize, g.RasterXSize
@@ -259,7 +320,6 @@ def kaska_runner(
         them_chunks = [the_chunk for the_chunk in get_chunks(
             nx, ny, block_size=block_size)]
 
-        wrapper = partial(process_tile, config=config)
         if dask_client is None:
             retval = list(map(wrapper, them_chunks))
         else:
@@ -283,3 +343,125 @@ def kaska_runner(
         LOG.info("Single chunk!")
         wrapper(the_chunk[0])
         return None
+
+
+def process_sar_tile(the_chunk, config):
+    """Runs the Sentinel 1 retrieval for a single spatial tile. See
+    `process_tile`.
+
+    Parameters
+    ----------
+    the_chunk : iter
+        Top left X and Y coordinates in pixels, the X and Y number of
+        pixels of the tile, and the tile number.
+    config : SARConfig
+        A configuration object.
+
+    Returns
+    -------
+    list
+        A list of retrieved parameters.
+    """
+    this_X, this_Y, nx_valid, ny_valid, chunk_no = the_chunk
+    s1_obs = copy.copy(config.s1_obs)
+    s1_obs.apply_roi(this_X, this_Y, this_X + nx_valid, this_Y + ny_valid)
+    n_unmasked_pxls = np.sum(s1_obs.state_mask.ReadAsArray())
+    if n_unmasked_pxls == 0:
+        LOG.info(f"No pixels in chunk {hex(chunk_no):s}")
+        return None
+    LOG.info(f"Unmasked pixels in {hex(chunk_no):s}: {n_unmasked_pxls:d}")
+    kaska_sar = KaSKASAR(
+        s1_obs,
+        config.temporal_grid,
+        config.state_mask,
+        config.s2_lai,
+        config.output_folder,
+        chunk=hex(chunk_no),
+        warm_start=config.warm_start,
+    )
+    dates, parameter_names, parameter_data = kaska_sar.run_retrieval()
+    kaska_sar.save_sar_output(dates, parameter_names, parameter_data)
+    return parameter_names
+
+
+def kaska_sar_runner(
+    start_date,
+    end_date,
+    temporal_grid_space,
+    state_mask,
+    s1_ncfile,
+    s2_lai,
+    output_folder,
+    dask_client=None,
+    block_size=[256, 256],
+    chunk=None,
+    warm_start=None,
+    s1_cache=None
+):
+    """Runs the KaSKA Sentinel 1 retrieval of the Water Cloud Model
+    parameters between `start_date` and `end_date`, using the LAI
+    retrieved from Sentinel 2 (e.g. by `kaska_runner`).
+
+    Parameters
+    ----------
+    start_date : datetime object
+        Starting date for the inference
+    end_date : datetime object
+        End date for the inference
+    temporal_grid_space : datetime object
+        Temporal resolution of the inference (in days).
+    state_mask : str
+        An existing spatial raster with the state mask (binary mask detailing
+        which pixels to process).
+    s1_ncfile : str
+        The Sentinel 1 netCDF file. Not used if `s1_cache` is given.
+    s2_lai : str
+        The multiband S2 LAI file (e.g. `lai.tif` from `kaska_runner`).
+    output_folder : str
+        A folder where the output files will be dumped.
+    dask_client : dask, optional
+        Allows the distribution of the processing using a dask distributed
+        cluster. If this is None, then the processing is run tiled but
+        sequentially.
+    block_size : int list[2], optional
+        The size of the tile to break the image into (in pixels).
+    chunk: int, optional
+        The chunk number to run the processing for. By default, set to
+        `None`, and all chunks are processed.
+    warm_start: str, optional
+        Starting point strategy for the pixel inversions (see
+        `KaSKASAR`). By default, `None`.
+    s1_cache: str, optional
+        A cache folder prepared with `s1_cache.prepare_s1_cache`. If
+        given, the observations are read from it rather than from the
+        netCDF file.
+
+    Returns
+    -------
+    list
+        A list of the processed parameters files.
+    """
+    temporal_grid = define_temporal_grid(
+        start_date, end_date, temporal_grid_space
+    )
+    if s1_cache is None:
+        s1_obs = Sentinel1Observations(
+            s1_ncfile,
+            state_mask,
+            time_grid=temporal_grid,
+        )
+    else:
+        s1_obs = CachedSentinel1Observations(
+            s1_cache,
+            state_mask,
+            time_grid=temporal_grid,
+        )
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    config = SARConfig(
+        s1_obs, temporal_grid, state_mask, s2_lai, output_folder, warm_start
+    )
+    wrapper = partial(process_sar_tile, config=config)
+    return run_chunks(wrapper, state_mask, output_folder,
+                      dask_client=dask_client, block_size=block_size,
+                      chunk=chunk)
@@ -1,30 +1,102 @@
 import numpy as np
-from numba import jit
+from numba import jit, prange
 
 '''
-This is a linear interpolation over 1 axis
-using numpy.interp function. It uses numba 
-to speed up filling gaps in the for loop.
+This is a linear interpolation over the first (time) axis, with the same
+result as numpy.interp for every pixel, ignoring NaNs. The data are kept
+time-major, and a numba kernel runs over blocks of pixels in parallel,
+so there are no transposed copies. Pixels without valid values are NaN.
 
 Feng Yin
 Department of Geography, UCL
 ucfafyi@ucl.ac.uk
-LICENSE: GNU GENERAL PUBLIC LICENSE V3 
+LICENSE: GNU GENERAL PUBLIC LICENSE V3
 '''
 
-@jit(nopython=True)
-def interp1d(newx, oldx, oldy):
+# Pixels per block: a block of time-major rows stays in cache while its
+# pixels are interpolated
+BLOCK_SIZE = 64
+
+
+@jit(nopython=True, parallel=True)
+def _interp_time_major(newx, oldx, oldy, newy, block_size):
+    n_old, n_pix = oldy.shape
+    n_new = newx.shape[0]
+    n_blocks = (n_pix + block_size - 1)//block_size
+    for b in prange(n_blocks):
+        p0 = b*block_size
+        p1 = min(n_pix, p0 + block_size)
+        # Number of valid values per pixel, reading the block row by row
+        count = np.zeros(p1 - p0, dtype=np.int64)
+        for t in range(n_old):
+            for p in range(p0, p1):
+                if not np.isnan(oldy[t, p]):
+                    count[p - p0] += 1
+        xv = np.empty(n_old)
+        yv = np.empty(n_old)
+        for p in range(p0, p1):
+            k = count[p - p0]
+            if k == 0:
+                for j in range(n_new):
+                    newy[j, p] = np.nan
+                continue
+            k = 0
+            for t in range(n_old):
+                if not np.isnan(oldy[t, p]):
+                    xv[k] = oldx[t]
+                    yv[k] = oldy[t, p]
+                    k += 1
+            for j in range(n_new):
+                x = newx[j]
+                if x <= xv[0]:
+                    newy[j, p] = yv[0]
+                elif x >= xv[k - 1]:
+                    newy[j, p] = yv[k - 1]
+                else:
+                    i = np.searchsorted(xv[:k], x, side='right') - 1
+                    newy[j, p] = yv[i] + (x - xv[i])*(yv[i + 1] - yv[i]) / \
+                        (xv[i + 1] - xv[i])
+
+
+def interp1d(newx, oldx, oldy, out=None):
+    """Linearly interpolates `oldy` from `oldx` to `newx` along the first
+    axis, for every pixel, ignoring NaNs.
+
+    Parameters
+    ----------
+    newx : array
+        The `n_new` points to interpolate to.
+    oldx : array
+        The `n_old` points of the data, increasing.
+    oldy : array
+        `(n_old, ...)` data. float32 data are interpolated (and returned)
+        as float32, anything else as float64.
+    out : array, optional
+        A C-contiguous `(n_new, ...)` output array of the same dtype.
+        It can be `oldy` itself when `newx` and `oldx` have the same
+        size.
+
+    Returns
+    -------
+    array
+        `(n_new, ...)` interpolated data, NaN for the pixels without any
+        valid values.
+    """
+    newx = np.asarray(newx, dtype=np.float64)
+    oldx = np.asarray(oldx, dtype=np.float64)
+    oldy = np.asarray(oldy)
     if oldx.shape[0] != oldy.shape[0]:
-        raise ValueError('oldx and oldy must have the same shape in first axis.')
-    oldy_shape = oldy.shape[1:]
-    new_shape  = newx.shape[0]
-    oldy_t = oldy.reshape(oldx.shape[0], -1).T
-    pix_num = oldy_t.shape[0]
-    newy = np.zeros((pix_num, new_shape))*np.nan
-    for i in range(pix_num):
-        y    = oldy_t[i]
-        mask = ~np.isnan(y)
-        if mask.sum()>0:
-            newy[i] = np.interp(newx, oldx[mask], y[mask])
-    newy_T = newy.transpose(1,0).reshape((new_shape,) + oldy_shape)
-    return newy_T
+        raise ValueError('oldx and oldy must have the same shape in first '
+                         'axis.')
+    dtype = np.float32 if oldy.dtype == np.float32 else np.float64
+    shape = (newx.shape[0], ) + oldy.shape[1:]
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif (out.shape != shape or out.dtype != dtype or
+          not out.flags.c_contiguous):
+        raise ValueError('out must be a C-contiguous array with shape ' +
+                         f'{shape} and dtype {np.dtype(dtype).name}.')
+    oldy = np.ascontiguousarray(oldy.reshape(oldx.shape[0], -1), dtype=dtype)
+    _interp_time_major(newx, oldx, oldy, out.reshape(newx.shape[0], -1),
+                       BLOCK_SIZE)
+    return out
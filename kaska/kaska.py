@@ -2,6 +2,7 @@
 
 """Main module."""
 import logging
+import time
 
 from pathlib import Path
 import datetime as dt
@@ -21,6 +22,16 @@ from .utils import save_output_parameters
 
 from .interp_fix import interp1d
 
+from .whittaker import whittaker_smooth, interpolation_matrix
+
+from .kaska_cost import BatchCostWrapper
+
+from .gauss_newton import gauss_newton_batch
+
+from .batch_solver import minimize_batch, state_to_parameters
+from .batch_solver import PROSAIL_OUTPUTS, PROSAIL_BOUNDS
+from .batch_solver import PROSAIL_PRIOR_MEAN, PROSAIL_PRIOR_SIGMA
+
 LOG = logging.getLogger(__name__)
             
 class KaSKA(object):
@@ -28,7 +39,42 @@ class KaSKA(object):
 
     def __init__(self, observations, time_grid, state_mask, approx_inverter,
                 output_folder,
-                chunk = None):
+                chunk = None, refine=False, refine_time_budget=None,
+                refine_method="gauss-newton", emulator=None,
+                smoother="smoothn"):
+        """The main KaSKA object.
+
+        Parameters
+        ----------
+        observations : Sentinel2Observations
+            The observations object.
+        time_grid : list
+            A list of datetimes with the output temporal grid.
+        state_mask : str
+            The state mask filename.
+        approx_inverter : str
+            The first pass inverter filename.
+        output_folder : str
+            Where to store the outputs.
+        chunk : str, optional
+            Chunk identifier, used in the output filenames.
+        refine : bool, optional
+            Whether to refine the smoothed first pass estimates against
+            the reflectances with the emulator (see `_run_refinement`).
+        refine_time_budget : float, optional
+            Wall clock time (in seconds) available to the refinement
+            stage for this tile. By default, there's no limit.
+        refine_method : str, optional
+            Either "gauss-newton" (default) or "lbfgs".
+        emulator : Two_NN, optional
+            The emulator used in the refinement. By default, the one
+            stored in `observations`.
+        smoother : str, optional
+            Either "smoothn" (default), which smooths the first pass
+            retrievals on the observation dates and interpolates them
+            to the time grid, or "whittaker", which smooths them straight
+            onto the time grid (see `_run_whittaker`).
+        """
         self.time_grid = time_grid
         self.observations = observations
         self.state_mask = state_mask
@@ -36,18 +82,32 @@ class KaSKA(object):
         self.inverter = NNParameterInversion(approx_inverter)
         self.chunk = chunk
         self.save_sgl_inversion = True
+        self.refine = refine
+        self.refine_time_budget = refine_time_budget
+        self.refine_method = refine_method
+        self.emulator = emulator
+        # Refinement settings: smoothness per (transformed) PROSAIL
+        # parameter and number of pixels solved together
+        self.refine_gamma = 100.
+        self.refine_block_size = 1024
+        self.smoother = smoother
+        # Smoothing parameters for the Whittaker smoother, on the scale of
+        # smoothn's `s` in `_run_smoother` (a second difference penalty
+        # per observation step). `_run_whittaker` rescales them to its
+        # penalty per time grid step
+        self.whittaker_lambda = {"lai": 0.05, "cab": 0.5, "cbrown": 0.5}
 
     def first_pass_inversion(self):
         """A first pass inversion. Could be anything, from a quick'n'dirty
         LUT, a regressor. As coded, we use the `self.inverter` method, which
         in this case, will call the ANN inversion."""
-        state_mask = self.observations.state_mask.ReadAsArray()
-        state_mask = state_mask.astype(np.bool)
+        state_mask = self._read_state_mask()
         LOG.info("Doing first pass inversion!")
         S = {}
         for k in self.observations.dates:
             retval = self.inverter.invert_observations(self.observations, k,
-                                                       state_mask=state_mask)
+                                                       state_mask=state_mask,
+                                                       packed=True)
             if retval is not None:
                 S[k] = retval
         return S
@@ -55,7 +115,9 @@ class KaSKA(object):
     def _process_first_pass(self, first_passer_dict):
         """This methods takes the first pass estimates of surface parameters
         (stored as a dictionary) and assembles them into an
-        `(n_params, n_times, nx, ny)` grid. The assumption here is the 
+        `(n_params, n_times, n_active)` array, packed over the pixels in
+        the state mask (estimates on the `(ny, nx)` grid are packed here
+        too). The assumption here is the
         dictionary is indexed by dates (e.g. datetime objects) and that for
         each date, we have a list of parameters.
         
@@ -66,11 +128,13 @@ class KaSKA(object):
         
         """
         dates = [k for k in first_passer_dict.keys()]
-        n_params, nx, ny = first_passer_dict[dates[0]].shape
-        param_grid = np.zeros((n_params, len(dates), nx, ny))
+        state_mask = self._read_state_mask()
+        n_params = first_passer_dict[dates[0]].shape[0]
+        param_grid = np.zeros((n_params, len(dates), state_mask.sum()))
         for i, k in enumerate(dates):
-            for j in range(n_params):
-                    param_grid[j, i, :, :] = first_passer_dict[k][j]
+            estimate = first_passer_dict[k]
+            param_grid[:, i] = (estimate if estimate.ndim == 2
+                                else estimate[:, state_mask])
         # param_grid = np.zeros((n_params, len(self.time_grid), nx, ny))
         # idx = np.argmin(np.abs(self.time_grid -
         #                 np.array(dates)[:, None]), axis=1)
@@ -92,10 +156,17 @@ class KaSKA(object):
     def run_retrieval(self):
         """Runs the retrieval for all time-steps. It proceeds by first 
         inverting on a observation by observation fashion, and then performs
-        a per pixel smoothing/interpolation."""
+        a per pixel smoothing/interpolation. Only the pixels in the state
+        mask are carried through: the outputs are packed `(n_tsteps,
+        n_active)` arrays, which `save_s2_output` puts back on the grid."""
         dates, retval = self._process_first_pass(self.first_pass_inversion())
         LOG.info("Burp! Now doing temporal smoothing")
-        return self._run_smoother(dates, retval)
+        parameter_names, parameter_data = self._run_smoother(dates, retval)
+        if self.refine:
+            LOG.info("Refining smoothed estimates with the emulator")
+            parameter_names, parameter_data = self._run_refinement(
+                parameter_names, parameter_data)
+        return parameter_names, parameter_data
         #x0 = np.zeros_like(retval)
         #for param in range(retval.shape[0]):
         #    S = retval[param]*1
@@ -103,17 +174,23 @@ class KaSKA(object):
         #    x0[param, :, :] = ss[0]
         #return x0
 
+    def _read_state_mask(self):
+        """The state mask as a boolean array. Its pixels are the ones
+        carried (packed, in C order) through the retrieval."""
+        return self.observations.state_mask.ReadAsArray().astype(bool)
+
     def _run_smoother(self, dates, parameter_block):
         """Very specific method that applies some parameter transformations
-        to the data in a very unrobust way."""
+        to the data in a very unrobust way. Works on packed `(n_params,
+        n_obs, n_active)` blocks, along the time axis."""
         # This needs to be abstracted up...
         # Note that in general, we don't know what parameters we are dealing
         # with. We probably want a data structure here with the parameter list,
         # transformation function, as well as boundaries, which could be
         # associated with the NN
-        lai = -2 * np.log(parameter_block[-2, :, :, :])
-        cab = -100*np.log(parameter_block[1, :, :, :])
-        cbrown = parameter_block[2, :, :, :]
+        lai = -2 * np.log(parameter_block[-2])
+        cab = -100*np.log(parameter_block[1])
+        cbrown = parameter_block[2]
         if self.save_sgl_inversion is True:
             save_output_parameters(dates, self.observations, 
                 self.output_folder/"single_imgs/", ["lai", "cab", "cbrown"],
@@ -122,7 +199,8 @@ class KaSKA(object):
                            options=['COMPRESS=DEFLATE',
                                     'BIGTIFF=YES',
                                     'PREDICTOR=1',
-                                    'TILED=YES'])
+                                    'TILED=YES'],
+                           state_mask=self._read_state_mask())
                
         # Basically, remove weird values outside of boundaries, nans and stuff
         # Could be done simply with the previously stated data structure, as
@@ -139,10 +217,13 @@ class KaSKA(object):
         # Time axes in days of year
         doys = np.array([int(x.strftime('%j')) for x in dates])
         doy_grid = np.array([int(x.strftime('%j')) for x in self.time_grid])
+        if self.smoother == "whittaker":
+            return self._run_whittaker(doys, doy_grid, lai, cab, cbrown)
         # Do a linear interpolation for missing values in the observations
-        laii = interp1d(doys, doys, lai)
-        cabi = interp1d(doys, doys, cab)
-        cbrowni = interp1d(doys, doys, cbrown)
+        # (in place, as the cleaned up arrays aren't needed any more)
+        laii = interp1d(doys, doys, lai, out=lai)
+        cabi = interp1d(doys, doys, cab, out=cab)
+        cbrowni = interp1d(doys, doys, cbrown, out=cbrown)
         # There might be some NaNs around, set to 0
         laii[np.isnan(laii)] = 0
         cabi[np.isnan(cabi)] = 0
@@ -161,12 +242,163 @@ class KaSKA(object):
         cbrowni =  interp1d(doy_grid, doys, scbrown)
         return (["lai", "cab", "cbrown"], [laii, cabi, cbrowni])
 
+    def _run_whittaker(self, doys, doy_grid, lai, cab, cbrown):
+        """Smooths the (cleaned up) first pass retrievals straight onto the
+        time grid with a robust weighted Whittaker smoother, rather than
+        interpolating, smoothing and interpolating again. Gaps are just
+        missing observations, and the irregular spacing of the
+        observations is taken into account. As in `_run_smoother`, LAI is
+        weighted by itself, and Cab and Cbrown by the smoothed LAI.
+
+        `whittaker_lambda` gives the smoothness on smoothn's scale, where
+        the second differences are taken between consecutive
+        observations. Over a smooth series, that penalty is about
+        `s*h_obs**3` times the integrated squared second derivative, and
+        the Whittaker penalty on the time grid is `lmbda*h_grid**3` times
+        the same integral (`h_obs` and `h_grid` are the mean spacings of
+        the observations and of the grid), so the smoother uses
+        `lmbda = s*(h_obs/h_grid)**3`. This holds as long as the grid
+        resolves the smoothing scale (e.g. a grid no coarser than the
+        observations).
+
+        Parameters
+        ----------
+        doys : array
+            Observation days of year.
+        doy_grid : array
+            Time grid days of year.
+        lai, cab, cbrown : array
+            Packed `(n_obs, n_active)` first pass retrievals, NaN where
+            missing.
+
+        Returns
+        -------
+        tuple
+            Parameter names and packed `(n_tsteps, n_active)` arrays.
+        """
+        h_obs = np.ptp(doys)/max(len(doys) - 1, 1)
+        h_grid = np.ptp(doy_grid)/max(len(doy_grid) - 1, 1)
+        lambdas = {name: s*(h_obs/h_grid)**3
+                   for name, s in self.whittaker_lambda.items()}
+        finite = np.isfinite(lai)
+        lai_max = lai[finite].max() if finite.any() else 0.
+        slai = whittaker_smooth(doys, lai, doy_grid, lambdas["lai"],
+                                weights=lai/max(lai_max, 1e-12), robust=True)
+        slai[~np.isfinite(slai)] = 0
+        slai[slai < 0] = 0
+        # Smoothed LAI on the observation dates
+        w = interpolation_matrix(doys, doy_grid) @ \
+            slai.reshape(len(doy_grid), -1)
+        w = w.reshape(lai.shape)/max(w.max(), 1e-12)
+        scab = whittaker_smooth(doys, cab, doy_grid, lambdas["cab"],
+                                weights=w, robust=True)
+        scbrown = whittaker_smooth(doys, cbrown, doy_grid,
+                                   lambdas["cbrown"], weights=w,
+                                   robust=True)
+        scab[~np.isfinite(scab)] = 0
+        scbrown[~np.isfinite(scbrown)] = 0
+        return (["lai", "cab", "cbrown"], [slai, scab, scbrown])
+
+    def _run_refinement(self, parameter_names, parameter_data):
+        """Variational refinement of the smoothed first pass estimates.
+        The smoothed parameters are used both as the starting point and
+        as the prior mean (the PROSAIL parameters that the first pass
+        doesn't retrieve get a default prior). The state is then fitted
+        to the observed reflectances through the emulator, with the
+        smoothness constraint from `kaska_cost`. The pixels in the state
+        mask are solved together in blocks of `refine_block_size` pixels,
+        and each block gets a share of the remaining time budget. Pixels
+        left unfinished when the budget runs out keep their current
+        estimate, and pixels where the solver fails keep the smoothed
+        estimate.
+
+        Parameters
+        ----------
+        parameter_names : list
+            Parameter names, as returned by `_run_smoother`.
+        parameter_data : list
+            Packed `(n_tsteps, n_active)` arrays, as returned by
+            `_run_smoother`.
+
+        Returns
+        -------
+        tuple
+            Parameter names and refined `(n_tsteps, n_active)` arrays.
+        """
+        tic = time.time()
+        state_mask = self._read_state_mask()
+        n_pix = state_mask.sum()
+        n_tsteps = len(self.time_grid)
+        n_params = len(PROSAIL_PRIOR_MEAN)
+        emulator = self.emulator
+        if emulator is None:
+            emulator = self.observations.emulator
+        s2_data = self.observations.read_time_series(self.time_grid)
+        if (n_pix == 0) or (len(s2_data.time) == 0):
+            LOG.info("No pixels or observations to refine")
+            return parameter_names, parameter_data
+        # Reflectances for the bands the inverter uses, (n_obs, n_bands,
+        # n_pix). Cloudy pixels are already NaN.
+        b_ind = self.inverter.b_ind
+        rho_surf = np.array([rho[b_ind][:, state_mask]
+                             for rho in s2_data.observations])
+        rho_unc = np.array([unc[b_ind]
+                            for unc in s2_data.uncertainty])[:, :, None]
+        angles = np.array(s2_data.metadata)
+        doy_obs = np.array([x.toordinal() for x in s2_data.time])
+        doy_grid = np.array([x.toordinal() for x in self.time_grid])
+
+        # Prior mean: default values, and the smoothed retrievals
+        mu_prior = np.tile(PROSAIL_PRIOR_MEAN, (n_pix, n_tsteps, 1))
+        for name, data in zip(parameter_names, parameter_data):
+            transform = PROSAIL_OUTPUTS[name]
+            mu_prior[:, :, transform.index] = transform.to_state(data.T)
+        lower, upper = PROSAIL_BOUNDS
+        mu_prior = np.clip(mu_prior, lower, upper).reshape(n_pix, -1)
+        c_prior_inv = np.tile(1./PROSAIL_PRIOR_SIGMA**2, n_tsteps)
+        bounds = (np.tile(lower, n_tsteps), np.tile(upper, n_tsteps))
+
+        x = mu_prior.copy()
+        failed = np.zeros(n_pix, dtype=bool)
+        blocks = np.array_split(np.arange(n_pix),
+                                int(np.ceil(n_pix/self.refine_block_size)))
+        for i, block in enumerate(blocks):
+            max_time = None
+            if self.refine_time_budget is not None:
+                max_time = max(self.refine_time_budget -
+                               (time.time() - tic), 0.)/(len(blocks) - i)
+            cost = BatchCostWrapper(doy_grid, doy_obs, rho_surf[:, :, block],
+                                    rho_unc, angles, self.refine_gamma,
+                                    emulator, mu_prior[block], c_prior_inv)
+            if self.refine_method == "lbfgs":
+                retval = minimize_batch(cost, x[block], bounds=bounds,
+                                        max_time=max_time)
+            else:
+                retval = gauss_newton_batch(cost, x[block], bounds=bounds,
+                                            max_time=max_time,
+                                            calc_variance=False)
+            x[block] = retval.x
+            failed[block] = retval.failed
+            LOG.info(f"Refined block {i+1:d}/{len(blocks):d}: " +
+                     f"{retval.converged.sum():d}/{block.size:d} " +
+                     f"pixels converged, {retval.failed.sum():d} failed")
+        LOG.info(f"Refinement done in {(time.time()-tic):g} s")
+        names, refined = state_to_parameters(
+            x, None, n_tsteps, n_params,
+            outputs={name: PROSAIL_OUTPUTS[name] for name in parameter_names})
+        for data, smoothed in zip(refined, parameter_data):
+            data[:, failed] = smoothed[:, failed]
+        return names, refined
+
     def save_s2_output(self, parameter_names, output_data,
                        time_grid=None, output_format="GTiff"):
+        """Saves the packed outputs of `run_retrieval` on the state mask
+        grid."""
         if time_grid is None:
             time_grid = self.time_grid
         save_output_parameters(time_grid, self.observations,
                                self.output_folder,
                                parameter_names, output_data,
                                output_format=output_format,
-                               chunk=self.chunk)
+                               chunk=self.chunk,
+                               state_mask=self._read_state_mask())
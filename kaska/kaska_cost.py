@@ -3,75 +3,322 @@ from collections import namedtuple
 
 import numpy as np
 
-common_computations = namedtuple('common_computations', 
+import scipy.sparse as sp
+
+common_computations = namedtuple('common_computations',
                     'y y_unc y_fwd dH_fwd diff prior_cost dprior_cost')
 
+
+def _obs_timestep_index(doy_obs, time_grid):
+    """Maps every observation to the closest time step in `time_grid`.
+
+    Parameters
+    ----------
+    doy_obs : array
+        Observation times (`n_obs`).
+    time_grid : array
+        State time grid (`n_tsteps`). Needs to be in the same units as
+        `doy_obs`.
+
+    Returns
+    -------
+    array
+        An `n_obs` integer array with the time step index of each
+        observation.
+    """
+    return np.argmin(np.abs(np.array(doy_obs)[:, None] -
+                            np.array(time_grid)), axis=1)
+
+
+def _as_prior_operator(c_prior_inv, n_state):
+    """Converts the inverse prior covariance into something we can
+    multiply state vectors with cheaply. Dense matrices are left alone,
+    but the prior is usually diagonal or banded, so we also take
+
+    * a `scipy.sparse` matrix,
+    * a 1D array with the main diagonal,
+    * a `(diagonals, offsets)` tuple, as in `scipy.sparse.diags`,
+
+    and store them as CSR sparse matrices.
+
+    Parameters
+    ----------
+    c_prior_inv : array, sparse matrix or tuple
+        The inverse prior covariance matrix.
+    n_state : int
+        The size of the state vector.
+
+    Returns
+    -------
+    array or sparse matrix
+        An `(n_state, n_state)` operator.
+    """
+    if sp.issparse(c_prior_inv):
+        c_prior_inv = sp.csr_matrix(c_prior_inv)
+    elif isinstance(c_prior_inv, tuple):
+        diagonals, offsets = c_prior_inv
+        c_prior_inv = sp.diags(diagonals, offsets, shape=(n_state, n_state),
+                               format="csr")
+    else:
+        c_prior_inv = np.asarray(c_prior_inv)
+        if c_prior_inv.ndim == 1:
+            c_prior_inv = sp.diags(c_prior_inv, 0, format="csr")
+    if c_prior_inv.shape != (n_state, n_state):
+        raise ValueError(f"Prior inverse covariance has shape " +
+                         f"{c_prior_inv.shape}, expected " +
+                         f"{(n_state, n_state)}")
+    return c_prior_inv
+
+
+def _smoothness_cost(x_grid, gamma):
+    """Second order difference model (smoothness) cost and its gradient.
+    The state is given as an array with the time steps along the
+    second-to-last axis and the parameters along the last one, so
+    it works both for a single pixel `(n_tsteps, n_params)` and for a
+    stack of pixels `(n_pix, n_tsteps, n_params)`.
+
+    Parameters
+    ----------
+    x_grid : array
+        The state, `(..., n_tsteps, n_params)`.
+    gamma : float or array
+        The regularisation strength. Either a scalar or one value per
+        parameter.
+
+    Returns
+    -------
+    tuple
+        The cost (summed over time and parameters, so a scalar for a
+        single pixel or an `n_pix` array for a stack) and its gradient,
+        with the same shape as `x_grid`.
+    """
+    p_diff = (2*x_grid[..., 1:-1, :] - x_grid[..., 2:, :] -
+              x_grid[..., :-2, :])
+    cost_model = 0.5*np.sum(gamma*p_diff**2, axis=(-2, -1))
+    dp_diff = gamma*p_diff
+    dcost_model = np.zeros_like(x_grid)
+    dcost_model[..., 1:-1, :] += 2*dp_diff
+    dcost_model[..., 2:, :] -= dp_diff
+    dcost_model[..., :-2, :] -= dp_diff
+    return cost_model, dcost_model
+
+
 class CostWrapper(object):
     def __init__(self, time_grid, current_data,
                  gamma, emu,
                  mu_prior, c_prior_inv):
-        
+
         self.gamma = gamma
         self.time_grid = time_grid
         self.current_data = current_data
         self.mu_prior = mu_prior
-        self.c_prior_inv = c_prior_inv
+        self.c_prior_inv = _as_prior_operator(c_prior_inv,
+                                              self.mu_prior.shape[0])
         self.doy_obs = self.current_data.doy
-        
+
 
         self.n_tsteps =  self.time_grid.shape[0]
         self.n_params = self.mu_prior.shape[0]//self.n_tsteps
-    
+
         self.emu = emu
 
+        # The observations don't change between calls, so we work out
+        # which time step each observation belongs to and stack the
+        # reflectances, uncertainties and angles only once.
+        self.obs_tstep = _obs_timestep_index(self.doy_obs, self.time_grid)
+        self.rho_surf = np.atleast_2d(np.array(self.current_data.rho_surf))
+        self.rho_inv_var = 1./np.atleast_2d(
+            np.array(self.current_data.rho_unc))**2
+        self.angles = np.c_[self.current_data.sza,
+                            self.current_data.vza,
+                            self.current_data.raa]
+        self.n_bands = self.rho_surf.shape[1]
+        self._gamma = np.array(self.gamma, dtype=float)
+
         self.common_computations= None
         self.x = None
 
     def calc_cost(self, x, *args):
+        """Calculates the cost function and its gradient for state `x`.
+        All the observations are pushed through the emulator in one
+        go.
+
+        Parameters
+        ----------
+        x : array
+            The state vector. The `n_params` parameters of each time step
+            are contiguous.
+
+        Returns
+        -------
+        tuple
+            The cost function (scalar) and its gradient.
+        """
+        x_grid = x.reshape(self.n_tsteps, self.n_params)
+        emu_in = np.hstack([x_grid[self.obs_tstep], self.angles])
+        emu_fwd = self.emu.predict(emu_in, cal_jac=True)
+        y_fwd = np.array([emu_fwd[band][0][:, 0]
+                          for band in range(self.n_bands)]).T
+        dH_fwd = np.array([emu_fwd[band][1][:, :-3]
+                           for band in range(self.n_bands)])
+        diff = y_fwd - self.rho_surf
+        obs_cost = 0.5*np.sum(diff**2*self.rho_inv_var)
+        # Gradient per observation, then added up over the observations
+        # sharing a time step
+        dcost_obs = np.einsum("bop,ob->op", dH_fwd, diff*self.rho_inv_var)
+        obs_dcost = np.zeros((self.n_tsteps, self.n_params))
+        np.add.at(obs_dcost, self.obs_tstep, dcost_obs)
 
-        idx = np.argmin(np.abs(np.array(self.doy_obs)[:, None] -
-                    np.array(self.time_grid) ),
-                    axis=1)
-        obs_cost = 0.
-        obs_dcost = np.zeros_like(x)
-        for tstep in np.unique(idx):
-            x_f = x[tstep*self.n_params:((tstep+1)*self.n_params)]
-            obs_list = np.where(idx == tstep)
-            for j in obs_list[0]:
-                
-                refl = self.current_data.rho_surf[j]
-                rho_unc = self.current_data.rho_unc[j]
-                sza = self.current_data.sza[j]
-                vza = self.current_data.vza[j] 
-                raa = self.current_data.raa[j]
-                x_tstep = np.r_[x_f, sza, vza, raa]
-                emu_fwd = self.emu.predict(x_tstep, cal_jac=True)        
-                for band in range(len(refl)):
-                    y = refl[band]
-                    y_unc = rho_unc[band]
-                    y_fwd = emu_fwd[band][0].squeeze()
-                    dH_fwd = emu_fwd[band][1][:-3]
-                    diff = y_fwd - y
-                    obs_cost += 0.5*(diff**2)/y_unc**2
-                    obs_dcost[tstep*self.n_params:((tstep+1)*self.n_params)] += \
-                        dH_fwd*diff/y_unc**2
         d = (x- self.mu_prior )
-        cost_prior = 0.5*(d@self.c_prior_inv@d)
         dcost_prior = self.c_prior_inv@d
-        cost_model = 0
-        dcost_model = np.zeros_like(x)
-        for param in range(self.n_params):
-            xp = x[param::self.n_params]
-            #p_diff = 1*np.gradient(xp[::-1], edge_order=2)
-            p_diff = xp[1:-1] - xp[2:] + xp[1:-1] - xp[:-2]
-            if isinstance(self.gamma, list):
-                xcost_model = 0.5*self.gamma[param]*np.sum(p_diff**2)
-                xdcost_model = 1*self.gamma[param]*p_diff
-            else:
-                xcost_model = 0.5*self.gamma*np.sum(p_diff**2)
-                xdcost_model = 1*self.gamma*p_diff
-            dcost_model[param::self.n_params][1:-1] += xdcost_model
-            cost_model += xcost_model
-        return (obs_cost + cost_prior + cost_model, 
-                obs_dcost + dcost_prior + dcost_model)
-                
+        cost_prior = 0.5*(d@dcost_prior)
+        cost_model, dcost_model = _smoothness_cost(x_grid, self._gamma)
+        return (obs_cost + cost_prior + cost_model,
+                obs_dcost.ravel() + dcost_prior + dcost_model.ravel())
+
+
+class BatchCostWrapper(object):
+    """The same cost function as `CostWrapper`, but for a stack of pixels
+    that share the observation dates and acquisition geometry (e.g. all
+    the pixels in a tile). The state of each pixel is a row of an
+    `(n_pix, n_tsteps*n_params)` array, ordered as in `CostWrapper`, and
+    all the pixels and observations go through the emulator in a single
+    call.
+
+    Parameters
+    ----------
+    time_grid : array
+        State time grid (`n_tsteps`).
+    doy_obs : array
+        Observation times (`n_obs`), in the same units as `time_grid`.
+    rho_surf : array
+        Surface reflectance, `(n_obs, n_bands, n_pix)`. Missing
+        observations (e.g. clouds) are flagged as NaN.
+    rho_unc : array
+        Reflectance uncertainty. Anything that broadcasts to `rho_surf`
+        (e.g. one value per observation and band, `(n_obs, n_bands, 1)`).
+    angles : array
+        `(n_obs, 3)` array with the SZA, VZA and RAA terms the emulator
+        expects for each observation.
+    gamma : float or list
+        Smoothness regularisation, scalar or one value per parameter.
+    emu : Two_NN
+        The emulator.
+    mu_prior : array
+        Prior mean, either shared (`n_state`) or per pixel
+        `(n_pix, n_state)`.
+    c_prior_inv : array, sparse matrix or tuple
+        Inverse prior covariance, shared by all pixels. See
+        `_as_prior_operator` for the accepted types.
+    """
+    def __init__(self, time_grid, doy_obs, rho_surf, rho_unc, angles,
+                 gamma, emu, mu_prior, c_prior_inv):
+        self.time_grid = np.asarray(time_grid)
+        self.doy_obs = np.asarray(doy_obs)
+        self.gamma = gamma
+        self.emu = emu
+        self.n_tsteps = self.time_grid.shape[0]
+        self.n_state = np.shape(mu_prior)[-1]
+        self.n_params = self.n_state//self.n_tsteps
+
+        rho_surf = np.asarray(rho_surf, dtype=float)
+        n_obs, self.n_bands, self.n_pix = rho_surf.shape
+        rho_unc = np.broadcast_to(np.asarray(rho_unc, dtype=float),
+                                  rho_surf.shape)
+        # Internally, we use a pixel-major layout, and missing
+        # observations just get a zero weight.
+        valid = np.isfinite(rho_surf) & np.isfinite(rho_unc)
+        self.rho_surf = np.where(valid, rho_surf, 0.).transpose(2, 0, 1)
+        self.rho_inv_var = np.where(valid, 1./np.where(valid, rho_unc, 1.)**2,
+                                    0.).transpose(2, 0, 1)
+        self.angles = np.asarray(angles, dtype=float)
+        self.mu_prior = np.broadcast_to(mu_prior, (self.n_pix, self.n_state))
+        self.c_prior_inv = _as_prior_operator(c_prior_inv, self.n_state)
+        self._gamma = np.array(self.gamma, dtype=float)
+        # Adds up per-observation terms into their time steps
+        self.obs_tstep = _obs_timestep_index(self.doy_obs, self.time_grid)
+        self.obs_to_tstep = np.zeros((self.n_tsteps, n_obs))
+        self.obs_to_tstep[self.obs_tstep, np.arange(n_obs)] = 1.
+
+    def _pixels(self, pixels):
+        return np.arange(self.n_pix) if pixels is None else pixels
+
+    def forward(self, x, pixels=None):
+        """Runs the emulator for all the observations of the pixels in
+        `pixels`.
+
+        Parameters
+        ----------
+        x : array
+            The state, `(n_sel, n_state)`.
+        pixels : array, optional
+            Indices of the pixels `x` refers to. By default, all of them.
+
+        Returns
+        -------
+        tuple
+            Residuals (model minus observations) and inverse variances,
+            both `(n_sel, n_obs, n_bands)`, and the emulator Jacobian
+            with respect to the parameters,
+            `(n_sel, n_obs, n_bands, n_params)`.
+        """
+        pixels = self._pixels(pixels)
+        n_sel = x.shape[0]
+        n_obs = self.doy_obs.shape[0]
+        x_grid = x.reshape(n_sel, self.n_tsteps, self.n_params)
+        emu_in = np.concatenate(
+            [x_grid[:, self.obs_tstep],
+             np.broadcast_to(self.angles, (n_sel, n_obs, 3))], axis=-1)
+        emu_fwd = self.emu.predict(emu_in.reshape(n_sel*n_obs, -1),
+                                   cal_jac=True)
+        y_fwd = np.stack([emu_fwd[band][0][:, 0]
+                          for band in range(self.n_bands)], axis=-1)
+        dH_fwd = np.stack([emu_fwd[band][1][:, :-3]
+                           for band in range(self.n_bands)], axis=1)
+        diff = y_fwd.reshape(n_sel, n_obs, self.n_bands) - self.rho_surf[pixels]
+        return (diff, self.rho_inv_var[pixels],
+                dH_fwd.reshape(n_sel, n_obs, self.n_bands, self.n_params))
+
+    def calc_cost(self, x, pixels=None):
+        """Calculates the cost function and its gradient for a stack of
+        pixels.
+
+        Parameters
+        ----------
+        x : array
+            The state, `(n_sel, n_state)`.
+        pixels : array, optional
+            Indices of the pixels `x` refers to. By default, all of them.
+
+        Returns
+        -------
+        tuple
+            The cost function per pixel (`n_sel`) and its gradient,
+            `(n_sel, n_state)`.
+        """
+        cost, dcost, _ = self.calc_cost_jacobian(x, pixels)
+        return cost, dcost
+
+    def calc_cost_jacobian(self, x, pixels=None):
+        """As `calc_cost`, but also returns the output of `forward`
+        (residuals, inverse variances and emulator Jacobian), so that
+        e.g. a Gauss-Newton solver can build the Hessian without running
+        the emulator again.
+        """
+        pixels = self._pixels(pixels)
+        diff, inv_var, dH_fwd = self.forward(x, pixels)
+        w_diff = diff*inv_var
+        obs_cost = 0.5*np.sum(diff*w_diff, axis=(1, 2))
+        dcost_obs = np.einsum("sobp,sob->sop", dH_fwd, w_diff)
+        obs_dcost = np.einsum("to,sop->stp", self.obs_to_tstep, dcost_obs)
+
+        d = x - self.mu_prior[pixels]
+        dcost_prior = (self.c_prior_inv@d.T).T
+        cost_prior = 0.5*np.sum(d*dcost_prior, axis=1)
+        cost_model, dcost_model = _smoothness_cost(
+            x.reshape(-1, self.n_tsteps, self.n_params), self._gamma)
+        n_sel = x.shape[0]
+        return (obs_cost + cost_prior + cost_model,
+                obs_dcost.reshape(n_sel, -1) + dcost_prior +
+                dcost_model.reshape(n_sel, -1),
+                (diff, inv_var, dH_fwd))
@@ -1,139 +1,336 @@
 # -*- coding: utf-8 -*-
 
-"""Main module."""
+"""Retrieval of Water Cloud Model (WCM) parameters from Sentinel 1 data.
+The vegetation terms of the WCM are given by the LAI that KaSKA retrieves
+from Sentinel 2, so this is run after the S2 retrieval, using its
+(stitched) LAI output."""
 import logging
+import time
 
 import datetime as dt
 import numpy as np
 
 from scipy.interpolate import interp1d
+from scipy.cluster.vq import kmeans2, whiten
 
-from NNParameterInversion import NNParameterInversion
-
-from s2_observations import Sentinel2Observations
-
-from s1_observations import Sentinel1Observations
-
-from smoothn import smoothn
-
-from utils import define_temporal_grid
-
-from watercloudmodel import cost, cost_jac, cost_hess
-
-import scipy.optimize
-
-import time # Just for timekeeping
-
-LOG = logging.getLogger(__name__ )
-
-if __name__ == "__main__":
-    state_mask = "/home/ucfajlg/Data/python/KaFKA_Validation/LMU/carto/ESU.tif"
-    nc_file = "/data/selene/ucfajlg/ELBARA_LMU/mirror_ftp/141.84.52.201/S1/S1_LMU_site_2017_new.nc"
-    start_date = dt.datetime(2017, 5, 1)
-    end_date = dt.datetime(2017, 9, 1)
-    temporal_grid_space = 5
-    temporal_grid = define_temporal_grid(start_date, end_date,
-                                        temporal_grid_space)
-    # Define S1 observations
-    s1_obs = Sentinel1Observations(nc_file,
-                state_mask,
-                time_grid=temporal_grid)
-    
-    # Read in smoothed S2 retrievals
-    s2_data = np.load("temporary_dump.npz")
-    # Move everything to DoY to simplify interpolation
-    s2_doys = [int(dt.datetime.strftime(x, "%j"))
-               for x in s2_data.f.temporal_grid]
-    s1_doys = [int(dt.datetime.strftime(x, "%j"))
-               for x in s1_obs.dates.keys()]
-    n_sar_obs = len(s1_doys)
-    # Interpolate S2 retrievals to S1 time grid
-    f = interp1d(s2_doys, s2_data.f.slai, axis=0, bounds_error=False)
-    lai_s1 = f(s1_doys)
-    f = interp1d(s2_doys, s2_data.f.scab, axis=0, bounds_error=False)
-    cab_s1 = f(s1_doys)
-    f = interp1d(s2_doys, s2_data.f.scbrown, axis=0, bounds_error=False)
-    cbrown_s1 = f(s1_doys)
-    # Read in S1 data
-    S1_backscatter=s1_obs.read_time_series(temporal_grid)  
-
-
-    # Wrap cost functions
-    def cost_nolai(xx, svh, svv, lai, cab, theta):
-        n_obs = len(svh)
-        return cost(np.concatenate([xx[:6], lai,lai, xx[-n_obs:]]), svh,svv,theta)
-
-    def cost_nolai_jac(xx, svh, svv, lai, cab, theta):
-        n_obs = len(svh)
-        return cost_jac(np.concatenate([xx[:6], lai,lai, xx[-n_obs:]]), svh,svv,theta)
-
-    def cost_nolai_hess(xx, svh, svv, lai, cab, theta):
-        n_obs = len(svh)
-        return cost_hess(np.concatenate([xx[:6], lai, lai, xx[-n_obs:]]), svh,svv,theta)
-
-    Avv, Bvv, Cvv = -12,  0.05, 0.1
-    Avh, Bvh, Cvh = -14, 0.01, 0.1
-    sigma_soil0 = np.zeros(n_sar_obs)*0.2 # Say
-    x0_all = np.r_[Avv, Bvv, Cvv, Avh, Bvh, Cvh, sigma_soil0]#, V1, V2, sigma_soil]
-    nt, ny, nx = lai_s1.shape
-    Avv_out = np.zeros((ny, nx))
-    Bvv_out = np.zeros((ny, nx))
-    Cvv_out = np.zeros((ny, nx))
-    Avh_out = np.zeros((ny, nx))
-    Bvh_out = np.zeros((ny, nx))
-    Cvh_out = np.zeros((ny, nx))
-    cost_f = np.zeros((ny, nx))
-    sigma_soil_out = np.zeros((nt, ny, nx))
-    tic = time.time()
-    n_pxls = 0
-    bounds = [
-            [-40, -5],
-            [1e-4, 1],
-            [-40, -1],
-            [-40, -5],
-            [1e-4, 1],
-            [-40, -1],
-            *([[0.01, 1]]*n_sar_obs) ]
-    x0 = x0_all
-    for (row, col) in np.ndindex(*lai_s1[0].shape):
-        lai = lai_s1[:, row, col]
-        if lai.max() < 2.5:
-            cost_f[row, col] = -900. # No dynamics
-            continue
-        # Select one pixel
-        svv = 10*np.log10(S1_backscatter.VV[:, row, col])
-        svh = 10*np.log10(S1_backscatter.VH[:, row, col])
-        theta = S1_backscatter.theta[:, row, col]
-        sigma_soil0 = np.ones_like(svv)*0.2 # 
-        
-        cab = cab_s1[:, row, col]
-        # Might be worth defining Cxx from LAI=0 average and
-        #  Axx when LAI=LAI.max()
-        x0[2] = svv[lai<0.3].mean()
-        x0[5] = svh[lai<0.3].mean()
-        x0[0] = svv[lai>(0.9*lai.max())].mean()
-        x0[3] = svh[lai>(0.9*lai.max())].mean()
-        retval = scipy.optimize.minimize(cost_nolai, x0, args=(svh, svh, lai, cab, theta), 
-                                 jac=cost_nolai_jac, hess=cost_nolai_hess,
-                                method="Newton-CG")
-        Avv_out[row, col] = retval.x[0]
-        Bvv_out[row, col] = retval.x[1]
-        Cvv_out[row, col] = retval.x[2]
-        Avh_out[row, col] = retval.x[3]
-        Bvh_out[row, col] = retval.x[4]
-        Cvh_out[row, col] = retval.x[5]
-        cost_f[row, col] = retval.fun
-        sigma_soil_out[:, row, col] = retval.x[6:]
-        if retval.fun < 1e5:
-            print(f"Good good...{row:d}, {col:d}")
-            x0 = retval.x
-        else:
-            # Rubbish inversion, do not use parameters!
-            x0 = x0_all
-
-        n_pxls += 1
-        if n_pxls % 1000 == 0:
-            n_pxls = 0
-            LOG.info(f"Done 100 pixels in {(time.time()-tic):g}")
-            tic = time.time()
+from osgeo import gdal
 
+from .utils import reproject_data, save_output_parameters
+
+from .watercloudmodel import newton_arrowhead, WCM_BOUNDS
+
+LOG = logging.getLogger(__name__)
+
+# The parameters that are constant over the time series, in the order
+# used by `watercloudmodel.cost`
+SAR_PARAMETERS = ["Avv", "Bvv", "Cvv", "Avh", "Bvh", "Cvh"]
+
+# Default values for the above
+SAR_DEFAULT = np.array([-12, 0.05, 0.1, -14, 0.01, 0.1])
+
+# Default soil term
+SOIL_DEFAULT = 0.2
+
+# Pixels where the LAI never goes above this don't have enough
+# vegetation dynamics to fit the WCM. Their cost is set to `NO_DYNAMICS`
+LAI_MIN_DYNAMICS = 2.5
+NO_DYNAMICS = -900.
+
+# Solver status of each pixel, in the `status` output (0 for the pixels
+# that aren't inverted)
+STATUS_CONVERGED = 1
+STATUS_MAX_ITER = 2
+STATUS_FAILED = 3
+
+
+def read_s2_lai(lai_file, state_mask):
+    """Reads a multiband LAI file (as produced by `stitch_outputs`) and
+    reprojects it to the state mask.
+
+    Parameters
+    ----------
+    lai_file : str
+        The LAI file. Each band must have a `DoY` metadata item with the
+        date as `%Y%j`.
+    state_mask : str or GDAL dataset
+        The state mask.
+
+    Returns
+    -------
+    tuple
+        A list of datetimes and a `(n_times, ny, nx)` LAI array.
+    """
+    g = gdal.Open(str(lai_file))
+    dates = [dt.datetime.strptime(
+                g.GetRasterBand(band + 1).GetMetadata()["DoY"], "%Y%j")
+             for band in range(g.RasterCount)]
+    g = None
+    g = reproject_data(str(lai_file), target_img=state_mask)
+    lai = g.ReadAsArray().astype(np.float64)
+    return dates, lai.reshape((len(dates), ) + lai.shape[-2:])
+
+
+def initial_guess(lai, svh, svv, bounds=WCM_BOUNDS):
+    """Vectorised starting point for the WCM inversion. `C` is set from
+    the mean backscatter over bare soil (LAI < 0.3), and `A` from the mean
+    backscatter when the LAI is within 10% of its maximum. Pixels where
+    there are no such observations keep the defaults.
+
+    Parameters
+    ----------
+    lai : array
+        `(n_pix, n_obs)` LAI.
+    svh : array
+        `(n_pix, n_obs)` VH backscatter.
+    svv : array
+        `(n_pix, n_obs)` VV backscatter.
+    bounds : tuple, optional
+        Lower and upper bounds for the constants and the soil term.
+
+    Returns
+    -------
+    array
+        `(n_pix, 6+n_obs)` starting point, as taken by `newton_arrowhead`.
+    """
+    n_pix, n_obs = lai.shape
+    x0 = np.concatenate([np.tile(SAR_DEFAULT, (n_pix, 1)),
+                         np.full((n_pix, n_obs), SOIL_DEFAULT)], axis=1)
+    bare = lai < 0.3
+    full = lai > 0.9*lai.max(axis=1, keepdims=True)
+    for column, obs, sel in [(0, svv, full), (2, svv, bare),
+                             (3, svh, full), (5, svh, bare)]:
+        n_sel = sel.sum(axis=1)
+        mean = np.sum(np.where(sel, obs, 0.), axis=1)/np.maximum(n_sel, 1)
+        x0[:, column] = np.where(n_sel > 0, mean, x0[:, column])
+    lower = np.r_[bounds[0][:6], np.broadcast_to(bounds[0][6:], (n_obs, ))]
+    upper = np.r_[bounds[1][:6], np.broadcast_to(bounds[1][6:], (n_obs, ))]
+    return np.clip(x0, lower, upper)
+
+
+def _group_solve(x0, lai, svh, svv, theta, groups, sigma=0.5):
+    """Fits the WCM to the group averaged data of groups of pixels (all
+    the groups together), and returns the solution of each pixel's group
+    and the total number of iterations."""
+    _, inverse, counts = np.unique(groups, return_inverse=True,
+                                   return_counts=True)
+    order = np.argsort(inverse, kind="stable")
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    group_data = [np.add.reduceat(arr[order], starts, axis=0)/counts[:, None]
+                  for arr in [x0, lai, svh, svv, theta]]
+    retval = newton_arrowhead(*group_data, sigma=sigma)
+    return retval.x[inverse], retval.n_iter.sum()
+
+
+def coarse_start(x0, lai, svh, svv, theta, rows, cols, factor=4,
+                 sigma=0.5):
+    """Starting points from a coarse resolution solve. Pixels are grouped
+    in `factor x factor` cells, the WCM is fitted to the cell averaged
+    LAI and backscatter, and each pixel starts from the solution of its
+    cell. All the cells are solved together, so unlike warm starting from
+    the previous pixel, this doesn't serialise the inversion.
+
+    Parameters
+    ----------
+    x0 : array
+        `(n_pix, 6+n_obs)` starting point for the coarse solve.
+    lai, svh, svv, theta : array
+        `(n_pix, n_obs)` LAI, backscatter and angle of incidence.
+    rows, cols : array
+        Pixel positions in the tile.
+    factor : int, optional
+        Size of the coarse cells, in pixels.
+    sigma : float, optional
+        Backscatter uncertainty.
+
+    Returns
+    -------
+    array
+        `(n_pix, 6+n_obs)` starting points.
+    """
+    cell = (rows//factor)*(cols.max()//factor + 1) + cols//factor
+    x_start, n_iter = _group_solve(x0, lai, svh, svv, theta, cell,
+                                   sigma=sigma)
+    LOG.info(f"Coarse solve: {np.unique(cell).size:d} cells, " +
+             f"{n_iter:d} iterations")
+    return x_start
+
+
+def cluster_start(x0, lai, svh, svv, theta, n_clusters, sigma=0.5, seed=0):
+    """Starting points from solving for clusters of similar pixels. The
+    pixels are clustered (k-means) on their LAI, VV and VH time series,
+    the WCM is fitted to each cluster's mean time series, and each pixel
+    starts from the solution of its cluster. Pixels in the same field
+    usually end up in the same cluster, and only need a few iterations
+    from there.
+
+    Parameters
+    ----------
+    x0 : array
+        `(n_pix, 6+n_obs)` starting point for the cluster solve.
+    lai, svh, svv, theta : array
+        `(n_pix, n_obs)` LAI, backscatter and angle of incidence.
+    n_clusters : int
+        Number of clusters.
+    sigma : float, optional
+        Backscatter uncertainty.
+    seed : int, optional
+        Random seed for the k-means initialisation.
+
+    Returns
+    -------
+    array
+        `(n_pix, 6+n_obs)` starting points.
+    """
+    n_clusters = max(min(n_clusters, lai.shape[0]), 1)
+    features = whiten(np.concatenate([lai, svv, svh], axis=1))
+    _, labels = kmeans2(features, n_clusters, minit="++", seed=seed)
+    x_start, n_iter = _group_solve(x0, lai, svh, svv, theta, labels,
+                                   sigma=sigma)
+    LOG.info(f"Cluster solve: {np.unique(labels).size:d} clusters, " +
+             f"{n_iter:d} iterations")
+    return x_start
+
+
+class KaSKASAR(object):
+    """The KaSKA Sentinel 1 retrieval object"""
+
+    def __init__(self, observations, time_grid, state_mask, s2_lai,
+                 output_folder, chunk=None, warm_start=None):
+        """Retrieves the WCM parameters (the `A`, `B` and `C` constants for
+        VV and VH, and the time-varying soil term) for the pixels in the
+        state mask.
+
+        Parameters
+        ----------
+        observations : Sentinel1Observations
+            The observations object.
+        time_grid : list
+            A list of datetimes. The S1 observations between the first
+            and last ones are used.
+        state_mask : str
+            The state mask filename.
+        s2_lai : str
+            The S2 LAI file, e.g. `lai.tif` from `kaska_runner`.
+        output_folder : str
+            Where to store the outputs.
+        chunk : str, optional
+            Chunk identifier, used in the output filenames.
+        warm_start : str, optional
+            How to get the starting point of each pixel. By default
+            (`None`), it is estimated from the pixel's own data (see
+            `initial_guess`). With "coarse", it is refined with a coarse
+            resolution solve (see `coarse_start`), and with "cluster",
+            with a solve for clusters of similar pixels (see
+            `cluster_start`), after which pixels only get
+            `cluster_refine_iter` iterations.
+        """
+        self.time_grid = time_grid
+        self.observations = observations
+        self.state_mask = state_mask
+        self.s2_lai = s2_lai
+        self.output_folder = output_folder
+        self.chunk = chunk
+        self.warm_start = warm_start
+        # Backscatter uncertainty [dB]
+        self.sigma = 0.5
+        # Size (in pixels) of the cells in the coarse warm start
+        self.coarse_factor = 4
+        # Average number of pixels per cluster, and number of refining
+        # iterations per pixel, in the cluster warm start
+        self.cluster_size = 50
+        self.cluster_refine_iter = 10
+
+    def _read_data(self):
+        """Reads the S1 observations and interpolates the S2 LAI to the S1
+        dates. Only the S1 dates within the LAI time series are kept."""
+        s1_data = self.observations.read_time_series(self.time_grid)
+        s2_dates, lai = read_s2_lai(self.s2_lai,
+                                    self.observations.state_mask)
+        s1_days = np.array([x.toordinal() for x in s1_data.time])
+        s2_days = np.array([x.toordinal() for x in s2_dates])
+        sel = (s1_days >= s2_days.min()) & (s1_days <= s2_days.max())
+        lai_s1 = interp1d(s2_days, lai, axis=0)(s1_days[sel])
+        dates = [x for x, keep in zip(s1_data.time, sel) if keep]
+        return (dates, lai_s1, s1_data.VH[sel], s1_data.VV[sel],
+                s1_data.theta[sel])
+
+    def run_retrieval(self):
+        """Runs the retrieval for all the pixels in the state mask with
+        enough vegetation dynamics. The backscatter is used as stored in
+        the observations (in dB).
+
+        Returns
+        -------
+        tuple
+            The S1 dates used, a list of parameter names and a list of
+            arrays. The WCM constants, the cost and the solver status
+            (`STATUS_CONVERGED`, `STATUS_MAX_ITER` or `STATUS_FAILED`)
+            are `(1, ny, nx)` arrays, the soil term is `(n_obs, ny, nx)`.
+            Pixels that aren't inverted are set to 0 (and the cost of
+            those with no dynamics to `NO_DYNAMICS`).
+        """
+        tic = time.time()
+        state_mask = self.observations.state_mask.ReadAsArray().astype(bool)
+        dates, lai, svh, svv, theta = self._read_data()
+        n_obs = len(dates)
+        ny, nx = state_mask.shape
+        parameter_names = SAR_PARAMETERS + ["sigma_soil", "cost", "status"]
+        parameter_data = [np.zeros((1, ny, nx)) for _ in SAR_PARAMETERS]
+        parameter_data += [np.zeros((n_obs, ny, nx)), np.zeros((1, ny, nx)),
+                           np.zeros((1, ny, nx))]
+        if n_obs == 0:
+            LOG.info("No S1 observations within the S2 LAI time series")
+            return dates, parameter_names, parameter_data
+        finite = np.all(np.isfinite(lai) & np.isfinite(svh) &
+                        np.isfinite(svv) & np.isfinite(theta), axis=0)
+        dynamic = np.max(np.where(finite, lai, 0.), axis=0) >= \
+            LAI_MIN_DYNAMICS
+        parameter_data[7][0, state_mask & finite & ~dynamic] = NO_DYNAMICS
+        valid = state_mask & finite & dynamic
+        n_pix = valid.sum()
+        LOG.info(f"Inverting {n_pix:d} pixels with {n_obs:d} S1 " +
+                 "observations")
+        if n_pix == 0:
+            return dates, parameter_names, parameter_data
+
+        lai, svh, svv, theta = [arr[:, valid].T
+                                for arr in [lai, svh, svv, theta]]
+        x0 = initial_guess(lai, svh, svv)
+        if self.warm_start == "coarse":
+            rows, cols = np.nonzero(valid)
+            x0 = coarse_start(x0, lai, svh, svv, theta, rows, cols,
+                              factor=self.coarse_factor, sigma=self.sigma)
+        max_iter = 100
+        if self.warm_start == "cluster":
+            x0 = cluster_start(x0, lai, svh, svv, theta,
+                               int(np.ceil(n_pix/self.cluster_size)),
+                               sigma=self.sigma)
+            max_iter = self.cluster_refine_iter
+        retval = newton_arrowhead(x0, lai, svh, svv, theta, sigma=self.sigma,
+                                  max_iter=max_iter)
+        for i, data in enumerate(parameter_data[:6]):
+            data[0, valid] = retval.x[:, i]
+        parameter_data[6][:, valid] = retval.x[:, 6:].T
+        parameter_data[7][0, valid] = retval.cost
+        status = np.where(retval.converged, STATUS_CONVERGED,
+                          np.where(retval.failed, STATUS_FAILED,
+                                   STATUS_MAX_ITER))
+        parameter_data[8][0, valid] = status
+        LOG.info(f"{retval.converged.sum():d}/{n_pix:d} pixels converged, " +
+                 f"{(status == STATUS_MAX_ITER).sum():d} out of " +
+                 f"iterations, {retval.failed.sum():d} failed " +
+                 f"in {(time.time()-tic):g} s")
+        return dates, parameter_names, parameter_data
+
+    def save_sar_output(self, dates, parameter_names, output_data,
+                        output_format="GTiff"):
+        """Saves the outputs of `run_retrieval`. The time-varying outputs
+        are stored per S1 date, and the rest with the first date of the
+        time grid."""
+        for param, data in zip(parameter_names, output_data):
+            time_grid = dates if param == "sigma_soil" else \
+                self.time_grid[:1]
+            save_output_parameters(time_grid, self.observations,
+                                   self.output_folder, [param], [data],
+                                   output_format=output_format,
+                                   chunk=self.chunk, fname_pattern="s1")
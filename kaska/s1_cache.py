@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""A cache of Sentinel 1 observations on the state mask grid.
+
+Reading the netCDF Sentinel 1 files and putting them on the state mask
+grid dominates the run time of the SAR retrieval, and it's the same for
+every run over the same site. `prepare_s1_cache` does it once, and stores
+each layer (VV, VH and theta) as a memory-mappable numpy cube, split in
+`(time, y, x)` blocks so that reading a tile (or a few dates) only touches
+the blocks it needs. `CachedSentinel1Observations` then serves the
+observations from the cache, as a drop-in replacement for
+`Sentinel1Observations`.
+"""
+import argparse
+import datetime as dt
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from .s1_observations import Sentinel1Observations, S1data
+
+LOG = logging.getLogger(__name__)
+
+CACHE_LAYERS = ["VV", "VH", "theta"]
+CACHE_METADATA = "s1_cache.json"
+
+
+def write_cube(fname, read_dates, shape, block_size=(16, 256, 256)):
+    """Writes a `(n_t, ny, nx)` cube as a blocked, memory-mappable `.npy`
+    file. The array stored has shape `(n_tblocks, n_yblocks, n_xblocks,
+    bt, by, bx)`, with each block contiguous on disk. Areas outside the
+    cube are NaN.
+
+    Parameters
+    ----------
+    fname : str
+        Output filename.
+    read_dates : callable
+        A function that takes a list of time indices and returns the
+        `(n, ny, nx)` data for them. It's called once per time block.
+    shape : tuple
+        The `(n_t, ny, nx)` cube shape.
+    block_size : tuple, optional
+        The `(bt, by, bx)` block size.
+    """
+    n_t, ny, nx = shape
+    bt, by, bx = block_size
+    n_blocks = [int(np.ceil(n/b)) for n, b in zip(shape, block_size)]
+    cube = np.lib.format.open_memmap(str(fname), mode="w+",
+                                     dtype=np.float32,
+                                     shape=tuple(n_blocks) + (bt, by, bx))
+    padded = np.full((bt, n_blocks[1]*by, n_blocks[2]*bx), np.nan,
+                     dtype=np.float32)
+    for tb in range(n_blocks[0]):
+        t_index = list(range(tb*bt, min((tb + 1)*bt, n_t)))
+        padded[:] = np.nan
+        padded[:len(t_index), :ny, :nx] = read_dates(t_index)
+        cube[tb] = padded.reshape(bt, n_blocks[1], by, n_blocks[2],
+                                  bx).transpose(1, 3, 0, 2, 4)
+    cube.flush()
+    del cube
+
+
+class S1Cache(object):
+    """Reads blocked cubes written by `write_cube`"""
+
+    def __init__(self, cache_folder):
+        self.cache_folder = Path(cache_folder)
+        with open(self.cache_folder/CACHE_METADATA, "r") as fp:
+            metadata = json.load(fp)
+        self.dates = [dt.datetime.fromisoformat(x)
+                      for x in metadata["dates"]]
+        self.shape = tuple(metadata["shape"])
+        self.block_size = tuple(metadata["block_size"])
+        self.cubes = {layer: np.load(self.cache_folder/f"{layer:s}.npy",
+                                     mmap_mode="r")
+                      for layer in metadata["layers"]}
+
+    def read(self, layer, t_index, y0, y1, x0, x1):
+        """Reads the dates in `t_index` of the window `[y0:y1, x0:x1]` of a
+        layer. Returns a `(len(t_index), y1-y0, x1-x0)` array."""
+        cube = self.cubes[layer]
+        bt, by, bx = self.block_size
+        t_index = np.asarray(t_index, dtype=int)
+        output = np.empty((t_index.size, y1 - y0, x1 - x0),
+                          dtype=np.float32)
+        for tb in np.unique(t_index//bt):
+            sel = np.flatnonzero(t_index//bt == tb)
+            t_block = t_index[sel] - tb*bt
+            for yb in range(y0//by, (y1 - 1)//by + 1):
+                ys, ye = max(y0, yb*by), min(y1, (yb + 1)*by)
+                for xb in range(x0//bx, (x1 - 1)//bx + 1):
+                    xs, xe = max(x0, xb*bx), min(x1, (xb + 1)*bx)
+                    block = cube[tb, yb, xb]
+                    output[sel, (ys - y0):(ye - y0), (xs - x0):(xe - x0)] = \
+                        block[t_block, (ys - yb*by):(ye - yb*by),
+                              (xs - xb*bx):(xe - xb*bx)]
+        return output
+
+
+def prepare_s1_cache(nc_file, state_mask, cache_folder,
+                     block_size=(16, 256, 256)):
+    """Puts all the observations in a Sentinel 1 netCDF file on the state
+    mask grid, and stores them in a cache that
+    `CachedSentinel1Observations` can read.
+
+    Parameters
+    ----------
+    nc_file : str
+        The Sentinel 1 netCDF file.
+    state_mask : str
+        The state mask filename.
+    cache_folder : str
+        Where to store the cache.
+    block_size : tuple, optional
+        The `(time, y, x)` block size, by default `(16, 256, 256)`.
+
+    Returns
+    -------
+    S1Cache
+        The cache.
+    """
+    s1_obs = Sentinel1Observations(nc_file, state_mask,
+                                   time_grid=[dt.datetime.min,
+                                              dt.datetime.max])
+    cache_folder = Path(cache_folder)
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    dates = sorted(s1_obs.dates.keys())
+    bands = [s1_obs.dates[x] for x in dates]
+    shape = (len(dates), ) + s1_obs.lookup[0].shape
+    for layer in CACHE_LAYERS:
+        LOG.info(f"Caching {layer:s}: {len(dates):d} dates")
+        write_cube(cache_folder/f"{layer:s}.npy",
+                   lambda t_index: s1_obs._read_layer(
+                       layer, [bands[i] for i in t_index]),
+                   shape, block_size=block_size)
+    metadata = {"dates": [x.isoformat() for x in dates],
+                "shape": shape, "block_size": list(block_size),
+                "layers": CACHE_LAYERS}
+    with open(cache_folder/CACHE_METADATA, "w") as fp:
+        json.dump(metadata, fp)
+    return S1Cache(cache_folder)
+
+
+class CachedSentinel1Observations(Sentinel1Observations):
+    """Sentinel 1 observations served from a cache prepared by
+    `prepare_s1_cache`"""
+
+    def __init__(self, cache_folder, state_mask, time_grid=None):
+        self.cache_folder = cache_folder
+        self.cache = S1Cache(cache_folder)
+        self.time_grid = time_grid
+        self.original_mask = state_mask
+        self.state_mask = state_mask
+        _, ny, nx = self.cache.shape
+        self.ulx, self.uly, self.lrx, self.lry = 0, 0, nx, ny
+        _, _, mask_nx, mask_ny = self.define_output()
+        if (mask_ny, mask_nx) != (ny, nx):
+            raise ValueError(f"Cache grid ({ny:d}, {nx:d}) doesn't match " +
+                             f"the state mask ({mask_ny:d}, {mask_nx:d})")
+        self._match_to_mask()
+
+    def _open_layers(self):
+        pass
+
+    def __getstate__(self):
+        """The cache cubes are memory maps, and pickling them (e.g. when
+        sending the object to dask workers) would copy all their data, so
+        the cache is reopened on the other side."""
+        state = self.__dict__.copy()
+        state.pop("cache", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = S1Cache(self.cache_folder)
+
+    def _match_to_window(self):
+        """`read_time_series` reads the current window straight from the
+        cache"""
+        pass
+
+    def _match_to_mask(self):
+        """The cache is already on the state mask grid, so there's only
+        the dates to select."""
+        self.dates = {x: i for i, x in enumerate(self.cache.dates)
+                      if self.time_grid is None or
+                      ((x >= self.time_grid[0]) and
+                       (x <= self.time_grid[-1]))}
+
+    def read_time_series(self, time_grid):
+        """Reads a time series of observations for the current window. See
+        `Sentinel1Observations.read_time_series`."""
+        early = time_grid[0]
+        late = time_grid[-1]
+        sel_dates = [k for k, v in self.dates.items()
+                     if ((k >= early) and (k < late))]
+        sel_index = [v for k, v in self.dates.items()
+                     if ((k >= early) and (k < late))]
+        obs = {layer: self.cache.read(layer, sel_index, self.uly, self.lry,
+                                      self.ulx, self.lrx).astype(np.float64)
+               for layer in CACHE_LAYERS}
+        return S1data(sel_dates, obs['VV'], obs['VH'], obs['theta'],
+                      0.5, 0.5)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Prepare a Sentinel 1 cache on a state mask grid")
+    parser.add_argument("nc_file", help="Sentinel 1 netCDF file")
+    parser.add_argument("state_mask", help="State mask file")
+    parser.add_argument("cache_folder", help="Output folder")
+    parser.add_argument("--block-size", type=int, nargs=3,
+                        default=[16, 256, 256],
+                        help="Block size in time, y and x")
+    args = parser.parse_args()
+    prepare_s1_cache(args.nc_file, args.state_mask, args.cache_folder,
+                     block_size=tuple(args.block_size))
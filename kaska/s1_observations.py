@@ -7,10 +7,10 @@ import logging
 from collections import namedtuple
 from pathlib import Path
 
-import gdal
+from osgeo import gdal, osr
 import numpy as np
 
-from .utils import reproject_data, define_temporal_grid
+from .utils import define_temporal_grid
 
 gdal.UseExceptions()
 
@@ -40,6 +40,67 @@ def get_s1_dates(s1_file):
     return times
 
 
+def _open_dataset(img):
+    """Opens `img` if it's a filename, otherwise assumes it's a dataset"""
+    try:
+        return gdal.Open(img)
+    except (RuntimeError, TypeError):
+        return img
+
+
+def nearest_cells(source, target):
+    """Nearest neighbour lookup from the pixel centres of a target raster
+    to the cells of a source raster (e.g. from the state mask to the
+    lat/lon netCDF grid). Replaces warping the source for every read: once
+    the lookup is available, the target grid is just a gather from the
+    source.
+
+    Parameters
+    ----------
+    source : GDAL dataset
+        The source raster. Without a projection, it's assumed to be in
+        EPSG:4326.
+    target : str or GDAL dataset
+        The target raster.
+
+    Returns
+    -------
+    tuple
+        `(ny, nx)` arrays with the source row and column of each target
+        pixel, set to -1 where the pixel falls outside the source.
+    """
+    target = _open_dataset(target)
+    geo_t = target.GetGeoTransform()
+    nx, ny = target.RasterXSize, target.RasterYSize
+    cols, rows = np.meshgrid(np.arange(nx) + 0.5, np.arange(ny) + 0.5)
+    x = geo_t[0] + cols*geo_t[1] + rows*geo_t[2]
+    y = geo_t[3] + cols*geo_t[4] + rows*geo_t[5]
+
+    target_srs = osr.SpatialReference()
+    target_srs.ImportFromWkt(target.GetProjection())
+    source_srs = osr.SpatialReference()
+    if source.GetProjection():
+        source_srs.ImportFromWkt(source.GetProjection())
+    else:
+        source_srs.ImportFromEPSG(4326)
+    for srs in [target_srs, source_srs]:
+        if hasattr(srs, "SetAxisMappingStrategy"):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(target_srs, source_srs)
+    points = np.array(transform.TransformPoints(
+        np.c_[x.ravel(), y.ravel()].tolist()))
+
+    src_geo_t = source.GetGeoTransform()
+    src_col = np.floor((points[:, 0] - src_geo_t[0])/src_geo_t[1])
+    src_row = np.floor((points[:, 1] - src_geo_t[3])/src_geo_t[5])
+    outside = ((src_col < 0) | (src_col >= source.RasterXSize) |
+               (src_row < 0) | (src_row >= source.RasterYSize))
+    src_col[outside] = -1
+    src_row[outside] = -1
+    return (src_row.astype(np.int64).reshape(ny, nx),
+            src_col.astype(np.int64).reshape(ny, nx))
+
+
 class Sentinel1Observations(object):
     def __init__(
         self,
@@ -52,6 +113,7 @@ class Sentinel1Observations(object):
                     "theta": "localIncidenceAngle"}
     ):
         self.time_grid = time_grid
+        self.original_mask = state_mask
         self.state_mask = state_mask
         self.nc_file = Path(netCDF_file)
         self.nc_layers = nc_layers
@@ -73,7 +135,24 @@ class Sentinel1Observations(object):
         )
         LOG.info(f"Applied ROI ulx, uly = ({ulx:d}, {uly:d}," +
                  f" w,h {width:d}, {height:d}")
-        self._match_to_mask()
+        self._match_to_window()
+
+    def _match_to_window(self):
+        """The datasets, dates and lookup for the full state mask are
+        already there, so only the window of the lookup is needed"""
+        self.lookup = tuple(index[self.uly:self.lry, self.ulx:self.lrx]
+                            for index in self.full_lookup)
+
+    def __getstate__(self):
+        """GDAL datasets can't be pickled (e.g. when sending the object to
+        dask workers), so they are reopened on the other side."""
+        state = self.__dict__.copy()
+        state.pop("s1_data_ptr", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_layers()
 
     def define_output(self):
         """Define the output array shapes to be consistent with the state
@@ -84,36 +163,73 @@ class Sentinel1Observations(object):
         -------
         tuple
             The first element is the projection string (WKT probably?), and
-            the second element is the geotransform.
+            the second element is the geotransform, followed by the number
+            of columns and rows.
         """
         try:
             g = gdal.Open(self.state_mask)
             proj = g.GetProjection()
             geoT = np.array(g.GetGeoTransform())
+            nx = g.RasterXSize
+            ny = g.RasterYSize
         except RuntimeError:
             proj = self.state_mask.GetProjection()
             geoT = np.array(self.state_mask.GetGeoTransform())
+            nx = self.state_mask.RasterXSize
+            ny = self.state_mask.RasterYSize
 
         # new_geoT = geoT*1.
         # new_geoT[0] = new_geoT[0] + self.ulx*new_geoT[1]
         # new_geoT[3] = new_geoT[3] + self.uly*new_geoT[5]
-        return proj, geoT.tolist()  # new_geoT.tolist()
+        return proj, geoT.tolist(), nx, ny  # new_geoT.tolist()
         
-    def _match_to_mask(self):
-        """Matches the observations to the state mask.
-        """
+    def _open_layers(self):
         self.s1_data_ptr = {}
         for layer, layer_name in self.nc_layers.items():
             fname = f'NETCDF:"{self.nc_file.as_posix():s}":{layer_name:s}'
-            self.s1_data_ptr[layer] = reproject_data(fname, output_format="VRT", 
-                                                srcSRS="EPSG:4326",
-                                                target_img=self.state_mask)
+            self.s1_data_ptr[layer] = gdal.Open(fname)
+
+    def _match_to_mask(self):
+        """Matches the observations to the state mask. Rather than warping
+        the netCDF layers, a nearest neighbour lookup from the state mask
+        pixels to the netCDF cells is built (all layers share the same
+        grid), and used by `read_time_series`. This is done once for the
+        full state mask, and `apply_roi` just takes a window of it.
+        """
+        self._open_layers()
+        layer = list(self.nc_layers.keys())[0]
+        self.full_lookup = nearest_cells(self.s1_data_ptr[layer],
+                                         self.state_mask)
+        self.lookup = self.full_lookup
         s1_dates = get_s1_dates(self.s1_data_ptr[layer])
         self.dates = {x:(i+1) 
                             for i, x in enumerate(s1_dates) 
                             if ( (x >= self.time_grid[0]) and 
                             (x <= self.time_grid[-1]))}
 
+    def _read_layer(self, layer, bands):
+        """Reads some bands of a layer on the state mask grid. Only the
+        window of the netCDF file that covers the state mask is read, once
+        per band, and then the pixels are gathered with the lookup. Pixels
+        outside the file or with no data are set to NaN."""
+        rows, cols = self.lookup
+        inside = rows >= 0
+        output = np.full((len(bands), ) + rows.shape, np.nan)
+        if not inside.any() or len(bands) == 0:
+            return output
+        yoff, xoff = rows[inside].min(), cols[inside].min()
+        ysize = rows[inside].max() - yoff + 1
+        xsize = cols[inside].max() - xoff + 1
+        win_rows, win_cols = rows[inside] - yoff, cols[inside] - xoff
+        for i, band_no in enumerate(bands):
+            band = self.s1_data_ptr[layer].GetRasterBand(band_no)
+            data = band.ReadAsArray(int(xoff), int(yoff), int(xsize),
+                                    int(ysize)).astype(np.float64)
+            nodata = band.GetNoDataValue()
+            if nodata is not None:
+                data[data == nodata] = np.nan
+            output[i, inside] = data[win_rows, win_cols]
+        return output
 
     def read_time_series(self, time_grid):
         """Reads a time series of observations. Uses the time grid to provide
@@ -138,10 +254,8 @@ class Sentinel1Observations(object):
         sel_bands = [v for k,v in self.dates.items()
                            if ((k >= early) and (k < late))]
         obs = {}
-        for ii, layer in enumerate(self.s1_data_ptr.keys()):
-                obs[layer] = np.array([self.s1_data_ptr[
-                                       layer].GetRasterBand(i).ReadAsArray()
-                                         for i in sel_bands])
+        for layer in self.s1_data_ptr.keys():
+            obs[layer] = self._read_layer(layer, sel_bands)
         the_obs = S1data(sel_dates, obs['VV'], obs['VH'], obs['theta'], 0.5, 0.5)
         return the_obs
     
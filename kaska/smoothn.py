@@ -2,7 +2,8 @@ from numpy import *
 import scipy.optimize.lbfgsb as lbfgsb
 import numpy.linalg
 from numpy.linalg import norm
-from scipy.fftpack.realtransforms import dct,idct
+from scipy.fft import dct,idct
+import numba
 import numpy as np
 import numpy.ma as ma
 
@@ -14,7 +15,8 @@ def H(y,t0=0):
   args = tuple([slice(0,y.shape[i]) for i in y.ndim])   
 
 def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
-	s0=None,z0=None,isrobust=False,W=None,s=None,MaxIter=100,TolZ=1e-3,weightstr='bisquare'):
+	s0=None,z0=None,isrobust=False,W=None,s=None,MaxIter=100,TolZ=1e-3,weightstr='bisquare',\
+	pixelwise=False,TolW=0,workers=None,stacked=False,pixelrobust=False):
   '''
    function [z,s,exitflag,Wtot] = smoothn(varargin)
 
@@ -39,11 +41,32 @@ def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
    Robust smoothing
    ----------------
    Z = SMOOTHN(...,'robust') carries out a robust smoothing that minimizes
-   the influence of outlying data.
+   the influence of outlying data. The residuals are scaled by the median
+   absolute deviation of the whole array (of each array with
+   stacked=True). With pixelrobust=True, and AXIS not covering all of Y,
+   the residuals of each series along AXIS are scaled by their own median
+   absolute deviation and leverage instead.
 
    [Z,S] = SMOOTHN(...) also returns the calculated value for S so that
    you can fine-tune the smoothing subsequently if needed.
 
+   Per-pixel smoothing
+   -------------------
+   Z = SMOOTHN(...,pixelwise=True) picks the smoothing parameter with GCV
+   for each series along AXIS on its own (e.g. for each pixel of a
+   (t, ny, nx) cube smoothed with axis=0), rather than one S for the whole
+   array. The GCV scores of nS0 candidate values of S are evaluated for
+   all the series at once from the same DCT, and S is then an array with
+   the shape of Y without the smoothed axes.
+
+   Whenever the series along AXIS are independent (S given or pixelwise,
+   and AXIS not covering all of Y), convergence is also tracked per
+   series: series that have converged are frozen, and later iterations
+   only transform the remaining ones. Robust steps are only redone for
+   the series whose robust weights changed by more than TolW. With
+   stacked=True, the first axis of Y stacks independent arrays (see
+   smoothn_stack), and each one stops on its own overall tolerance.
+
    An iteration process is used in the presence of weighted and/or missing
    values. Z = SMOOTHN(...,OPTION_NAME,OPTION_VALUE) smoothes with the
    termination parameters specified by OPTION_NAME and OPTION_VALUE. They
@@ -51,6 +74,12 @@ def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
        -----------------
        TolZ:       Termination tolerance on Z (default = 1e-3)
                    TolZ must be in ]0,1[
+       TolW:       Robust steps stop when the robust weights change by
+                   less than TolW (default = 0, no early stopping).
+                   E.g. 1e-2 saves robust steps, but the results
+                   drift from the fully robust ones
+       workers:    Number of threads for the DCTs (default = numba's
+                   thread count, see fft_workers)
        MaxIter:    Maximum number of iterations allowed (default = 100)
        Initial:    Initial value for the iterative process (default =
                    original data)
@@ -237,11 +266,13 @@ def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
   #isrobust
   #---
   # Automatic smoothing?
-  isauto = not s;
+  isauto = s is None or (np.ndim(s) == 0 and not s);
+  workers = fft_workers(workers)
+  pixelwise = pixelwise and isauto
   #---
   # DCTN and IDCTN are required
   try:
-    from scipy.fftpack.realtransforms import dct,idct
+    from scipy.fft import dct,idct
   except:
     z = y
     exitflag = -1;Wtot=0
@@ -252,18 +283,10 @@ def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
   # Lambda contains the eingenvalues of the difference matrix used in this
   # penalized least squares process.
   axis = tuple(np.array(axis).flatten())
-  d =  y.ndim;
-  Lambda = zeros(sizy);
-  for i in axis:
-    # create a 1 x d array (so e.g. [1,1] for a 2D case
-    siz0 = ones((1,y.ndim))[0].astype(int);
-    siz0[i] = sizy[i];
-    # cos(pi*(reshape(1:sizy(i),siz0)-1)/sizy(i)))
-    # (arange(1,sizy[i]+1).reshape(siz0) - 1.)/sizy[i]
-    Lambda = Lambda + (cos(pi*(arange(1,sizy[i]+1) - 1.)/sizy[i]).reshape(siz0))
-    #else:
-    #  Lambda = Lambda + siz0
-  Lambda = -2.*(len(axis)-Lambda);
+  Lambda = eigenvalues(sizy,axis)
+  # Independent series along axis can converge one by one
+  pixelmask = len(axis) < y.ndim and (not isauto or pixelwise)
+  active = None
   if not isauto:
     Gamma = 1./(1+(s*abs(Lambda))**smoothOrder);
 
@@ -274,6 +297,9 @@ def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
   # equation relating h to the smoothness parameter (Equation #12 in the
   # referenced CSDA paper).
   N = sum(array(sizy) != 1); # tensor rank of the y-array
+  if pixelwise:
+    # each series along axis is smoothed on its own
+    N = sum(array(sizy)[list(axis)] != 1);
   hMin = 1e-6; hMax = 0.99;
   # (h/n)**2 = (1 + a)/( 2 a)
   # a = 1/(2 (h/n)**2 -1) 
@@ -295,7 +321,7 @@ def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
     # purpose, a nearest neighbor interpolation followed by a coarse
     # smoothing are performed.
     #---
-    if z0 != None: # an initial guess (z0) has been provided
+    if z0 is not None: # an initial guess (z0) has been provided
         z = z0;
     else:
         z = y #InitialGuess(y,IsFinite);
@@ -329,12 +355,24 @@ def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
     #--- "amount" of weights (see the function GCVscore)
     aow = sum(Wtot)/noe; # 0 < aow <= 1
     #---
-    while tol>TolZ and nit<MaxIter:
+    if pixelmask:
+      z,s,exitflag = smooth_pixels(y,z,Wtot,Lambda,s,smoothOrder,axis,RF,\
+          isweighted,TolZ,MaxIter,active=active,verbose=verbose,workers=workers,\
+          groups=np.arange(sizy[0]).reshape((-1,)+(1,)*(y.ndim-1)) if stacked else None,\
+          ss=np.linspace(log10(sMinBnd),log10(sMaxBnd),nS0) if isauto else None)
+    while not pixelmask and tol>TolZ and nit<MaxIter:
         if verbose:
           print('tol',tol,'nit',nit)
         nit = nit+1;
-        DCTy = dctND(Wtot*(y-z)+z,f=dct);
-        if isauto and not remainder(log2(nit),1):
+        DCTy = dctND(Wtot*(y-z)+z,f=dct,axis=axis,workers=workers);
+        if isauto and not remainder(log2(nit),1) and pixelwise:
+            # GCV for every series along axis at once, picking s from nS0
+            # candidates spanning the bounds the first time, and around
+            # the current s afterwards
+            ss = np.linspace(log10(sMinBnd),log10(sMaxBnd),nS0)
+            s = gcv_pixel(ss,Lambda,DCTy,Wtot,y,smoothOrder,axis,
+                          s0=None if nit == 1 else s,workers=workers)
+        elif isauto and not remainder(log2(nit),1):
             #---
             # The generalized cross-validation (GCV) method is used.
             # We seek the smoothing parameter s that minimizes the GCV
@@ -355,7 +393,7 @@ def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
               ss = np.arange(nS0)*(1./(nS0-1.))*(log10(sMaxBnd)-log10(sMinBnd))+ log10(sMinBnd)
               g = np.zeros_like(ss)
               for i,p in enumerate(ss):
-                g[i] = gcv(p,Lambda,aow,DCTy,IsFinite,Wtot,y,nof,noe,smoothOrder)
+                g[i] = gcv(p,Lambda,aow,DCTy,IsFinite,Wtot,y,nof,noe,smoothOrder,axis,workers)
                 #print 10**p,g[i]
               xpost = [ss[g==g.min()]]
               #print '==============='
@@ -365,38 +403,58 @@ def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
               xpost = [s0]
             xpost,f,d = lbfgsb.fmin_l_bfgs_b(gcv,xpost,fprime=None,factr=1e7,\
                approx_grad=True,bounds=[(log10(sMinBnd),log10(sMaxBnd))],\
-               args=(Lambda,aow,DCTy,IsFinite,Wtot,y,nof,noe,smoothOrder))
-        s = 10**xpost[0];
-        # update the value we use for the initial s estimate
-        s0 = xpost[0]
+               args=(Lambda,aow,DCTy,IsFinite,Wtot,y,nof,noe,smoothOrder,axis,workers))
+        if not pixelwise:
+          s = 10**xpost[0];
+          # update the value we use for the initial s estimate
+          s0 = xpost[0]
 
         Gamma = 1./(1+(s*abs(Lambda))**smoothOrder);
 
-        z = RF*dctND(Gamma*DCTy,f=idct) + (1-RF)*z;
+        z = RF*dctND(Gamma*DCTy,f=idct,axis=axis,workers=workers) + (1-RF)*z;
         # if no weighted/missing data => tol=0 (no iteration)
         tol = isweighted*norm(z0-z)/norm(z);
        
         z0 = z; # re-initialization
-    exitflag = nit<MaxIter;
+    if not pixelmask:
+      exitflag = nit<MaxIter;
 
     if isrobust: #-- Robust Smoothing: iteratively re-weighted process
-        #--- average leverage
+        #--- average leverage (per series or per stacked array if asked)
+        Nh = N;
+        if pixelrobust and len(axis) < y.ndim:
+          series = axis; Nh = sum(array(sizy)[list(axis)] != 1);
+        elif stacked:
+          series = tuple(range(1,y.ndim));
+          if not pixelwise:
+            Nh = sum(array(sizy)[1:] != 1);
+        else:
+          series = None;
         h = sqrt(1+16.*s); 
         h = sqrt(1+h)/sqrt(2)/h; 
-        h = h**N;
+        h = h**Nh;
         #--- take robust weights into account
-        Wtot = W*RobustWeights(y-z,IsFinite,h,weightstr);
+        Wnew = W*RobustWeights(y-z,IsFinite,h,weightstr,axis=series);
+        if pixelmask:
+          # only redo the series whose weights have changed
+          active = np.max(abs(Wnew-Wtot),axis=axis,keepdims=True)>TolW
+        else:
+          active = np.max(abs(Wnew-Wtot))>TolW
+        Wtot = Wnew
         #--- re-initialize for another iterative weighted process
         isweighted = True; tol = 1; nit = 0; 
         #---
         RobustStep = RobustStep+1;
-        RobustIterativeProcess = RobustStep<3; # 3 robust steps are enough.
+        # 3 robust steps are enough.
+        RobustIterativeProcess = RobustStep<3 and np.any(active);
     else:
         RobustIterativeProcess = False; # stop the whole process
 
   ## Warning messages
   #---
-  if isauto:
+  if pixelwise:
+    s = np.squeeze(s,axis=axis)
+  elif isauto:
     if abs(log10(s)-log10(sMinBnd))<errp:
         warning('MATLAB:smoothn:SLowerBound',\
             ['s = %.3f '%(s) + ': the lower bound for s '\
@@ -410,14 +468,127 @@ def smoothn(y,nS0=10,axis=None,smoothOrder=2.0,sd=None,verbose=False,\
     #    + 'been exceeded. Increase MaxIter option or decrease TolZ value.'])
   return z,s,exitflag,Wtot
 
+def eigenvalues(sizy,axis):
+  '''
+  Eigenvalues (Lambda) of the difference matrix along the axes in axis,
+  for an array of shape sizy
+  '''
+  Lambda = zeros(sizy);
+  for i in axis:
+    # create a 1 x d array (so e.g. [1,1] for a 2D case
+    siz0 = ones((1,len(sizy)))[0].astype(int);
+    siz0[i] = sizy[i];
+    Lambda = Lambda + (cos(pi*(arange(1,sizy[i]+1) - 1.)/sizy[i]).reshape(siz0))
+  return -2.*(len(axis)-Lambda);
+
+def smoothn_sweep(y,s,axis=None,smoothOrder=2.0,W=None,sd=None,isrobust=False,\
+                  workers=None,**kwargs):
+  '''
+  Smooths y with each of the smoothing parameters in s, sharing the work
+  between them. Without weights, missing data or robust smoothing the
+  smoother is linear, so a single forward DCT of y is enough for all s.
+  Otherwise, the values of s are run from the largest to the smallest,
+  each starting from the smoothed data of the previous one. The robust
+  weights depend too much on s to be carried over. Other keyword
+  arguments are passed on to smoothn.
+
+  Returns the smoothed data for all s, stacked on a new first axis, and
+  the GCV score of each s (the smallest being the one smoothn would
+  pick).
+  '''
+  s = np.atleast_1d(s).astype(float)
+  y = np.array(y,dtype=float)
+  if axis is None:
+    axis = tuple(np.arange(y.ndim))
+  axis = tuple(np.array(axis).flatten())
+  if W is not None:
+    W = np.array(W,dtype=float)
+  Lambda = eigenvalues(y.shape,axis)
+  IsFinite = isfinite(y)
+  z = np.zeros((len(s),)+y.shape)
+  score = np.zeros(len(s))
+  yf = np.where(IsFinite,y,0.)
+  def gcv_score(si,zi,Wtot):
+    Gamma = 1./(1+(si*abs(Lambda))**smoothOrder);
+    RSS = np.sum((Wtot*(yf-zi)**2)[IsFinite])
+    return RSS/float(IsFinite.sum())/(1.-Gamma.sum()/float(y.size))**2
+  if (not isrobust and IsFinite.all() and sd is None and
+      (W is None or np.all(W == W.flat[0]))):
+    workers = fft_workers(workers)
+    DCTy = dctND(y,f=dct,axis=axis,workers=workers)
+    for i,si in enumerate(s):
+      z[i] = dctND(DCTy/(1+(si*abs(Lambda))**smoothOrder),f=idct,axis=axis,\
+                   workers=workers)
+      score[i] = gcv_score(si,z[i],1.)
+  else:
+    zi = None
+    for i in np.argsort(s)[::-1]:
+      zi,_,_,Wtot = smoothn(y.copy(),axis=axis,smoothOrder=smoothOrder,\
+          W=None if W is None else W.copy(),sd=sd,isrobust=isrobust,s=s[i],\
+          z0=None if zi is None else zi.copy(),workers=workers,**kwargs)
+      z[i] = zi
+      score[i] = gcv_score(s[i],zi,Wtot)
+  return z,score
+
 def warning(s1,s2):
   print(s1)
   print(s2[0])
 
+def median_along(r,I,axis):
+    '''
+    Median of the finite values (I) of every series of r along axis, with
+    the axes kept. The series are stacked, missing values are pushed to
+    their end, and the middle values are found with a single partition
+    (np.partition with the k-th positions needed by any series), so
+    there is no full sort and no loop over the series. Series without
+    finite values are NaN.
+    '''
+    rest = [i for i in range(r.ndim) if i not in axis]
+    rt = np.transpose(np.where(I,r,np.inf),rest+list(axis))
+    shape = rt.shape[:len(rest)]
+    rt = rt.reshape(int(np.prod(shape)),-1)
+    n = np.sum(np.isfinite(rt),axis=1)
+    lo = np.maximum((n-1)//2,0)[:,None]; hi = np.maximum(n//2,0)[:,None]
+    rt = np.partition(rt,np.unique(np.r_[lo,hi]),axis=1)
+    med = 0.5*(np.take_along_axis(rt,lo,1)+np.take_along_axis(rt,hi,1))[:,0]
+    med[n==0] = nan
+    return np.expand_dims(med.reshape(shape),axis)
+
+def smoothn_stack(ys,s,W=None,axis=None,**kwargs):
+  '''
+  Smooths several arrays of the same shape (e.g. the cubes of different
+  parameters) in one smoothn call, each with its own smoothing parameter
+  and weights. The arrays are stacked on a new first axis and smoothed
+  along axis (all of their axes by default), so the setup is done once
+  and every DCT works on all of them at the same time. Each series is
+  independent, as in separate calls: weights are normalised per array,
+  and convergence and robust weights are tracked per series. Other
+  keyword arguments are passed on to smoothn (s must be given).
+
+  Returns z, s, exitflag and Wtot as smoothn, with z and Wtot stacked on
+  the first axis.
+  '''
+  y = np.array([np.array(yi,dtype=float) for yi in ys])
+  n = y.shape[0]
+  if axis is None:
+    axis = tuple(np.arange(y.ndim-1))
+  axis = tuple(np.array(axis).flatten()+1)
+  s = np.reshape(np.broadcast_to(np.array(s,dtype=float),(n,)),
+                 (n,)+(1,)*(y.ndim-1))
+  if W is None:
+    W = [None]*n
+  Ws = np.ones_like(y)
+  for i,Wi in enumerate(W):
+    if Wi is not None:
+      Wi = np.broadcast_to(np.array(Wi,dtype=float),y.shape[1:])
+      Ws[i] = Wi/Wi.max() if Wi.max() > 0 else Wi
+  return smoothn(y,axis=axis,W=Ws,s=s,stacked=True,**kwargs)
+
 ## GCV score
 #---
 #function GCVscore = gcv(p)
-def gcv(p,Lambda,aow,DCTy,IsFinite,Wtot,y,nof,noe,smoothOrder):
+def gcv(p,Lambda,aow,DCTy,IsFinite,Wtot,y,nof,noe,smoothOrder,axis=None,\
+        workers=None):
     # Search the smoothing parameter s that minimizes the GCV score
     #---
     s = 10**p;
@@ -428,19 +599,169 @@ def gcv(p,Lambda,aow,DCTy,IsFinite,Wtot,y,nof,noe,smoothOrder):
         RSS = norm(DCTy*(Gamma-1.))**2;
     else:
         # take account of the weights to calculate RSS:
-        yhat = dctND(Gamma*DCTy,f=idct);
+        yhat = dctND(Gamma*DCTy,f=idct,axis=axis,workers=workers);
         RSS = norm(sqrt(Wtot[IsFinite])*(y[IsFinite]-yhat[IsFinite]))**2;
     #---
     TrH = sum(Gamma);
     GCVscore = RSS/float(nof)/(1.-TrH/float(noe))**2;
     return GCVscore
 
+## Per-pixel iterations
+def smooth_pixels(y,z,Wtot,Lambda,s,smoothOrder,axis,RF,isweighted,TolZ,\
+                  MaxIter,ss=None,active=None,verbose=False,workers=None,\
+                  groups=None):
+    '''
+    The smoothn iterations for independent series along axis. They stop
+    with the same overall tolerance as smoothn, but each series is frozen
+    as soon as its own relative change falls below TolZ, so later
+    iterations only transform the series still iterating. If groups (an
+    array of integer labels broadcastable to y) is given, the overall
+    tolerance is checked for each group of series on its own. Only the
+    series in the active mask (all of them by default) are iterated. If
+    ss is given, s is picked per series with GCV from those log10(s)
+    candidates (see gcv_pixel). Returns z, s and whether all the series
+    converged.
+    '''
+    pix = [i for i in range(y.ndim) if i not in axis]
+    perm = pix + list(axis)
+    shape = tuple(y.shape[i] for i in perm)
+    def flat(a):
+      return np.transpose(np.broadcast_to(a,y.shape),perm).reshape(
+          (-1,)+shape[len(pix):])
+    def unflat(a):
+      return np.transpose(a.reshape(shape[:len(pix)]+a.shape[1:]),
+                          np.argsort(perm))
+    ax = tuple(range(1,len(axis)+1))
+    def sumsq(a):
+      # sum of squares of each series, without a temporary
+      a = a.reshape(len(a),-1)
+      return np.einsum('ij,ij->i',a,a)
+    one = (slice(None),)+(slice(0,1),)*len(axis)
+    yf = flat(y); Wf = flat(Wtot); zf = flat(z).copy()
+    L = flat(Lambda)[:1]
+    sf = flat(0. if s is None else s)[one].copy()
+    gf = flat(0 if groups is None else groups)[one].ravel()
+    ng = gf.max()+1
+    todo = np.arange(zf.shape[0])
+    if active is not None:
+      todo = np.flatnonzero(flat(active)[one])
+    # the series still iterating are worked on as compact copies, only
+    # gathered again when some of them converge
+    ya = yf[todo]; Wa = Wf[todo]; za = zf[todo]; sa = sf[todo]
+    # series without weighted/missing data are done in one (unrelaxed)
+    # iteration, as in smoothn
+    wa = isweighted*np.any(Wa!=1,axis=ax)
+    RFa = np.where(wa,RF,1.).reshape(sa.shape)
+    ga = gf[todo]
+    znorm = np.bincount(gf,sumsq(zf),ng) - np.bincount(ga,sumsq(za),ng)
+    # with a fixed s, Gamma only depends on the series
+    Ga = None if ss is not None else 1./(1+(sa*abs(L))**smoothOrder)
+    # series still iterating (the compact copies can hold some more)
+    live = np.ones(todo.size,dtype=bool)
+    nit = 0
+    while live.any() and nit<MaxIter:
+        if verbose:
+          print('active',live.sum(),'nit',nit)
+        nit = nit+1;
+        DCTy = ya-za; DCTy *= Wa; DCTy += za
+        DCTy = dctND(DCTy,f=dct,axis=ax,workers=workers);
+        if ss is not None and not remainder(log2(nit),1):
+            sa = gcv_pixel(ss,L,DCTy,Wa,ya,smoothOrder,ax,
+                           s0=None if s is None and nit == 1 else sa,
+                           workers=workers)
+        Gamma = Ga if Ga is not None else 1./(1+(sa*abs(L))**smoothOrder);
+        DCTy *= Gamma
+        znew = dctND(DCTy,f=idct,axis=ax,workers=workers)
+        # relaxation, znew = RFa*znew + (1-RFa)*za, in place
+        znew -= za; znew *= RFa; znew += za
+        # if no weighted/missing data => tol=0 (no iteration)
+        change = wa*sumsq(za-znew)
+        za = znew
+        norm2 = sumsq(za)
+        # the overall tolerance (per group) is the same as in smoothn...
+        with np.errstate(divide='ignore',invalid='ignore'):
+          tol = np.sqrt(np.bincount(ga[live],change[live],ng)/
+                        (znorm + np.bincount(ga[live],norm2[live],ng)))
+        # ... but the series that have converged on their own stop here
+        done = live & ((change <= TolZ**2*norm2) | ~(tol[ga]>TolZ))
+        if done.any():
+          zf[todo[done]] = za[done]; sf[todo[done]] = sa[done]
+          znorm = znorm + np.bincount(ga[done],norm2[done],ng)
+          live = live & ~done
+        # compacting copies all the arrays, so it waits until enough
+        # series have stopped
+        if (~live).sum() > live.size//8:
+          todo = todo[live]; ga = ga[live]; ya = ya[live]; Wa = Wa[live]
+          za = za[live]; sa = sa[live]; wa = wa[live]; RFa = RFa[live]
+          if Ga is not None:
+            Ga = Ga[live]
+          live = live[live]
+    zf[todo[live]] = za[live]; sf[todo[live]] = sa[live]
+    if ss is not None or np.ndim(s):
+      s = unflat(sf)
+    return unflat(zf),s,nit<MaxIter
+
+## Per-pixel GCV scores
+def gcv_pixel(ss,Lambda,DCTy,Wtot,y,smoothOrder,axis,s0=None,workers=None):
+    '''
+    Smoothing parameter minimising the GCV score of each series along
+    axis. The log10(s) candidates in ss are scored first, then as many
+    candidates between the neighbours of the best one, and a parabola is
+    fitted through the scores around the minimum. If s0 (the previous
+    estimate) is given, only the neighbourhood of s0 is searched, as the
+    weighted GCV score often has a spurious minimum at the lower bound.
+    Returns s with the shape of y, but length 1 along axis.
+    '''
+    noe = np.prod([y.shape[i] for i in axis])
+    nof = np.maximum(np.sum(Wtot>0,axis=axis,keepdims=True),1)
+    aow = np.sum(Wtot,axis=axis,keepdims=True)/noe
+    # the inverse DCT is only needed where the weights matter
+    weighted = np.any(aow<=0.9)
+    def scores(pp):
+      g = []
+      for p in pp:
+        Gamma = 1./(1+(10**p*abs(Lambda))**smoothOrder);
+        RSS = np.sum((DCTy*(Gamma-1.))**2,axis=axis,keepdims=True)
+        if weighted:
+          yhat = dctND(Gamma*DCTy,f=idct,axis=axis,workers=workers);
+          RSS = np.where(aow>0.9,RSS,
+                         np.sum(Wtot*(y-yhat)**2,axis=axis,keepdims=True))
+        TrH = np.sum(Gamma,axis=axis,keepdims=True)
+        g.append(RSS/nof/(1.-TrH/noe)**2)
+      return np.array(g)
+    def best(pp,g):
+      k = np.argmin(g,axis=0)[None]
+      return np.take_along_axis(pp,k,0)[0]
+    dp = ss[1]-ss[0]
+    if s0 is None:
+      pp = np.broadcast_to(np.reshape(ss,(-1,)+(1,)*y.ndim),(len(ss),)+nof.shape)
+      p0 = best(pp,scores(pp))
+    else:
+      p0 = log10(s0)
+    pp = p0 + np.linspace(-dp,dp,len(ss)).reshape((-1,)+(1,)*y.ndim)
+    pp = np.clip(pp,ss[0],ss[-1])
+    g = scores(pp)
+    k = np.clip(np.argmin(g,axis=0),1,len(ss)-2)[None]
+    g0,g1,g2 = [np.take_along_axis(g,k+j,0)[0] for j in (-1,0,1)]
+    p = np.take_along_axis(pp,k,0)[0]
+    curv = g0-2*g1+g2
+    step = np.where(curv>0,0.5*(g0-g2)/np.where(curv>0,curv,1.),0.)
+    p = p + 2*dp/(len(ss)-1.)*np.clip(step,-1,1)
+    return 10**np.clip(p,ss[0],ss[-1])
+
 ## Robust weights
 #function W = RobustWeights(r,I,h,wstr)
-def RobustWeights(r,I,h,wstr):
+def RobustWeights(r,I,h,wstr,axis=None):
     # weights for robust smoothing.
-    MAD = median(abs(r[I]-median(r[I]))); # median absolute deviation
-    u = abs(r/(1.4826*MAD)/sqrt(1-h)); # studentized residuals
+    if axis is None:
+      MAD = median(abs(r[I]-median(r[I]))); # median absolute deviation
+      u = abs(r/(1.4826*MAD)/sqrt(1-h)); # studentized residuals
+    else:
+      # one MAD (and leverage h) per series along axis
+      MAD = median_along(abs(r-median_along(r,I,axis)),I,axis)
+      with np.errstate(divide='ignore',invalid='ignore'):
+        u = abs(r/(1.4826*MAD)/sqrt(1-h));
+      u[r==0] = 0; # exact fits, even when MAD is 0
     if wstr == 'cauchy':
         c = 2.385; W = 1./(1+(u/c)**2); # Cauchy weights
     elif wstr == 'talworth':
@@ -497,21 +818,27 @@ def InitialGuess(y,I):
 
 
 
-def dctND(data,f=dct):
-  nd = len(data.shape)
-  if nd == 1:
-    return f(data,norm='ortho',type=2)
-  elif nd == 2:
-    return f(f(data,norm='ortho',type=2).T,norm='ortho',type=2).T
-  elif nd ==3:
-    return f(f(f(data,norm='ortho',type=2,axis=0)\
-                     ,norm='ortho',type=2,axis=1)\
-                     ,norm='ortho',type=2,axis=2)
-  elif nd ==4:
-    return f(f(f(f(data,norm='ortho',type=2,axis=0)\
-                       ,norm='ortho',type=2,axis=1)\
-                       ,norm='ortho',type=2,axis=2)\
-                       ,norm='ortho',type=2,axis=3) 
+def fft_workers(workers=None):
+  '''
+  Number of threads for the DCTs. By default, as many as numba uses, so
+  that the transforms share the thread budget (NUMBA_NUM_THREADS or
+  numba.set_num_threads) of the compiled kernels
+  '''
+  if workers is None:
+    workers = numba.get_num_threads()
+  return workers
+
+def dctND(data,f=dct,axis=None,workers=None):
+  '''
+  Orthonormal (inverse) DCT of data along the axes in axis (all of them
+  by default), with workers threads
+  '''
+  if axis is None:
+    axis = range(data.ndim)
+  for i in axis:
+    data = f(data,norm='ortho',type=2,axis=i,workers=workers)
+  return data
+
 def peaks(n):   
   '''
   Mimic basic of matlab peaks fn
@@ -0,0 +1,131 @@
+'''
+Test the batched variational solver
+
+'''
+
+import pytest
+import numpy as np
+import scipy.optimize
+
+from ..kaska_cost import CostWrapper, BatchCostWrapper
+from ..batch_solver import minimize_batch, state_to_parameters
+from ..batch_solver import PROSAIL_OUTPUTS
+from .test_kaska_cost import ToyEmulator, ObsData
+
+
+def batch_problem(n_pix=20, n_tsteps=15, n_params=3, n_bands=4):
+    rng = np.random.RandomState(0)
+    time_grid = np.arange(n_tsteps)*5.
+    doys = np.sort(rng.uniform(0, time_grid[-1], 25))
+    n_obs = len(doys)
+    emu = ToyEmulator(n_params + 3, n_bands)
+    angles = rng.rand(n_obs, 3)
+    truth = 0.5 + 0.2*np.sin(time_grid[None, :, None]/20. +
+                             rng.rand(n_pix, 1, n_params))
+    tsteps = np.argmin(np.abs(doys[:, None] - time_grid), axis=1)
+    emu_in = np.concatenate([truth[:, tsteps],
+                             np.broadcast_to(angles, (n_pix, n_obs, 3))],
+                            axis=-1)
+    fwd = emu.predict(emu_in.reshape(n_pix*n_obs, -1))
+    rho = np.stack([band[0][:, 0] for band in fwd], axis=-1)
+    rho = rho.reshape(n_pix, n_obs, n_bands).transpose(1, 2, 0)
+    rho += rng.randn(*rho.shape)*0.01
+    # Some clouds
+    rho[3, :, 5] = np.nan
+    rho[10, :, :4] = np.nan
+    rho_unc = np.ones((n_obs, n_bands, 1))*0.01
+    mu_prior = np.ones(n_tsteps*n_params)*0.5
+    c_prior_inv = np.ones(n_tsteps*n_params)
+    cost = BatchCostWrapper(time_grid, doys, rho, rho_unc, angles, 100.,
+                            emu, mu_prior, c_prior_inv)
+    return cost, np.tile(mu_prior, (n_pix, 1))
+
+
+def pixel_cost(cost, pixel):
+    """A single pixel `CostWrapper` for a pixel in a `BatchCostWrapper`"""
+    rho = np.where(cost.rho_inv_var[pixel] > 0, cost.rho_surf[pixel], np.nan)
+    ok = np.all(np.isfinite(rho), axis=1)
+    data = ObsData(cost.doy_obs[ok], rho[ok],
+                   1./np.sqrt(cost.rho_inv_var[pixel][ok]),
+                   *cost.angles[ok].T)
+    return CostWrapper(cost.time_grid, data, cost.gamma, cost.emu,
+                       cost.mu_prior[pixel], np.eye(cost.n_state))
+
+
+def test_batch_cost():
+    cost, x0 = batch_problem()
+    x = x0 + np.random.RandomState(3).rand(*x0.shape)*0.1
+    f, grad = cost.calc_cost(x)
+    for pixel in [0, 2, 5]:
+        f_pxl, grad_pxl = pixel_cost(cost, pixel).calc_cost(x[pixel])
+        assert np.allclose(f[pixel], f_pxl)
+        assert np.allclose(grad[pixel], grad_pxl)
+    # A subset of pixels
+    f_sub, grad_sub = cost.calc_cost(x[[5, 2]], np.array([5, 2]))
+    assert np.allclose(f_sub, f[[5, 2]])
+    assert np.allclose(grad_sub, grad[[5, 2]])
+
+
+def test_minimize_batch():
+    cost, x0 = batch_problem()
+    solution = minimize_batch(cost, x0)
+    assert solution.converged.all()
+    assert not solution.failed.any()
+    for pixel in [0, 5, 11]:
+        retval = scipy.optimize.minimize(pixel_cost(cost, pixel).calc_cost,
+                                         x0[pixel], jac=True,
+                                         method="L-BFGS-B")
+        assert np.allclose(solution.cost[pixel], retval.fun, rtol=1e-5)
+
+
+def test_minimize_batch_bounds():
+    cost, x0 = batch_problem()
+    solution = minimize_batch(cost, x0, bounds=(0.45, 0.55))
+    assert solution.converged.all()
+    assert solution.x.min() >= 0.45
+    assert solution.x.max() <= 0.55
+    # Most of the state sits on the bounds
+    assert np.mean((solution.x == 0.45) | (solution.x == 0.55)) > 0.5
+    for pixel in [0, 5, 11]:
+        retval = scipy.optimize.minimize(
+            pixel_cost(cost, pixel).calc_cost, x0[pixel], jac=True,
+            method="L-BFGS-B", bounds=[(0.45, 0.55)]*x0.shape[1],
+            options={"ftol": 1e-14, "gtol": 1e-10, "maxiter": 1000})
+        assert np.allclose(solution.cost[pixel], retval.fun, rtol=1e-6)
+
+
+def test_minimize_batch_failed():
+    cost, x0 = batch_problem()
+    # Without any backtracking steps, the line search can't succeed
+    solution = minimize_batch(cost, x0, max_backtrack=0)
+    assert solution.failed.all()
+    assert not solution.converged.any()
+
+
+def test_minimize_batch_time_budget():
+    cost, x0 = batch_problem()
+    solution = minimize_batch(cost, x0, max_time=0.)
+    assert not solution.converged.any()
+    assert not solution.failed.any()
+    assert np.all(solution.n_iter == 0)
+
+
+def test_state_to_parameters():
+    n_tsteps, n_params = 4, 10
+    state_mask = np.zeros((3, 5), dtype=bool)
+    state_mask[1:, 2:] = True
+    n_pix = state_mask.sum()
+    lai = np.linspace(0.5, 5, n_pix*n_tsteps).reshape(n_pix, n_tsteps)
+    x = np.full((n_pix, n_tsteps, n_params), 0.5)
+    x[:, :, PROSAIL_OUTPUTS["lai"].index] = PROSAIL_OUTPUTS["lai"].to_state(
+        lai)
+    names, data = state_to_parameters(x.reshape(n_pix, -1), state_mask,
+                                      n_tsteps, n_params)
+    assert names == ["lai", "cab", "cbrown"]
+    assert data[0].shape == (n_tsteps, 3, 5)
+    assert np.allclose(data[0][:, state_mask], lai.T)
+    assert np.all(data[0][:, ~state_mask] == 0)
+    names, packed = state_to_parameters(x.reshape(n_pix, -1), None,
+                                        n_tsteps, n_params)
+    assert packed[0].shape == (n_tsteps, n_pix)
+    assert np.allclose(packed[0], lai.T)
@@ -0,0 +1,109 @@
+'''
+Test the banded Gauss-Newton solver
+
+'''
+
+import numpy as np
+import scipy.optimize
+
+from ..gauss_newton import cholesky_banded_batch, cho_solve_banded_batch
+from ..gauss_newton import inverse_diagonal_banded_batch
+from ..gauss_newton import gauss_newton_batch
+from ..batch_solver import minimize_batch
+from ..kaska_cost import BatchCostWrapper
+from .test_batch_solver import batch_problem, pixel_cost
+
+
+def banded_spd(n_pix=3, n=40, u=6, seed=0):
+    """Random banded SPD matrices, dense and in lower banded storage"""
+    rng = np.random.RandomState(seed)
+    dense = np.zeros((n_pix, n, n))
+    ab = np.zeros((n_pix, u + 1, n))
+    for pix in range(n_pix):
+        M = sum(np.diag(rng.randn(n - k), -k) for k in range(u//2 + 1))
+        dense[pix] = M@M.T + 0.1*np.eye(n)
+        for k in range(u + 1):
+            ab[pix, k, :n - k] = np.diag(dense[pix], -k)
+    return dense, ab
+
+
+def test_banded_solve():
+    dense, ab = banded_spd()
+    chol, failed = cholesky_banded_batch(ab)
+    assert not failed.any()
+    b = np.random.RandomState(1).randn(*dense.shape[:2])
+    x = cho_solve_banded_batch(chol, b)
+    for pix in range(dense.shape[0]):
+        assert np.allclose(x[pix], np.linalg.solve(dense[pix], b[pix]))
+
+
+def test_banded_inverse_diagonal():
+    dense, ab = banded_spd()
+    chol, _ = cholesky_banded_batch(ab)
+    diag = inverse_diagonal_banded_batch(chol)
+    for pix in range(dense.shape[0]):
+        assert np.allclose(diag[pix], np.diag(np.linalg.inv(dense[pix])))
+
+
+def test_banded_not_positive_definite():
+    _, ab = banded_spd()
+    ab[1, 0, 5] = -10.
+    _, failed = cholesky_banded_batch(ab)
+    assert np.all(failed == [False, True, False])
+
+
+def test_gauss_newton():
+    cost, x0 = batch_problem()
+    solution = gauss_newton_batch(cost, x0)
+    assert solution.converged.all()
+    assert not solution.failed.any()
+    assert solution.n_iter.max() <= 6
+    reference = minimize_batch(cost, x0)
+    assert np.allclose(solution.cost, reference.cost, rtol=1e-6)
+    assert solution.variance.shape == x0.shape
+    assert np.all(solution.variance > 0)
+
+
+def test_gauss_newton_bounds():
+    cost, x0 = batch_problem()
+    solution = gauss_newton_batch(cost, x0, bounds=(0.45, 0.55))
+    assert solution.converged.all()
+    assert solution.x.min() >= 0.45
+    assert solution.x.max() <= 0.55
+    # Most of the state sits on the bounds
+    assert np.mean((solution.x == 0.45) | (solution.x == 0.55)) > 0.5
+    for pixel in [0, 5, 11]:
+        retval = scipy.optimize.minimize(
+            pixel_cost(cost, pixel).calc_cost, x0[pixel], jac=True,
+            method="L-BFGS-B", bounds=[(0.45, 0.55)]*x0.shape[1],
+            options={"ftol": 1e-14, "gtol": 1e-10, "maxiter": 1000})
+        assert np.allclose(solution.cost[pixel], retval.fun, rtol=1e-6)
+
+
+def test_gauss_newton_singular():
+    cost, x0 = batch_problem()
+    # Without a prior, a pixel without observations is only constrained
+    # by the smoothness term, which leaves its offset and trend free
+    rho = np.where(cost.rho_inv_var > 0, cost.rho_surf, np.nan)
+    rho = rho.transpose(1, 2, 0)
+    rho[:, :, 3] = np.nan
+    cost = BatchCostWrapper(cost.time_grid, cost.doy_obs, rho, 0.01,
+                            cost.angles, cost.gamma, cost.emu, x0,
+                            np.zeros(x0.shape[1]))
+    solution = gauss_newton_batch(cost, x0)
+    assert list(np.flatnonzero(solution.failed)) == [3]
+    assert not solution.converged[3]
+    assert np.all(solution.converged[np.arange(20) != 3])
+
+
+def test_gauss_newton_stalled():
+    cost, x0 = batch_problem()
+    # Without any backtracking steps, no pixel can take a step, and they
+    # all fail, with or without the posterior variance
+    for calc_variance in [True, False]:
+        solution = gauss_newton_batch(cost, x0, max_backtrack=0,
+                                      calc_variance=calc_variance)
+        assert solution.failed.all()
+        assert not solution.converged.any()
+        assert np.all(solution.n_iter == 0)
+        assert np.all(solution.x == x0)
@@ -51,4 +51,38 @@ def test3d():
 #             diff    = numba_ret - np_ret
 #             if not np.nansum(diff)<1e-10:
 #                 raise
-#     print('Same result achieved and filled gaps')
\ No newline at end of file
+#     print('Same result achieved and filled gaps')
+
+
+def test_gaps():
+    rng = np.random.RandomState(0)
+    newx = np.arange(200)
+    oldx = np.array(sorted(rng.choice(np.arange(200), 100, replace=False)))
+    oldy = rng.rand(100, 5, 10)
+    oldy[rng.rand(*oldy.shape) > 0.5] = np.nan
+    oldy[:, 0, 0] = np.nan
+    numba_ret = interp_fix.interp1d(newx, oldx, oldy)
+    assert np.all(np.isnan(numba_ret[:, 0, 0]))
+    for i in range(5):
+        for j in range(10):
+            valid = ~np.isnan(oldy[:, i, j])
+            if valid.any():
+                np_ret = np.interp(newx, oldx[valid], oldy[valid, i, j])
+                assert np.allclose(np_ret, numba_ret[:, i, j])
+
+
+def test_out_float32():
+    rng = np.random.RandomState(0)
+    newx = np.arange(200)
+    oldx = np.array(sorted(rng.choice(np.arange(200), 100, replace=False)))
+    oldy = rng.rand(100, 5, 10).astype(np.float32)
+    out = np.empty((200, 5, 10), dtype=np.float32)
+    numba_ret = interp_fix.interp1d(newx, oldx, oldy, out=out)
+    assert numba_ret is out
+    assert np.allclose(numba_ret[:, 1, 2], np.interp(newx, oldx, oldy[:, 1, 2]))
+    with pytest.raises(ValueError):
+        interp_fix.interp1d(newx, oldx, oldy, out=np.empty((200, 5, 10)))
+    # in place, on the same x
+    expected = interp_fix.interp1d(oldx, oldx, oldy)
+    interp_fix.interp1d(oldx, oldx, oldy, out=oldy)
+    assert np.allclose(oldy, expected)
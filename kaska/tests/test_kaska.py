@@ -3,10 +3,19 @@
 
 """Tests for `kaska` package."""
 
+import datetime as dt
+from types import SimpleNamespace
+
 import pytest
+import numpy as np
+import scipy.optimize
 
 
 from .. import kaska
+from ..NNParameterInversion import NNParameterInversion
+from ..batch_solver import PROSAIL_BOUNDS, PROSAIL_PRIOR_MEAN
+from ..gauss_newton import gauss_newton_batch
+from .test_kaska_cost import ToyEmulator
 
 
 @pytest.fixture
@@ -23,3 +32,223 @@ def test_content(response):
     """Sample pytest test function with the pytest fixture as an argument."""
     # from bs4 import BeautifulSoup
     # assert 'GitHub' in BeautifulSoup(response.content).title.string
+
+
+def refinement_problem(method):
+    """A KaSKA object set up for `_run_refinement` on a small scene, with
+    the toy emulator, and smoothed first pass parameters. The smoothed
+    LAI is 0 (on the upper bound of the transformed LAI) in half of the
+    time steps, and the reflectances are simulated with the transformed
+    LAI beyond that bound."""
+    rng = np.random.RandomState(0)
+    state_mask = rng.rand(4, 5) > 0.3
+    n_pix = state_mask.sum()
+    time_grid = [dt.datetime(2017, 5, 1) + dt.timedelta(days=5*i)
+                 for i in range(8)]
+    dates = [dt.datetime(2017, 5, 3) + dt.timedelta(days=4*i)
+             for i in range(9)]
+    emulator = ToyEmulator(13, 8)
+    truth = PROSAIL_PRIOR_MEAN.copy()
+    truth[6] = 1.3
+    angles = rng.rand(len(dates), 3)
+    rho = np.array([[band[0][0, 0] for band in
+                     emulator.predict(np.r_[truth, angle])]
+                    for angle in angles])
+    observations = []
+    for rho_date in rho:
+        obs = np.full((13, 4, 5), 0.1)
+        obs[1:9] = rho_date[:, None, None] + rng.randn(8, 4, 5)*0.01
+        observations.append(obs)
+    s2_data = SimpleNamespace(time=dates, observations=observations,
+                              uncertainty=[np.ones(13)*0.01]*len(dates),
+                              metadata=list(angles))
+    observations = SimpleNamespace(
+        state_mask=SimpleNamespace(
+            ReadAsArray=lambda: state_mask.astype(np.uint8)),
+        emulator=emulator,
+        read_time_series=lambda time_grid: s2_data)
+    retrieval = object.__new__(kaska.KaSKA)
+    retrieval.observations = observations
+    retrieval.time_grid = time_grid
+    retrieval.emulator = None
+    retrieval.inverter = SimpleNamespace(b_ind=np.arange(1, 9))
+    retrieval.refine_gamma = 100.
+    retrieval.refine_block_size = 5
+    retrieval.refine_time_budget = None
+    retrieval.refine_method = method
+    lai = np.tile(np.r_[np.zeros(4), np.linspace(1, 3, 4)][:, None],
+                  (1, n_pix))
+    cab = np.full((8, n_pix), 40.)
+    cbrown = np.full((8, n_pix), 0.2)
+    return retrieval, ["lai", "cab", "cbrown"], [lai, cab, cbrown]
+
+
+@pytest.mark.parametrize("method", ["gauss-newton", "lbfgs"])
+def test_refinement_bounds(method, monkeypatch):
+    retrieval, names, data = refinement_problem(method)
+    solver = "minimize_batch" if method == "lbfgs" else "gauss_newton_batch"
+    original = getattr(kaska, solver)
+    costs = []
+
+    def recording_solver(cost, x0, **kwargs):
+        costs.append(cost)
+        return original(cost, x0, **kwargs)
+    monkeypatch.setattr(kaska, solver, recording_solver)
+    _, refined = retrieval._run_refinement(names, data)
+    lower, upper = PROSAIL_BOUNDS
+    n_tsteps = len(retrieval.time_grid)
+    bounds = list(zip(np.tile(lower, n_tsteps), np.tile(upper, n_tsteps)))
+    # Pixels of the first block, against a dense bounded solver
+    cost = costs[0]
+    for pixel in range(3):
+        def pixel_cost(x):
+            f, grad = cost.calc_cost(x[None], np.array([pixel]))
+            return f[0], grad[0]
+        retval = scipy.optimize.minimize(
+            pixel_cost, cost.mu_prior[pixel], jac=True, method="L-BFGS-B",
+            bounds=bounds,
+            options={"ftol": 1e-14, "gtol": 1e-10, "maxiter": 2000})
+        x_ref = retval.x.reshape(n_tsteps, -1)
+        # The LAI bound is active
+        assert np.any(x_ref[:, 6] == upper[6])
+        assert np.allclose(refined[0][:, pixel], -2*np.log(x_ref[:, 6]),
+                           atol=1e-3)
+        assert np.allclose(refined[1][:, pixel], -100*np.log(x_ref[:, 1]),
+                           atol=1e-2)
+
+
+def test_refinement_failed(monkeypatch):
+    retrieval, names, data = refinement_problem("gauss-newton")
+
+    def failing_solver(cost, x0, **kwargs):
+        retval = gauss_newton_batch(cost, x0, **kwargs)
+        failed = np.zeros_like(retval.failed)
+        failed[0] = True
+        return retval._replace(converged=retval.converged & ~failed,
+                               failed=failed)
+    monkeypatch.setattr(kaska, "gauss_newton_batch", failing_solver)
+    _, refined = retrieval._run_refinement(names, data)
+    # The first pixel of every block keeps the smoothed estimate
+    n_pix = data[0].shape[1]
+    blocks = np.array_split(np.arange(n_pix), int(np.ceil(n_pix/5)))
+    first = np.array([block[0] for block in blocks])
+    for smoothed, output in zip(data, refined):
+        assert np.all(output[:, first] == smoothed[:, first])
+        assert not np.allclose(output[:, first + 1],
+                               smoothed[:, first + 1])
+
+
+class ToyInverterModel(object):
+    """Stands in for the keras first pass inverter: maps the 8 band
+    reflectances and 3 angles to 10 transformed parameters in (0.05,
+    0.95), or puts the transformed LAI above 1 (negative LAI) if
+    `invalid_lai`."""
+    def __init__(self, invalid_lai=False):
+        self.w = np.random.RandomState(1).randn(11, 10)
+        self.invalid_lai = invalid_lai
+
+    def predict(self, X):
+        params = 0.05 + 0.9/(1. + np.exp(-(X - 0.5)@self.w))
+        if self.invalid_lai:
+            params[:, -2] = 1.5
+        return params
+
+
+def s2_retrieval(smoother, packed=True, invalid_lai=False):
+    """A KaSKA object set up for `run_retrieval` on a small masked tile,
+    with cloudy pixels, and the real first pass inversion code around a
+    toy inverter model. If not `packed`, the first pass returns the
+    parameters on the `(ny, nx)` grid."""
+    rng = np.random.RandomState(0)
+    ny, nx = 6, 7
+    state_mask = rng.rand(ny, nx) > 0.4
+    dates = [dt.datetime(2017, 4, 1) + dt.timedelta(days=int(day))
+             for day in np.cumsum(rng.randint(3, 12, 12))]
+    time_grid = [dt.datetime(2017, 4, 5) + dt.timedelta(days=8*i)
+                 for i in range(12)]
+    granules = {}
+    for i, date in enumerate(dates):
+        rho = 0.2 + 0.1*np.sin(i/3.) + 0.05*rng.rand(13, ny, nx)
+        clear = rng.rand(ny, nx) > 0.2
+        granules[date] = (rho, clear, 0.3, 0.1, 0.5, 0.01*rho)
+    observations = SimpleNamespace(
+        dates=dates, read_granule=granules.get,
+        state_mask=SimpleNamespace(
+            ReadAsArray=lambda: state_mask.astype(np.uint8)))
+    inverter = object.__new__(NNParameterInversion)
+    inverter.b_ind = np.arange(1, 9)
+    inverter.inverse_param_model = ToyInverterModel(invalid_lai)
+    retrieval = object.__new__(kaska.KaSKA)
+    retrieval.observations = observations
+    retrieval.time_grid = time_grid
+    retrieval.save_sgl_inversion = False
+    retrieval.refine = False
+    retrieval.smoother = smoother
+    retrieval.whittaker_lambda = {"lai": 0.05, "cab": 0.5, "cbrown": 0.5}
+    if packed:
+        retrieval.inverter = inverter
+    else:
+        def invert_observations(data, date, state_mask=None, packed=False):
+            return inverter.invert_observations(data, date,
+                                                state_mask=state_mask)
+        retrieval.inverter = SimpleNamespace(
+            invert_observations=invert_observations)
+    return retrieval, state_mask
+
+
+@pytest.mark.parametrize("smoother", ["smoothn", "whittaker"])
+def test_retrieval_packed(smoother):
+    retrieval, state_mask = s2_retrieval(smoother)
+    names, packed = retrieval.run_retrieval()
+    retrieval, _ = s2_retrieval(smoother, packed=False)
+    dense_names, dense = retrieval.run_retrieval()
+    assert names == dense_names == ["lai", "cab", "cbrown"]
+    n_tsteps = len(retrieval.time_grid)
+    for packed_data, dense_data in zip(packed, dense):
+        assert packed_data.shape == (n_tsteps, state_mask.sum())
+        assert np.all(np.isfinite(packed_data))
+        assert np.all(packed_data == dense_data)
+    assert np.any(packed[0] > 0)
+
+
+def test_first_pass_packed():
+    retrieval, state_mask = s2_retrieval("smoothn")
+    inverter = retrieval.inverter
+    for date in retrieval.observations.dates:
+        packed = inverter.invert_observations(
+            retrieval.observations, date, state_mask=state_mask, packed=True)
+        dense = inverter.invert_observations(
+            retrieval.observations, date, state_mask=state_mask)
+        assert packed.shape == (10, state_mask.sum())
+        assert np.all(packed == dense[:, state_mask])
+        assert np.all(dense[:, ~state_mask] == 0)
+
+
+def test_retrieval_whittaker():
+    # A time grid much finer than the observations
+    time_grid = [dt.datetime(2017, 4, 5) + dt.timedelta(days=2*i)
+                 for i in range(45)]
+    retrieval, _ = s2_retrieval("smoothn")
+    retrieval.time_grid = time_grid
+    _, reference = retrieval.run_retrieval()
+    retrieval, _ = s2_retrieval("whittaker")
+    retrieval.time_grid = time_grid
+    names, output = retrieval.run_retrieval()
+    assert names == ["lai", "cab", "cbrown"]
+    # With the smoothness rescaled to the grid, the Whittaker smoother
+    # stays close to smoothn away from the ends of the time grid
+    diff = [np.mean(np.abs(data - ref)[3:-3])
+            for data, ref in zip(output, reference)]
+    assert diff[0] < 0.02
+    assert diff[1] < 0.5
+    assert diff[2] < 0.05
+
+
+@pytest.mark.filterwarnings("error:All-NaN")
+def test_retrieval_whittaker_invalid_lai():
+    # No valid LAI anywhere in the tile
+    retrieval, state_mask = s2_retrieval("whittaker", invalid_lai=True)
+    _, output = retrieval.run_retrieval()
+    for data in output:
+        assert data.shape == (len(retrieval.time_grid), state_mask.sum())
+        assert np.all(data == 0)
@@ -0,0 +1,114 @@
+'''
+Test the KaSKA variational cost function
+
+'''
+from collections import namedtuple
+
+import pytest
+import numpy as np
+import scipy.sparse as sp
+
+from ..kaska_cost import CostWrapper
+
+ObsData = namedtuple("ObsData", "doy rho_surf rho_unc sza vza raa")
+
+
+class ToyEmulator(object):
+    """A smooth stand-in for `Two_NN` that returns the same structure
+    from `predict`: a list with `[output, jacobian]` per band."""
+    def __init__(self, n_inputs, n_bands, seed=42):
+        rng = np.random.RandomState(seed)
+        self.w = rng.randn(n_bands, n_inputs)*0.3
+
+    def predict(self, x, cal_jac=False):
+        x = np.atleast_2d(x)
+        rets = []
+        for w in self.w:
+            out = np.tanh(x@w)
+            dx = (1 - out**2)[:, None]*w[None, :]
+            rets.append([out[:, None], dx])
+        return rets
+
+
+def toy_problem(n_tsteps=12, n_params=3, n_bands=4, gamma=10.,
+                c_prior_inv=None):
+    rng = np.random.RandomState(1)
+    time_grid = np.arange(n_tsteps)*5.
+    doys = np.sort(rng.uniform(0, time_grid[-1], 20))
+    n_obs = len(doys)
+    emu = ToyEmulator(n_params + 3, n_bands)
+    data = ObsData(doys, rng.rand(n_obs, n_bands)*0.5,
+                   np.ones((n_obs, n_bands))*0.05,
+                   rng.rand(n_obs), rng.rand(n_obs), rng.rand(n_obs))
+    mu_prior = np.ones(n_tsteps*n_params)*0.5
+    if c_prior_inv is None:
+        c_prior_inv = np.eye(n_tsteps*n_params)*4.
+    cost = CostWrapper(time_grid, data, gamma, emu, mu_prior, c_prior_inv)
+    return cost, rng.rand(n_tsteps*n_params)
+
+
+def test_cost_gradient():
+    cost, x = toy_problem()
+    f0, grad = cost.calc_cost(x)
+    eps = 1e-6
+    num_grad = np.zeros_like(x)
+    for i in range(x.shape[0]):
+        dx = np.zeros_like(x)
+        dx[i] = eps
+        num_grad[i] = (cost.calc_cost(x + dx)[0] -
+                       cost.calc_cost(x - dx)[0])/(2*eps)
+    assert np.allclose(grad, num_grad, rtol=1e-5, atol=1e-5)
+
+
+def test_cost_gamma_list():
+    cost_list, x = toy_problem(gamma=[10., 10., 10.])
+    cost_scalar, _ = toy_problem(gamma=10.)
+    assert np.allclose(cost_list.calc_cost(x)[0], cost_scalar.calc_cost(x)[0])
+    cost_list, _ = toy_problem(gamma=[1., 10., 100.])
+    assert not np.allclose(cost_list.calc_cost(x)[0],
+                           cost_scalar.calc_cost(x)[0])
+
+
+def test_obs_cost_per_observation():
+    """The batched observation term matches a per-observation sum."""
+    cost, x = toy_problem(gamma=0.)
+    cost.c_prior_inv = np.zeros_like(cost.c_prior_inv)
+    data = cost.current_data
+    expected = 0.
+    for j, doy in enumerate(data.doy):
+        tstep = np.argmin(np.abs(cost.time_grid - doy))
+        x_f = x[tstep*cost.n_params:(tstep+1)*cost.n_params]
+        fwd = cost.emu.predict(np.r_[x_f, data.sza[j], data.vza[j],
+                                     data.raa[j]])
+        for band in range(cost.n_bands):
+            diff = fwd[band][0].squeeze() - data.rho_surf[j][band]
+            expected += 0.5*diff**2/data.rho_unc[j][band]**2
+    assert np.allclose(cost.calc_cost(x)[0], expected)
+
+
+@pytest.mark.parametrize("prior", ["sparse", "diagonal", "banded"])
+def test_sparse_prior(prior):
+    n_state = 12*3
+    main = np.linspace(1, 4, n_state)
+    off = -0.3*np.ones(n_state - 3)
+    dense = np.diag(main)
+    if prior == "diagonal":
+        c_prior_inv = main
+    else:
+        dense += np.diag(off, 3) + np.diag(off, -3)
+        if prior == "sparse":
+            c_prior_inv = sp.csc_matrix(dense)
+        else:
+            c_prior_inv = ([main, off, off], [0, 3, -3])
+    cost_dense, x = toy_problem(c_prior_inv=dense)
+    cost_sparse, _ = toy_problem(c_prior_inv=c_prior_inv)
+    assert sp.issparse(cost_sparse.c_prior_inv)
+    f_dense, g_dense = cost_dense.calc_cost(x)
+    f_sparse, g_sparse = cost_sparse.calc_cost(x)
+    assert np.allclose(f_dense, f_sparse)
+    assert np.allclose(g_dense, g_sparse)
+
+
+def test_prior_wrong_shape():
+    with pytest.raises(ValueError):
+        toy_problem(c_prior_inv=np.ones(5))
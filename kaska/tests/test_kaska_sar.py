@@ -0,0 +1,116 @@
+'''
+Test the Sentinel 1 retrieval helpers
+
+'''
+
+import pytest
+import numpy as np
+
+from types import SimpleNamespace
+
+from ..kaska_sar import initial_guess, SAR_DEFAULT, SOIL_DEFAULT
+from ..kaska_sar import coarse_start, cluster_start
+from ..kaska_sar import KaSKASAR, NO_DYNAMICS
+from ..kaska_sar import STATUS_CONVERGED, STATUS_MAX_ITER, STATUS_FAILED
+from ..watercloudmodel import WCM_BOUNDS, wcm_batch, newton_arrowhead
+
+
+def test_initial_guess():
+    lai = np.array([[0.1, 0.2, 2.0, 4.0, 3.9],
+                    [1.0, 2.0, 3.0, 4.0, 5.0]])
+    svv = np.array([[-14., -16., -12., -9., -11.],
+                    [-14., -16., -12., -9., -11.]])
+    svh = svv - 5.
+    x0 = initial_guess(lai, svh, svv)
+    assert x0.shape == (2, 11)
+    # Bare soil and full canopy means
+    assert np.allclose(x0[0, [0, 2, 3, 5]], [-10., -15., -15., -20.])
+    # No bare soil observations in the second pixel: default C, clipped
+    assert np.allclose(x0[1, [0, 3]], [-11., -16.])
+    assert np.allclose(x0[1, [2, 5]], np.minimum(SAR_DEFAULT[[2, 5]],
+                                                 WCM_BOUNDS[1][[2, 5]]))
+    assert np.all(x0[:, 6:] == SOIL_DEFAULT)
+
+
+def sar_field(ny=12, nx=12, n_obs=25, seed=0):
+    """A synthetic field: LAI trajectories and WCM parameters that vary
+    smoothly in space"""
+    rng = np.random.RandomState(seed)
+    rows, cols = [x.ravel() for x in np.mgrid[:ny, :nx]]
+    n_pix = rows.size
+    t = np.linspace(0, 1, n_obs)
+    peak = 0.5 + 0.1*np.sin(rows/5.)[:, None]
+    lai = 5*np.exp(-((t - peak)/0.2)**2) + 0.05
+    consts = np.array([-11, 0.06, -10, -13, 0.04, -14]) + \
+        0.5*np.cos(cols/7.)[:, None]*[1, 0.01, 1, 1, 0.01, 1]
+    soil = 0.2 + 0.1*rng.rand(n_pix, n_obs)
+    theta = np.tile(rng.uniform(30, 40, n_obs), (n_pix, 1))
+    svv = wcm_batch(np.c_[consts[:, :3], lai, lai, soil], theta=theta)
+    svh = wcm_batch(np.c_[consts[:, 3:], lai, lai, soil], theta=theta)
+    svv += rng.randn(n_pix, n_obs)*0.2
+    svh += rng.randn(n_pix, n_obs)*0.2
+    return rows, cols, lai, svh, svv, theta
+
+
+def test_coarse_start():
+    rows, cols, lai, svh, svv, theta = sar_field()
+    x0 = initial_guess(lai, svh, svv)
+    cold = newton_arrowhead(x0, lai, svh, svv, theta, max_iter=400)
+    x0_coarse = coarse_start(x0, lai, svh, svv, theta, rows, cols)
+    warm = newton_arrowhead(x0_coarse, lai, svh, svv, theta, max_iter=400)
+    assert warm.converged.all()
+    assert np.allclose(warm.cost, cold.cost, rtol=1e-3, atol=1e-2)
+    assert warm.n_iter.sum() < cold.n_iter.sum()
+
+
+def test_cluster_start():
+    rows, cols, lai, svh, svv, theta = sar_field()
+    x0 = initial_guess(lai, svh, svv)
+    cold = newton_arrowhead(x0, lai, svh, svv, theta, max_iter=400)
+    x0_cluster = cluster_start(x0, lai, svh, svv, theta, 5)
+    refined = newton_arrowhead(x0_cluster, lai, svh, svv, theta,
+                               max_iter=10)
+    # The cold start only needs a few tens of iterations per pixel, so
+    # the saving is modest, but the refined costs are very close
+    assert refined.n_iter.sum() < 0.6*cold.n_iter.sum()
+    rel_diff = (refined.cost - cold.cost)/cold.cost
+    assert np.median(rel_diff) < 1e-6
+    assert np.all(rel_diff < 0.02)
+
+
+def sar_retrieval(warm_start=None):
+    """A KaSKASAR object on the synthetic field, with the data reading
+    replaced. One pixel is masked out and one has no dynamics"""
+    ny, nx = 12, 12
+    rows, cols, lai, svh, svv, theta = sar_field(ny, nx)
+    lai[1] = 0.1
+    state_mask = np.ones((ny, nx), dtype=bool)
+    state_mask[0, 0] = False
+    retrieval = KaSKASAR.__new__(KaSKASAR)
+    KaSKASAR.__init__(retrieval, None, None, None, None, None,
+                      warm_start=warm_start)
+    retrieval.observations = SimpleNamespace(
+        state_mask=SimpleNamespace(ReadAsArray=lambda: state_mask))
+    dates = list(range(lai.shape[1]))
+    retrieval._read_data = lambda: (dates, *[
+        arr.T.reshape(-1, ny, nx) for arr in [lai, svh, svv, theta]])
+    return retrieval
+
+
+@pytest.mark.parametrize("warm_start", [None, "cluster"])
+def test_retrieval_status(warm_start):
+    retrieval = sar_retrieval(warm_start)
+    _, names, data = retrieval.run_retrieval()
+    status = data[names.index("status")][0]
+    cost = data[names.index("cost")][0]
+    assert status[0, 0] == 0 and cost[0, 0] == 0
+    assert status[0, 1] == 0 and cost[0, 1] == NO_DYNAMICS
+    inverted = status.ravel()[2:]
+    assert np.all(np.isin(inverted, [STATUS_CONVERGED, STATUS_MAX_ITER,
+                                     STATUS_FAILED]))
+    if warm_start is None:
+        assert np.all(inverted == STATUS_CONVERGED)
+    else:
+        # Only `cluster_refine_iter` iterations, which isn't enough for
+        # all of them
+        assert np.any(inverted == STATUS_MAX_ITER)
@@ -0,0 +1,49 @@
+'''
+Test the Sentinel 1 cache cubes
+
+'''
+
+import json
+import pickle
+
+import pytest
+import numpy as np
+
+from ..s1_cache import write_cube, S1Cache, CACHE_METADATA
+from ..s1_cache import CachedSentinel1Observations
+
+
+def test_cube_roundtrip(tmp_path):
+    rng = np.random.RandomState(0)
+    data = rng.rand(7, 11, 13).astype(np.float32)
+    write_cube(tmp_path/"VV.npy", lambda t_index: data[t_index],
+               data.shape, block_size=(3, 4, 5))
+    with open(tmp_path/CACHE_METADATA, "w") as fp:
+        json.dump({"dates": ["2017-05-01T00:00:00"]*7, "shape": data.shape,
+                   "block_size": [3, 4, 5], "layers": ["VV"]}, fp)
+    cache = S1Cache(tmp_path)
+    assert np.all(cache.read("VV", range(7), 0, 11, 0, 13) == data)
+    # Windows and dates that cut across blocks
+    t_index = [1, 2, 3, 6]
+    assert np.all(cache.read("VV", t_index, 3, 9, 2, 12) ==
+                  data[t_index, 3:9, 2:12])
+
+
+def test_cached_observations_pickle(tmp_path):
+    rng = np.random.RandomState(0)
+    data = rng.rand(7, 11, 13).astype(np.float32)
+    write_cube(tmp_path/"VV.npy", lambda t_index: data[t_index],
+               data.shape, block_size=(3, 4, 5))
+    with open(tmp_path/CACHE_METADATA, "w") as fp:
+        json.dump({"dates": ["2017-05-01T00:00:00"]*7, "shape": data.shape,
+                   "block_size": [3, 4, 5], "layers": ["VV"]}, fp)
+    # Without a state mask file, so skip the grid checks in __init__
+    s1_obs = CachedSentinel1Observations.__new__(CachedSentinel1Observations)
+    s1_obs.cache_folder = tmp_path
+    s1_obs.cache = S1Cache(tmp_path)
+    s1_obs.ulx, s1_obs.uly, s1_obs.lrx, s1_obs.lry = 0, 0, 13, 11
+    pickled = pickle.dumps(s1_obs)
+    # The cube data stay in the cache files
+    assert len(pickled) < data.nbytes
+    other = pickle.loads(pickled)
+    assert np.all(other.cache.read("VV", range(7), 0, 11, 0, 13) == data)
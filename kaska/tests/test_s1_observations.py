@@ -0,0 +1,33 @@
+'''
+Test the Sentinel 1 observations lookup
+
+'''
+
+import pytest
+import numpy as np
+
+from osgeo import gdal, osr
+
+from ..s1_observations import nearest_cells
+
+
+def mem_raster(nx, ny, geo_t, epsg=None):
+    g = gdal.GetDriverByName("MEM").Create("", nx, ny, 1, gdal.GDT_Float32)
+    g.SetGeoTransform(geo_t)
+    if epsg is not None:
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(epsg)
+        g.SetProjection(srs.ExportToWkt())
+    return g
+
+
+def test_nearest_cells():
+    # A lat/lon grid without projection, as read from the netCDF files
+    source = mem_raster(10, 10, (10, 0.01, 0, 50, 0, -0.01))
+    target = mem_raster(4, 4, (9.995, 0.005, 0, 49.98, 0, -0.005),
+                        epsg=4326)
+    rows, cols = nearest_cells(source, target)
+    assert rows.shape == (4, 4)
+    assert np.all(cols[:, 0] == -1) and np.all(rows[:, 0] == -1)
+    assert np.all(cols[:, 1:] == [0, 0, 1])
+    assert np.all(rows[:, 1:].T == [2, 2, 3, 3])
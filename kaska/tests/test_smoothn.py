@@ -59,6 +59,89 @@ def test_time_txy():
     assert(np.all(maximum_residuals <= target_maximum_residuals + fudge))
     assert(np.all(rms <= target_rms + fudge))
 
+# Smoothing along one axis of a cube is smoothing each series on its own
+def test_axis_restricted():
+    np.random.seed(1)
+    y = np.cumsum(np.random.randn(50, 3, 4), axis=0)
+    (z, s, flag, wtot) = smoothn.smoothn(y.copy(), s=2., axis=0)
+    for i in range(3):
+        for j in range(4):
+            zij = smoothn.smoothn(y[:, i, j].copy(), s=2.)[0]
+            assert np.allclose(z[:, i, j], zij)
+    assert np.allclose(smoothn.dctND(smoothn.dctND(y, axis=(0,)),
+                                     f=smoothn.idct, axis=(0,)), y)
+
+# Each pixel gets its own GCV smoothing parameter
+def test_pixelwise():
+    np.random.seed(2)
+    t = np.linspace(0, 1, 100)
+    noise = np.array([[0.01, 0.1, 0.5], [0.05, 0.2, 1.]])
+    y = np.sin(2*np.pi*t)[:, None, None] + np.random.randn(100, 2, 3)*noise
+    (z, s, flag, wtot) = smoothn.smoothn(y.copy(), axis=0, pixelwise=True)
+    assert s.shape == (2, 3)
+    assert np.all(np.diff(s[0]) > 0)
+    for i in range(2):
+        for j in range(3):
+            (zij, sij, _, _) = smoothn.smoothn(y[:, i, j].copy())
+            assert np.abs(np.log10(s[i, j]/sij)) < 0.1
+            assert np.allclose(z[:, i, j], smoothn.smoothn(
+                y[:, i, j].copy(), pixelwise=True)[0])
+
+# A sweep over s gives the same results as smoothing with each s
+def test_sweep():
+    np.random.seed(3)
+    t = np.linspace(0, 1, 80)
+    y = np.sin(2*np.pi*t)[:, None] + np.random.randn(80, 5)*0.2
+    s = [1., 10., 100.]
+    (z, score) = smoothn.smoothn_sweep(y, s, axis=0)
+    assert z.shape == (3, 80, 5)
+    for i in range(3):
+        assert np.allclose(z[i], smoothn.smoothn(y.copy(), s=s[i], axis=0)[0])
+    assert np.argmin(score) == 1
+    w = (np.random.rand(80, 5) > 0.3).astype(float)
+    (z, score) = smoothn.smoothn_sweep(y, s, W=w, axis=0, isrobust=True)
+    assert np.allclose(z[2], smoothn.smoothn(y.copy(), W=w.copy(), s=s[2],
+                                             axis=0, isrobust=True)[0])
+
+# Series converge (and are frozen) on their own
+def test_pixel_convergence():
+    np.random.seed(4)
+    t = np.linspace(0, 1, 60)
+    y = np.sin(2*np.pi*t)[:, None] + np.random.randn(60, 20)*0.2
+    w = np.ones_like(y)
+    w[:, 10:] = np.random.rand(60, 10) > 0.5
+    (z, s, flag, wtot) = smoothn.smoothn(y.copy(), W=w.copy(), s=1., axis=0)
+    assert flag
+    # the series without gaps are done in a single iteration
+    assert np.allclose(z[:, :10], smoothn.smoothn(y[:, :10].copy(), s=1.,
+                                                  axis=0)[0])
+    (zt, s, flag, wtot) = smoothn.smoothn(y.copy(), W=w.copy(), s=1.,
+                                          axis=0, TolZ=1e-8, MaxIter=5000)
+    assert np.sqrt(np.mean((z - zt)**2)) < 0.05
+
+# The robust LAI smoothing in KaSKA._run_smoother gives the same results
+# as before the per series convergence (values from the original smoothn)
+def test_robust_lai_regression():
+    np.random.seed(7)
+    t = np.linspace(0, 1, 40)
+    lai = 4*np.exp(-((t - 0.5)/0.2)**2)[:, None, None] * \
+        np.random.rand(1, 10, 10)
+    y = lai + np.random.randn(40, 10, 10)*0.3
+    y[np.random.rand(40, 10, 10) < 0.3] = 0.
+    y[y < 0] = 0.
+    z = smoothn.smoothn(y.copy(), W=2*y.copy(), isrobust=True, s=0.05,
+                        TolZ=1e-6, axis=0)[0]
+    assert np.allclose(z[[5, 20, 35], 3, 4],
+                       [0.23229919096128626, 1.689245885544068,
+                        0.32394229971947425], rtol=1e-9)
+    assert np.isclose(z.max(), 4.492960963245887, rtol=1e-9)
+    assert np.isclose(np.sqrt(np.mean(z**2)), 1.1243485798087667,
+                      rtol=1e-9)
+    # Early stopping of the robust steps is opt-in, and moves the results
+    z_early = smoothn.smoothn(y.copy(), W=2*y.copy(), isrobust=True, s=0.05,
+                              TolZ=1e-6, axis=0, TolW=1e-2)[0]
+    assert not np.allclose(z_early, z)
+
 def txy_data():
     
     np.random.seed(2718281828)
@@ -104,3 +187,51 @@ def cloudy_data(nt, mist_threshold):
 # a multiplicative noise value
 def data_noise(nt, scale):
     return np.random.randn(nt) * scale
+
+def test_workers():
+    np.random.seed(4)
+    y = np.random.randn(60, 8, 8)
+    y[np.random.rand(*y.shape) > 0.7] = np.nan
+    z1 = smoothn.smoothn(y.copy(), axis=0, workers=1)[0]
+    z2 = smoothn.smoothn(y.copy(), axis=0, workers=2)[0]
+    assert np.allclose(z1, z2)
+
+def test_robust_per_pixel():
+    np.random.seed(5)
+    r = np.random.randn(30, 4, 5)
+    finite = np.random.rand(*r.shape) > 0.3
+    finite[:, 0, 0] = False
+    median = smoothn.median_along(r, finite, (0,))
+    assert median.shape == (1, 4, 5)
+    assert np.isnan(median[0, 0, 0])
+    assert np.allclose(median[0].flat[1:],
+                       [np.median(r[:, i, j][finite[:, i, j]])
+                        for i in range(4) for j in range(5)][1:])
+    # half the pixels are 25 times noisier than the others: their
+    # observations shouldn't be taken as outliers
+    t = np.linspace(0, 1, 100)
+    sigma = np.where(np.arange(40) < 20, 0.02, 0.5)
+    y = np.sin(2*np.pi*t)[:, None] + np.random.randn(100, 40)*sigma
+    y[50, :20] += 0.3
+    (z, s, exitflag, Wtot) = smoothn.smoothn(y, axis=0, isrobust=True,
+                                             pixelwise=True, pixelrobust=True)
+    assert np.all(Wtot[50, :20] < 0.1)
+    assert np.mean(Wtot[:, 20:] < 0.5) < 0.1
+
+def test_stack():
+    np.random.seed(6)
+    t = np.linspace(0, 1, 50)
+    y1 = np.sin(2*np.pi*t)[:, None, None] + np.random.randn(50, 4, 6)*0.2
+    y2 = 10*t[:, None, None] + np.random.randn(50, 4, 6)
+    w = np.random.rand(50, 4, 6)
+    w[np.random.rand(50, 4, 6) > 0.7] = 0
+    (z, s, exitflag, Wtot) = smoothn.smoothn_stack([y1, y2], [1., 5.],
+                                                   W=[w, w[::-1]], axis=0,
+                                                   isrobust=True)
+    assert z.shape == (2, 50, 4, 6)
+    z1 = smoothn.smoothn(y1.copy(), s=1., W=w.copy(), axis=0,
+                         isrobust=True)[0]
+    z2 = smoothn.smoothn(y2.copy(), s=5., W=w[::-1].copy(), axis=0,
+                         isrobust=True)[0]
+    assert np.allclose(z[0], z1)
+    assert np.allclose(z[1], z2)
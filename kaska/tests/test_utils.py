@@ -4,12 +4,17 @@ Test some utility functions
 
 """
 
+import datetime as dt
+from types import SimpleNamespace
+
 import pytest
 import numpy as np
+from osgeo import gdal
 
 
 from ..utils import get_chunks
 from ..utils import rasterise_vector
+from ..utils import save_output_parameters
 
 
 def test_get_chunks():
@@ -56,3 +61,30 @@ def test_rasterise_vector():
         + "IMG_DATA/T35VNE_20170105T094402_B06_sur.tif",
     ).ReadAsArray()
     assert mask.sum() == 412451
+
+
+def test_save_output_parameters_packed(tmp_path):
+    rng = np.random.RandomState(0)
+    state_mask = rng.rand(6, 7) > 0.4
+    time_grid = [dt.datetime(2017, 5, 1) + dt.timedelta(days=5*i)
+                 for i in range(3)]
+    observations = SimpleNamespace(
+        define_output=lambda: ("", [500000., 10., 0., 4000000., 0., -10.],
+                               7, 6))
+    lai = rng.rand(3, 6, 7) + 0.5
+    lai[:, ~state_mask] = 0
+    # The same outputs, on the grid and packed over the state mask
+    save_output_parameters(time_grid, observations, tmp_path/"dense",
+                           ["lai"], [lai])
+    save_output_parameters(time_grid, observations, tmp_path/"packed",
+                           ["lai"], [lai[:, state_mask]],
+                           state_mask=state_mask)
+    for band, tstep in enumerate(time_grid):
+        fname = f"s2_lai_A{tstep.strftime('%Y%j')}.tif"
+        dense = gdal.Open(str(tmp_path/"dense"/fname)).ReadAsArray()
+        packed = gdal.Open(str(tmp_path/"packed"/fname)).ReadAsArray()
+        assert packed.shape == state_mask.shape
+        assert np.all(packed[state_mask] == lai[band, state_mask]
+                      .astype(np.float32))
+        assert np.all(packed[~state_mask] == 0)
+        assert np.all(packed == dense)
@@ -6,10 +6,17 @@ Test the water cloud model
 
 import pytest
 import numpy as np
+import scipy.optimize
 
 
 from ..watercloudmodel  import wcm, wcm_jac, wcm_hess
 from ..watercloudmodel import cost, cost_jac, cost_hess
+from ..watercloudmodel import wcm_batch, wcm_jac_batch, wcm_hess_batch
+from ..watercloudmodel import cost_batch, cost_jac_batch, cost_hess_batch
+from ..watercloudmodel import arrowhead_to_dense
+from ..watercloudmodel import _cost_kernel
+from ..watercloudmodel import cost_hessp
+from ..watercloudmodel import newton_arrowhead, WCM_BOUNDS
 
 
 def test_wcm():
@@ -30,7 +37,7 @@ def test_wcm_jac():
     x = np.r_[A, B, C, V1, V2, sigma_soil]
     jj = wcm_jac(x)
     retval = np.array([jj[0].sum(), jj[1].sum(), jj[2].sum(), *(jj[3])])
-    expected = np.array([2.959217508268818, -559.9411675286623,
+    expected = np.array([2.959217508268818, -560.1739912989444,
                         1.2601956229327955, 0.63009781, 0.63009781])
     assert np.allclose( retval, expected)
 
@@ -101,3 +108,235 @@ def test_optimiser():
     
 
 
+
+
+def batch_problem(n_pix=5, n_obs=7, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.c_[rng.uniform(-14, -10, n_pix), rng.uniform(0.01, 0.1, n_pix),
+              rng.uniform(0.01, 0.5, n_pix), rng.uniform(-16, -12, n_pix),
+              rng.uniform(0.01, 0.1, n_pix), rng.uniform(0.01, 0.5, n_pix),
+              rng.uniform(0, 5, (n_pix, n_obs)),
+              rng.uniform(0, 5, (n_pix, n_obs)),
+              rng.uniform(0.05, 0.4, (n_pix, n_obs))]
+    svv = rng.uniform(-18, -10, (n_pix, n_obs))
+    svh = rng.uniform(-22, -14, (n_pix, n_obs))
+    theta = rng.uniform(25, 45, (n_pix, n_obs))
+    return x, svh, svv, theta
+
+
+def test_wcm_batch():
+    x, svh, svv, theta = batch_problem()
+    x_vv = np.delete(x, [3, 4, 5], axis=1)
+    fwd = wcm_batch(x_vv, theta=theta)
+    jac = wcm_jac_batch(x_vv, theta=theta)
+    hess = wcm_hess_batch(x_vv, theta=theta)
+    for pixel in range(x.shape[0]):
+        assert np.allclose(fwd[pixel], wcm(x_vv[pixel], theta=theta[pixel]))
+        for i, term in enumerate(wcm_jac(x_vv[pixel], theta=theta[pixel])):
+            assert np.allclose(jac[i][pixel], term)
+        for i, term in enumerate(wcm_hess(x_vv[pixel], theta=theta[pixel])):
+            assert np.allclose(hess[i][pixel], term)
+
+
+def numerical_jac(func, x, eps=1e-6):
+    """Central difference derivatives of `func` (scalar or vector valued)
+    with respect to `x`, with the derivatives on the last axis."""
+    steps = eps*np.maximum(np.abs(x), 1.)
+    derivs = []
+    for k in range(x.shape[0]):
+        dx = np.zeros_like(x)
+        dx[k] = steps[k]
+        derivs.append((func(x + dx) - func(x - dx))/(2*steps[k]))
+    return np.stack(derivs, axis=-1)
+
+
+def test_cost_jac_hess_numerical():
+    x, svh, svv, theta = batch_problem()
+    n_obs = svv.shape[1]
+    # Only the constants and the soil terms are differentiated
+    free = np.r_[0:6, (6 + 2*n_obs):(6 + 3*n_obs)]
+    for pixel in range(x.shape[0]):
+        args = (svh[pixel], svv[pixel], theta[pixel])
+
+        def embed(xx):
+            x_full = x[pixel].copy()
+            x_full[free] = xx
+            return x_full
+        x_free = x[pixel, free]
+        jac = numerical_jac(lambda xx: cost(embed(xx), *args), x_free)
+        hess = numerical_jac(lambda xx: cost_jac(embed(xx), *args), x_free)
+        assert np.allclose(cost_jac(x[pixel], *args), jac, rtol=1e-5,
+                           atol=1e-6)
+        assert np.allclose(cost_hess(x[pixel], *args), hess, rtol=1e-5,
+                           atol=1e-6)
+
+
+def test_cost_batch_numerical():
+    x, svh, svv, theta = batch_problem()
+    n_obs = svv.shape[1]
+    free = np.r_[0:6, (6 + 2*n_obs):(6 + 3*n_obs)]
+    for pixel in range(x.shape[0]):
+        args = (svh[pixel:(pixel+1)], svv[pixel:(pixel+1)],
+                theta[pixel:(pixel+1)])
+
+        def embed(xx):
+            x_full = x[pixel:(pixel+1)].copy()
+            x_full[0, free] = xx
+            return x_full
+        x_free = x[pixel, free]
+        jac = numerical_jac(lambda xx: cost_batch(embed(xx), *args)[0],
+                            x_free)
+        hess = numerical_jac(lambda xx: cost_jac_batch(embed(xx), *args)[0],
+                             x_free)
+        assert np.allclose(cost_jac_batch(x[pixel:(pixel+1)], *args)[0], jac,
+                           rtol=1e-5, atol=1e-6)
+        assert np.allclose(
+            arrowhead_to_dense(*cost_hess_batch(x[pixel:(pixel+1)],
+                                                *args))[0],
+            hess, rtol=1e-5, atol=1e-6)
+
+
+def test_cost_batch():
+    x, svh, svv, theta = batch_problem()
+    cos_theta = np.cos(np.deg2rad(theta))
+    costs = cost_batch(x, svh, svv, theta)
+    jacs = cost_jac_batch(x, svh, svv, theta)
+    hess = arrowhead_to_dense(*cost_hess_batch(x, svh, svv, None,
+                                               cos_theta=cos_theta))
+    for pixel in range(x.shape[0]):
+        args = (x[pixel], svh[pixel], svv[pixel], theta[pixel])
+        assert np.allclose(costs[pixel], cost(*args))
+        assert np.allclose(jacs[pixel], cost_jac(*args))
+        assert np.allclose(hess[pixel], cost_hess(*args))
+
+
+def kernel_cost(x, svh, svv, theta, exact=True):
+    """Cost, gradient and dense Hessian from the compiled kernel"""
+    n_obs = svv.shape[0]
+    jac = np.empty(6 + n_obs)
+    block = np.empty((6, 6))
+    border = np.empty((6, n_obs))
+    diag = np.empty(n_obs)
+    f = _cost_kernel(x, svh, svv, np.cos(np.deg2rad(theta)), 0.3, jac,
+                     block, border, diag, True, exact)
+    return f, jac, arrowhead_to_dense(block[None], border[None],
+                                      diag[None])[0]
+
+
+def test_cost_kernel():
+    x, svh, svv, theta = batch_problem()
+    n_obs = svv.shape[1]
+    free = np.r_[0:6, (6 + 2*n_obs):(6 + 3*n_obs)]
+    for pixel in range(x.shape[0]):
+        args = (svh[pixel], svv[pixel], theta[pixel])
+
+        def embed(xx):
+            x_full = x[pixel].copy()
+            x_full[free] = xx
+            return x_full
+        x_free = x[pixel, free]
+        f, jac, hess = kernel_cost(x[pixel], *args)
+        assert np.allclose(f, cost(x[pixel], *args, sigma=0.3))
+        assert np.allclose(jac, numerical_jac(
+            lambda xx: cost(embed(xx), *args, sigma=0.3), x_free),
+            rtol=1e-5, atol=1e-6)
+        assert np.allclose(hess, numerical_jac(
+            lambda xx: kernel_cost(embed(xx), *args)[1], x_free),
+            rtol=1e-5, atol=1e-6)
+        # Without residuals, the Gauss-Newton Hessian is the Hessian
+        x_vv = np.delete(x[pixel], [3, 4, 5])
+        obs = (wcm(x[pixel, 3:], theta=theta[pixel]),
+               wcm(x_vv, theta=theta[pixel]), theta[pixel])
+        assert np.allclose(kernel_cost(x[pixel], *obs, exact=False)[2],
+                           cost_hess(x[pixel], *obs, sigma=0.3))
+
+
+def test_cost_hessp():
+    x, svh, svv, theta = batch_problem()
+    n_obs = svv.shape[1]
+    free = np.r_[0:6, (6 + 2*n_obs):(6 + 3*n_obs)]
+    p = np.random.RandomState(2).randn(6 + n_obs)
+    for pixel in range(x.shape[0]):
+        args = (svh[pixel], svv[pixel], theta[pixel])
+        hessp = cost_hessp(x[pixel], p, *args)
+        assert np.allclose(hessp, cost_hess(x[pixel], *args)@p)
+        # Directional derivative of the gradient along p
+        step = np.zeros_like(x[pixel])
+        step[free] = p*1e-6
+        numerical = (cost_jac(x[pixel] + step, *args) -
+                     cost_jac(x[pixel] - step, *args))/2e-6
+        assert np.allclose(hessp, numerical, rtol=1e-5, atol=1e-5)
+
+
+def arrowhead_problem(n_pix):
+    """Noisy backscatter simulated with the vegetation terms set to the
+    LAI, and a common starting point"""
+    x, svh, svv, theta = batch_problem(n_pix=n_pix, n_obs=20)
+    n_obs = svv.shape[1]
+    lai = x[:, 6:(6 + n_obs)]
+    x[:, (6 + n_obs):(6 + 2*n_obs)] = lai
+    x[:, [2, 5]] = [-10, -13]
+    svv = wcm_batch(np.delete(x, [3, 4, 5], axis=1), theta=theta)
+    svh = wcm_batch(x[:, 3:], theta=theta)
+    rng = np.random.RandomState(1)
+    svv += rng.randn(*svv.shape)*0.1
+    svh += rng.randn(*svh.shape)*0.1
+    x0 = np.r_[-12, 0.05, -10, -14, 0.05, -12, np.ones(n_obs)*0.2]
+    return x, x0, lai, svh, svv, theta
+
+
+def test_newton_arrowhead():
+    x, x0, lai, svh, svv, theta = arrowhead_problem(6)
+    n_obs = svv.shape[1]
+    solution = newton_arrowhead(x0, lai, svh, svv, theta)
+    assert solution.converged.all()
+    assert not solution.failed.any()
+    # The truth is within the bounds, so the minimum can't be any worse
+    assert np.all(solution.cost <= cost_batch(x, svh, svv, theta))
+    x_full = np.c_[solution.x[:, :6], lai, lai, solution.x[:, 6:]]
+    assert np.allclose(solution.cost, cost_batch(x_full, svh, svv, theta))
+    # Bounds are enforced
+    solution = newton_arrowhead(x0, lai, svh, svv + 30., theta)
+    lower = np.r_[WCM_BOUNDS[0][:6], np.ones(n_obs)*WCM_BOUNDS[0][6]]
+    upper = np.r_[WCM_BOUNDS[1][:6], np.ones(n_obs)*WCM_BOUNDS[1][6]]
+    assert np.all(solution.x >= lower) and np.all(solution.x <= upper)
+    assert np.any(solution.x == upper)
+
+
+def test_newton_arrowhead_convergence():
+    x, x0, lai, svh, svv, theta = arrowhead_problem(30)
+    n_obs = svv.shape[1]
+    # All the pixels converge within the iterations kaska_sar allows
+    solution = newton_arrowhead(x0, lai, svh, svv, theta, max_iter=100)
+    assert solution.converged.all()
+    assert not solution.failed.any()
+    assert solution.n_iter.max() < 100
+    x_full = np.c_[solution.x[:, :6], lai, lai, solution.x[:, 6:]]
+    jac = cost_jac_batch(x_full, svh, svv, theta)
+    lower = np.r_[WCM_BOUNDS[0][:6], np.ones(n_obs)*WCM_BOUNDS[0][6]]
+    upper = np.r_[WCM_BOUNDS[1][:6], np.ones(n_obs)*WCM_BOUNDS[1][6]]
+    pg = np.clip(solution.x - jac, lower, upper) - solution.x
+    assert np.all(np.abs(pg).max(axis=1) < 1e-5)
+    # Against a dense bounded solver, started from the solution
+    for pixel in np.argsort(solution.n_iter)[-3:]:
+        args = (svh[pixel], svv[pixel], theta[pixel])
+
+        def fun(x_pix):
+            x_pix = np.r_[x_pix[:6], lai[pixel], lai[pixel], x_pix[6:]]
+            return cost(x_pix, *args), cost_jac(x_pix, *args)
+        retval = scipy.optimize.minimize(
+            fun, solution.x[pixel], jac=True, method="L-BFGS-B",
+            bounds=list(zip(lower, upper)),
+            options={"ftol": 1e-15, "gtol": 1e-10, "maxiter": 5000})
+        assert solution.cost[pixel] <= retval.fun + 1e-8
+    # Without the log transform of A and B (bounds straddling zero), the
+    # same minima are found
+    bounds = (WCM_BOUNDS[0], WCM_BOUNDS[1].copy())
+    bounds[1][[0, 3]] = 5.
+    unscaled = newton_arrowhead(x0, lai, svh, svv, theta, bounds=bounds,
+                                max_iter=2000)
+    assert unscaled.converged.all()
+    assert np.allclose(unscaled.cost, solution.cost, rtol=1e-6)
+    # Without any damping steps, no step is ever taken
+    solution = newton_arrowhead(x0, lai, svh, svv, theta, max_backtrack=0)
+    assert solution.failed.all() and not solution.converged.any()
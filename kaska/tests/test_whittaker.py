@@ -0,0 +1,56 @@
+'''
+Test the Whittaker smoother on irregular dates
+
+'''
+
+import numpy as np
+
+from ..whittaker import whittaker_smooth
+from ..whittaker import interpolation_matrix, difference_matrix
+
+
+def irregular_series(n_pix=50, seed=0):
+    """A noisy, gappy LAI-like bump sampled on irregular dates"""
+    rng = np.random.RandomState(seed)
+    doys = np.sort(rng.choice(np.arange(1, 366), 40,
+                              replace=False)).astype(float)
+
+    def truth(t):
+        return 3*np.exp(-((t - 180)/50.)**2)
+    y = truth(doys)[:, None] + 0.3*rng.randn(40, n_pix)
+    y[rng.rand(40, n_pix) < 0.3] = np.nan
+    return doys, y, truth
+
+
+def test_whittaker_dense():
+    doys, y, truth = irregular_series()
+    grid = np.arange(1, 366, 5.)
+    z = whittaker_smooth(doys, y, grid, 5.)
+    H = interpolation_matrix(doys, grid).toarray()
+    D = difference_matrix(grid).toarray()
+    for pix in range(3):
+        w = np.isfinite(y[:, pix]).astype(float)
+        A = H.T@np.diag(w)@H + 5*D.T@D
+        b = H.T@(w*np.nan_to_num(y[:, pix]))
+        assert np.allclose(z[:, pix], np.linalg.solve(A, b), atol=1e-4)
+    assert np.mean(np.abs(z - truth(grid)[:, None])) < 0.25
+
+
+def test_whittaker_robust():
+    doys, y, truth = irregular_series()
+    y[::7] = 10.
+    grid = np.arange(1, 366, 5.)
+    err = np.abs(whittaker_smooth(doys, y, grid, 5.) - truth(grid)[:, None])
+    err_robust = np.abs(whittaker_smooth(doys, y, grid, 5., robust=True) -
+                        truth(grid)[:, None])
+    assert np.mean(err_robust) < 0.5*np.mean(err)
+
+
+def test_whittaker_empty_pixel():
+    doys, y, truth = irregular_series(n_pix=4)
+    y[:, 2] = np.nan
+    z = whittaker_smooth(doys, y.reshape(40, 2, 2), np.arange(1, 366, 5.),
+                         np.array([[1., 5.], [5., 10.]]))
+    assert z.shape == (73, 2, 2)
+    assert np.all(np.isnan(z[:, 1, 0]))
+    assert np.all(np.isfinite(z[:, [0, 0, 1], [0, 1, 1]]))
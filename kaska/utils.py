@@ -163,8 +163,13 @@ def save_output_parameters(time_grid, observations, output_folder, parameter_nam
                            options=['COMPRESS=DEFLATE',
                                     'BIGTIFF=YES',
                                     'PREDICTOR=1',
-                                    'TILED=YES']):
-    """Saving the output parameters as (probably all times) GeoTIFFs
+                                    'TILED=YES'],
+                           state_mask=None):
+    """Saving the output parameters as (probably all times) GeoTIFFs.
+    If a boolean `state_mask` is given, the outputs are packed
+    `(n_times, n_active)` arrays with the pixels in the mask, and each
+    band is put back on the grid (with zeros outside the mask) as it's
+    written.
     """
     output_folder = Path(output_folder)
     if not output_folder.exists(): output_folder.mkdir(parents=True,
@@ -189,7 +194,12 @@ def save_output_parameters(time_grid, observations, output_folder, parameter_nam
             dst_ds.SetProjection(projection)
             dst_ds.SetGeoTransform(geo_transform)
             x = dst_ds.GetRasterBand(1)
-            x.WriteArray(data[band, :, :].astype(np.float32))
+            if state_mask is None:
+                band_data = data[band, :, :].astype(np.float32)
+            else:
+                band_data = np.zeros(state_mask.shape, dtype=np.float32)
+                band_data[state_mask] = data[band]
+            x.WriteArray(band_data)
             x.SetMetadata({'parameter': param,
                             'date': time_grid[band].strftime("%Y-%m-%d"),
                             'doy':this_date})
@@ -16,9 +16,11 @@ soil moisture in [%]) to backscatter. In general, all the "constants"
 the scatterers within the turbid medium, and are usually related to LAI.
 """
 
+from collections import namedtuple
+
 import numpy as np
 
-from numba import jit
+from numba import jit, prange
 
 
 
@@ -80,8 +82,8 @@ def wcm_jac(x, theta=30.):
 
     der_dA = V1 - V1*tau
     der_dV1 = a - a*tau
-    der_dB = (-2*V2/m)*tau*(-a*V1 + s)
-    der_dV2 = (-2*b/m)*tau*(-a*V1 + s)
+    der_dB = (-2*V2/m)*tau*(c + s - a*V1)
+    der_dV2 = (-2*b/m)*tau*(c + s - a*V1)
     der_dC = tau
     der_dsigmasoil = tau
     
@@ -373,16 +375,15 @@ def cost_hess(x, svh, svv, theta, sigma=0.5):
     hess_vh = wcm_hess(x_vh, theta=theta)
     # The hessian contribution to the cost function is given by
     # H'C_{obs}H'^{T} - H''C_{obs}(H(x)-y)
-    # since C_obs is diagonal, the first term is diagonal
-    linear_hess_term =  np.diag(np.concatenate([np.array([np.sum(dvv[0]), 
-                             np.sum(dvv[1]), 
-                             np.sum(dvv[2]), 
-                             #np.sum(dvv[3]*diff_vv), # Removed D parameter
-                             np.sum(dvh[0]), 
-                             np.sum(dvh[1]),
-                             np.sum(dvh[2])]), 
-                             #np.sum(dvh[3]*diff_vh)]),# Removed D parameter
-                             dvv[-1] + dvh[-1]])**2)/(sigma**2)
+    # The first term couples the A, B and C terms of each polarisation
+    # with each other and with the soil term of every observation
+    jac_vv = np.zeros((n_obs, 6 + n_obs))
+    jac_vh = np.zeros((n_obs, 6 + n_obs))
+    jac_vv[:, :3] = np.array(dvv[:3]).T
+    jac_vh[:, 3:6] = np.array(dvh[:3]).T
+    jac_vv[:, 6:] = np.diag(dvv[-1])
+    jac_vh[:, 6:] = np.diag(dvh[-1])
+    linear_hess_term = (jac_vv.T @ jac_vv + jac_vh.T @ jac_vh)/(sigma**2)
     
     ABC_ABC_vv, ABCS_vv, SS_vv = hessian_time_residual(hess_vv, diff_vv)
     #top_rows = np.vstack([ABC_ABC, ABCS.T])
@@ -399,3 +400,629 @@ def cost_hess(x, svh, svv, theta, sigma=0.5):
     hessian_residual = np.hstack([top_rows_vv, top_rows_vh, bot_rows])
     cost_f_hessian = linear_hess_term - hessian_residual/sigma**2
     return  cost_f_hessian#, linear_hess_term
+
+
+# Pixel-batched versions of the above. Rather than one pixel's parameter
+# vector, these take a stack of them, `(n_pix, n_params)`, with the
+# observations (`svh`, `svv`, `theta`) given as `(n_pix, n_obs)` arrays
+# (or anything that broadcasts to that shape). The parameter ordering
+# within each row is the same as in the single pixel functions.
+
+
+def _unpack_batch(x, n_pol_params):
+    """Splits a stack of parameter vectors into the per polarisation
+    constants (a tuple of `(n_pix, 1)` arrays) and the `V1`, `V2` and
+    soil terms (`(n_pix, n_obs)` arrays)."""
+    n_obs = (x.shape[-1] - n_pol_params)//3
+    consts = tuple(x[:, i:(i+1)] for i in range(n_pol_params))
+    V1 = x[:, n_pol_params:(n_pol_params+n_obs)]
+    V2 = x[:, (n_pol_params+n_obs):(n_pol_params+2*n_obs)]
+    s = x[:, (n_pol_params+2*n_obs):]
+    return consts, V1, V2, s
+
+
+def _cos_theta(theta, cos_theta):
+    if cos_theta is None:
+        return np.cos(np.deg2rad(theta))
+    return cos_theta
+
+
+def wcm_batch(x, theta=30., cos_theta=None):
+    """Pixel-batched version of `wcm`.
+
+    Arguments:
+        x {array} -- `(n_pix, 3+3*n_obs)` array of parameters. Each row is
+                     ordered as in `wcm`.
+
+    Keyword Arguments:
+        theta {float|array} -- Angle of incidence (default: 30)
+        cos_theta {array} -- Precomputed cosine of `theta`. If given,
+                             `theta` is ignored.
+
+    Returns:
+        [array] -- `(n_pix, n_obs)` backscatter
+    """
+    m = _cos_theta(theta, cos_theta)
+    (a, b, c), V1, V2, s = _unpack_batch(x, 3)
+    tau = np.exp(-2*b*V2/m)
+    return tau*(c + s) + a*V1*(1 - tau)
+
+
+def wcm_jac_batch(x, theta=30., cos_theta=None):
+    """Pixel-batched version of `wcm_jac`. Returns a list with the
+    `(n_pix, n_obs)` derivatives with respect to A, B, C and the soil
+    term."""
+    m = _cos_theta(theta, cos_theta)
+    (a, b, c), V1, V2, s = _unpack_batch(x, 3)
+    tau = np.exp(-2*b*V2/m)
+    der_dA = V1 - V1*tau
+    der_dB = (-2*V2/m)*tau*(c + s - a*V1)
+    return [der_dA, der_dB, tau, tau]
+
+
+def wcm_hess_batch(x, theta=30., cos_theta=None):
+    """Pixel-batched version of `wcm_hess`. Returns the same 16 element
+    tuple, with `(n_pix, n_obs)` arrays."""
+    m = _cos_theta(theta, cos_theta)
+    (a, b, c), V1, V2, s = _unpack_batch(x, 3)
+    tau = np.exp(-2*b*V2/m)
+    d_tau = -2*V2*tau/m*np.ones_like(s)
+    v1_d_tau = -V1*d_tau
+    zero = np.zeros_like(s)
+    d_bb = (4*tau*V2*V2*(c + s - a*V1))/m**2
+    return (zero, v1_d_tau, zero, zero,
+            v1_d_tau, d_bb, d_tau, d_tau,
+            zero, d_tau, zero, zero,
+            zero, d_tau, zero, zero)
+
+
+def _cost_terms_batch(x, svh, svv, m):
+    """Forward model and residuals for both polarisations, and the
+    per-polarisation parameter stacks"""
+    (a_vv, b_vv, c_vv, a_vh, b_vh, c_vh), V1, V2, s = _unpack_batch(x, 6)
+    pols = []
+    for (a, b, c, obs) in [(a_vv, b_vv, c_vv, svv), (a_vh, b_vh, c_vh, svh)]:
+        tau = np.exp(-2*b*V2/m)
+        diff = obs - (tau*(c + s) + a*V1*(1 - tau))
+        pols.append((a, b, c, tau, diff))
+    return pols, V1, V2, s
+
+
+def cost_batch(x, svh, svv, theta, sigma=0.5, cos_theta=None):
+    """Pixel-batched version of `cost`.
+
+    Arguments:
+        x [array] -- `(n_pix, 6+3*n_obs)` parameters, each row ordered
+                     as in `cost`.
+        svh [array] -- `(n_pix, n_obs)` VH backscatter
+        svv [array] -- `(n_pix, n_obs)` VV backscatter
+        theta [array] -- Angle of incidence
+
+    Keyword Arguments:
+        sigma {float|array} -- Backscatter uncertainty (default: 0.5)
+        cos_theta {array} -- Precomputed cosine of `theta`
+
+    Returns:
+        Cost -- `(n_pix,)` cost per pixel
+    """
+    m = _cos_theta(theta, cos_theta)
+    pols, V1, V2, s = _cost_terms_batch(x, svh, svv, m)
+    diff_vv, diff_vh = pols[0][-1], pols[1][-1]
+    return np.sum(0.5*(diff_vv**2 + diff_vh**2)/(sigma**2), axis=1)
+
+
+def cost_jac_batch(x, svh, svv, theta, sigma=0.5, cos_theta=None):
+    """Pixel-batched version of `cost_jac`. Returns the `(n_pix, 6+n_obs)`
+    gradient with respect to the six polarisation constants and the
+    soil terms."""
+    m = _cos_theta(theta, cos_theta)
+    pols, V1, V2, s = _cost_terms_batch(x, svh, svv, m)
+    n_pix, n_obs = V1.shape
+    jac = np.empty((n_pix, 6 + n_obs))
+    jac[:, 6:] = 0.
+    for i, (a, b, c, tau, diff) in enumerate(pols):
+        jac[:, 3*i] = np.sum((V1 - V1*tau)*diff, axis=1)
+        jac[:, 3*i+1] = np.sum((-2*V2/m)*tau*(c + s - a*V1)*diff, axis=1)
+        jac[:, 3*i+2] = np.sum(tau*diff, axis=1)
+        jac[:, 6:] += tau*diff
+    return -jac/sigma**2
+
+
+def cost_hess_batch(x, svh, svv, theta, sigma=0.5, cos_theta=None):
+    """Pixel-batched version of `cost_hess`. Rather than the dense
+    Hessian, this returns its three distinct parts: the Hessian is an
+    arrowhead matrix, with a dense 6x6 block for the polarisation
+    constants, a `6 x n_obs` border coupling them to the soil terms,
+    and a diagonal over the soil terms. Use `arrowhead_to_dense` to
+    assemble the full matrices.
+
+    Returns:
+        A tuple with the `(n_pix, 6, 6)` block, the `(n_pix, 6, n_obs)`
+        border and the `(n_pix, n_obs)` diagonal.
+    """
+    m = _cos_theta(theta, cos_theta)
+    pols, V1, V2, s = _cost_terms_batch(x, svh, svv, m)
+    n_pix, n_obs = V1.shape
+    block = np.zeros((n_pix, 6, 6))
+    border = np.zeros((n_pix, 6, n_obs))
+    dsoil = np.zeros((n_pix, n_obs))
+    for i, (a, b, c, tau, diff) in enumerate(pols):
+        j = 3*i
+        d_tau = -2*V2*tau/m
+        # Linear (J^T J) term
+        derivs = (V1 - V1*tau, d_tau*(c + s - a*V1), tau)
+        for k in range(3):
+            for l in range(3):
+                block[:, j+k, j+l] = np.sum(derivs[k]*derivs[l], axis=1)
+            border[:, j+k] = derivs[k]*tau
+        dsoil += tau*tau
+        # Hessian times residual term
+        d_ab = np.sum(-V1*d_tau*diff, axis=1)
+        d_bb = np.sum((4*tau*V2*V2*(c + s - a*V1))/m**2*diff, axis=1)
+        d_bc = np.sum(d_tau*diff, axis=1)
+        block[:, j, j+1] -= d_ab
+        block[:, j+1, j] -= d_ab
+        block[:, j+1, j+1] -= d_bb
+        block[:, j+1, j+2] -= d_bc
+        block[:, j+2, j+1] -= d_bc
+        border[:, j+1] -= d_tau*diff
+    return block/sigma**2, border/sigma**2, dsoil/sigma**2
+
+
+def arrowhead_to_dense(block, border, diag):
+    """Assembles dense Hessians from the arrowhead parts returned by
+    `cost_hess_batch`.
+
+    Returns:
+        `(n_pix, 6+n_obs, 6+n_obs)` array
+    """
+    n_pix, n_obs = diag.shape
+    n_block = block.shape[1]
+    hess = np.zeros((n_pix, n_block + n_obs, n_block + n_obs))
+    hess[:, :n_block, :n_block] = block
+    hess[:, :n_block, n_block:] = border
+    hess[:, n_block:, :n_block] = border.transpose(0, 2, 1)
+    idx = np.arange(n_obs) + n_block
+    hess[:, idx, idx] = diag
+    return hess
+
+
+# Compiled single pixel kernel. The functions above build a handful of
+# small temporary arrays per call, which dominates the run time of a per
+# pixel optimisation. The kernel below computes the cost function, its
+# gradient and the arrowhead parts of its Hessian (see `cost_hess_batch`)
+# in a single pass over the observations, writing into preallocated
+# arrays.
+
+
+@jit(nopython=True)
+def _cost_kernel(x, svh, svv, cos_theta, sigma, jac, block, border, diag,
+                 do_jac, exact):
+    """WCM cost for one pixel, with `x` ordered as in `cost`. If `do_jac`
+    is set, `jac` (`6+n_obs`) is filled in with the gradient, and `block`
+    (`6x6`), `border` (`6 x n_obs`) and `diag` (`n_obs`) with the
+    Gauss-Newton Hessian, or with the full Hessian (as in `cost_hess`) if
+    `exact` is set too. Returns the cost."""
+    n_obs = svv.shape[0]
+    isig2 = 1./(sigma*sigma)
+    cost = 0.
+    if do_jac:
+        jac[:] = 0.
+        block[:, :] = 0.
+        diag[:] = 0.
+    for i in range(n_obs):
+        V1 = x[6 + i]
+        V2 = x[6 + n_obs + i]
+        s = x[6 + 2*n_obs + i]
+        m = cos_theta[i]
+        for pol in range(2):
+            j = 3*pol
+            a = x[j]
+            b = x[j + 1]
+            c = x[j + 2]
+            obs = svv[i] if pol == 0 else svh[i]
+            tau = np.exp(-2*b*V2/m)
+            diff = obs - (tau*(c + s) + a*V1*(1 - tau))
+            cost += 0.5*diff*diff
+            if not do_jac:
+                continue
+            d_a = V1 - V1*tau
+            d_tau = -2*V2*tau/m
+            d_b = d_tau*(c + s - a*V1)
+            jac[j] += d_a*diff
+            jac[j + 1] += d_b*diff
+            jac[j + 2] += tau*diff
+            jac[6 + i] += tau*diff
+            # Upper triangle of the J^T J block
+            block[j, j] += d_a*d_a
+            block[j, j + 1] += d_a*d_b
+            block[j, j + 2] += d_a*tau
+            block[j + 1, j + 1] += d_b*d_b
+            block[j + 1, j + 2] += d_b*tau
+            block[j + 2, j + 2] += tau*tau
+            border[j, i] = d_a*tau*isig2
+            border[j + 1, i] = d_b*tau*isig2
+            border[j + 2, i] = tau*tau*isig2
+            diag[i] += tau*tau
+            if exact:
+                # Hessian times residual term
+                block[j, j + 1] += V1*d_tau*diff
+                block[j + 1, j + 1] -= (4*tau*V2*V2*(c + s - a*V1) /
+                                        (m*m)*diff)
+                block[j + 1, j + 2] -= d_tau*diff
+                border[j + 1, i] -= d_tau*diff*isig2
+    if do_jac:
+        for k in range(jac.shape[0]):
+            jac[k] = -jac[k]*isig2
+        for i in range(n_obs):
+            diag[i] *= isig2
+        for k in range(6):
+            for l in range(k, 6):
+                block[k, l] *= isig2
+                block[l, k] = block[k, l]
+    return cost*isig2
+
+
+def _kernel_args(x, svv, theta, cos_theta):
+    n_obs = svv.shape[0]
+    if cos_theta is None:
+        cos_theta = np.cos(np.deg2rad(theta))
+    cos_theta = np.ascontiguousarray(
+        np.broadcast_to(cos_theta, (n_obs, )), dtype=np.float64)
+    return np.ascontiguousarray(x, dtype=np.float64), cos_theta
+
+
+def cost_hessp(x, p, svh, svv, theta, sigma=0.5, cos_theta=None):
+    """Product of the Hessian of the cost function (as in `cost_hess`)
+    with a vector `p`, without building the dense Hessian. Can be passed
+    as `hessp` to `scipy.optimize.minimize`.
+
+    Arguments:
+        x [array] -- Parameter array, ordered as in `cost`
+        p [array] -- `6+n_obs` vector
+        svh [array] -- Array of backscatter measurements VH polarisation
+        svv [array] -- Array of backscatter measurements VV polarisation
+        theta [array] -- Angle of incidence (per observation)
+
+    Keyword Arguments:
+        sigma {float} -- Backscatter uncertainty (default: 0.5)
+        cos_theta {array} -- Precomputed cosine of `theta`
+
+    Returns:
+        [array] -- The `6+n_obs` Hessian-vector product
+    """
+    x, cos_theta = _kernel_args(x, svv, theta, cos_theta)
+    n_obs = svv.shape[0]
+    block = np.empty((6, 6))
+    border = np.empty((6, n_obs))
+    diag = np.empty(n_obs)
+    _cost_kernel(x, np.asarray(svh, dtype=np.float64),
+                 np.asarray(svv, dtype=np.float64), cos_theta, float(sigma),
+                 np.empty(6 + n_obs), block, border, diag, True, True)
+    return np.r_[block@p[:6] + border@p[6:], p[:6]@border + diag*p[6:]]
+
+
+# Solving the WCM cost for the constants and soil terms of many pixels.
+# With the vegetation terms fixed, the Hessian is an arrowhead matrix, so
+# each Newton step reduces to a 6x6 Schur complement solve plus a
+# diagonal one, O(n_obs) in all. The solver uses the exact gradient and
+# the Gauss-Newton Hessian, which (unlike the full Hessian) is positive
+# semi-definite everywhere.
+
+WCMSolution = namedtuple("WCMSolution", "x cost converged failed n_iter")
+
+# Bounds for A, B and C (VV first, then VH) and for the soil term
+WCM_BOUNDS = (np.array([-40., 1e-4, -40., -40., 1e-4, -40., 0.01]),
+              np.array([-5., 1., -1., -5., 1., -1., 1.]))
+
+
+@jit(nopython=True)
+def _solve_arrowhead(block, border, diag, rhs, damping, out):
+    """Solves `(H + damping*diag(H)) out = rhs` for an arrowhead `H`,
+    eliminating the diagonal part first and factorising the 6x6 Schur
+    complement. Returns False if the system isn't positive definite."""
+    n_obs = diag.shape[0]
+    for i in range(n_obs):
+        if diag[i] <= 0.:
+            return False
+    schur = np.empty((6, 6))
+    r = np.empty(6)
+    for k in range(6):
+        acc = rhs[k]
+        for i in range(n_obs):
+            acc -= border[k, i]*rhs[6 + i]/(diag[i]*(1. + damping))
+        r[k] = acc
+        for l in range(k + 1):
+            acc = block[k, l]
+            for i in range(n_obs):
+                acc -= border[k, i]*border[l, i]/(diag[i]*(1. + damping))
+            schur[k, l] = acc
+        schur[k, k] += damping*block[k, k]
+    # Cholesky factorisation (lower triangle) and solve
+    for k in range(6):
+        acc = schur[k, k]
+        for m in range(k):
+            acc -= schur[k, m]*schur[k, m]
+        if acc <= 0.:
+            return False
+        schur[k, k] = np.sqrt(acc)
+        for l in range(k + 1, 6):
+            acc = schur[l, k]
+            for m in range(k):
+                acc -= schur[l, m]*schur[k, m]
+            schur[l, k] = acc/schur[k, k]
+    for k in range(6):
+        acc = r[k]
+        for m in range(k):
+            acc -= schur[k, m]*r[m]
+        r[k] = acc/schur[k, k]
+    for k in range(5, -1, -1):
+        acc = r[k]
+        for m in range(k + 1, 6):
+            acc -= schur[m, k]*r[m]
+        r[k] = acc/schur[k, k]
+    for k in range(6):
+        out[k] = r[k]
+    for i in range(n_obs):
+        acc = rhs[6 + i]
+        for k in range(6):
+            acc -= border[k, i]*r[k]
+        out[6 + i] = acc/(diag[i]*(1. + damping))
+    return True
+
+
+@jit(nopython=True)
+def _freeze(frozen, jac, block, border, diag, rhs):
+    """Takes the `frozen` variables out of the Newton system, leaving them
+    with a zero step."""
+    n_obs = diag.shape[0]
+    for k in range(6 + n_obs):
+        rhs[k] = jac[k]
+        if not frozen[k]:
+            continue
+        rhs[k] = 0.
+        if k < 6:
+            for l in range(6):
+                block[k, l] = 0.
+                block[l, k] = 0.
+            block[k, k] = 1.
+            for i in range(n_obs):
+                border[k, i] = 0.
+        else:
+            for l in range(6):
+                border[l, k - 6] = 0.
+            diag[k - 6] = 1.
+
+
+@jit(nopython=True)
+def _to_state(z, log_var, sign, lower, upper, n_obs, x_full):
+    """Writes the solver variables `z` into the full parameter vector (as
+    in `cost`), undoing the log transform of the `log_var` ones."""
+    for k in range(z.shape[0]):
+        xk = sign[k]*np.exp(z[k]) if log_var[k] else z[k]
+        xk = min(max(xk, lower[k]), upper[k])
+        x_full[k if k < 6 else k + 2*n_obs] = xk
+
+
+@jit(nopython=True, parallel=True)
+def _newton_arrowhead_batch(x, lai, svh, svv, cos_theta, sigma, lower,
+                            upper, log_var, max_iter, gtol, max_backtrack,
+                            max_extend, cost, converged, failed, n_iter):
+    n_pix, n_obs = svv.shape
+    n_state = 6 + n_obs
+    # Bounds of the solver variables
+    sign = np.ones(n_state)
+    z_lower = lower.copy()
+    z_upper = upper.copy()
+    for k in range(n_state):
+        if log_var[k]:
+            sign[k] = 1. if lower[k] > 0 else -1.
+            z_lower[k] = np.log(min(abs(lower[k]), abs(upper[k])))
+            z_upper[k] = np.log(max(abs(lower[k]), abs(upper[k])))
+    for pix in prange(n_pix):
+        x_full = np.empty(6 + 3*n_obs)
+        x_try = np.empty(6 + 3*n_obs)
+        z = np.empty(n_state)
+        z_try = np.empty(n_state)
+        z_ext = np.empty(n_state)
+        scale = np.empty(n_state)
+        jac = np.empty(n_state)
+        grad = np.empty(n_state)
+        block = np.empty((6, 6))
+        border = np.empty((6, n_obs))
+        diag = np.empty(n_obs)
+        block0 = np.empty((6, 6))
+        border0 = np.empty((6, n_obs))
+        diag0 = np.empty(n_obs)
+        rhs = np.empty(n_state)
+        step = np.empty(n_state)
+        frozen = np.empty(n_state, dtype=np.bool_)
+        for i in range(n_obs):
+            x_full[6 + i] = lai[pix, i]
+            x_full[6 + n_obs + i] = lai[pix, i]
+        for k in range(n_state):
+            xk = min(max(x[pix, k], lower[k]), upper[k])
+            z[k] = np.log(sign[k]*xk) if log_var[k] else xk
+        _to_state(z, log_var, sign, lower, upper, n_obs, x_full)
+        x_try[:] = x_full
+        damping = 1e-3
+        f = _cost_kernel(x_full, svh[pix], svv[pix], cos_theta[pix], sigma,
+                         jac, block, border, diag, True, False)
+        # One more pass than iterations, to test the last step
+        for iteration in range(max_iter + 1):
+            pg_norm = 0.
+            for k in range(n_state):
+                xk = x_full[k if k < 6 else k + 2*n_obs]
+                pg = min(max(xk - jac[k], lower[k]), upper[k]) - xk
+                pg_norm = max(pg_norm, abs(pg))
+            if pg_norm < gtol:
+                converged[pix] = True
+                break
+            if iteration == max_iter:
+                break
+            # Gradient and Gauss-Newton Hessian of the solver variables,
+            # and the variables sitting on a bound with the gradient
+            # pushing them out
+            for k in range(n_state):
+                scale[k] = x_full[k] if k < 6 and log_var[k] else 1.
+                grad[k] = scale[k]*jac[k]
+                frozen[k] = ((z[k] <= z_lower[k] and grad[k] > 0.) or
+                             (z[k] >= z_upper[k] and grad[k] < 0.))
+            for k in range(6):
+                for j in range(6):
+                    block0[k, j] = block[k, j]*scale[k]*scale[j]
+                for i in range(n_obs):
+                    border0[k, i] = border[k, i]*scale[k]
+            diag0[:] = diag
+            # Levenberg-Marquardt damping: the Hessian is singular (`C`
+            # and the soil terms trade off against each other), and far
+            # from the solution the Gauss-Newton step overshoots
+            accepted = False
+            for _ in range(max_backtrack):
+                # Variables on a bound that the step pushes out are
+                # frozen too, and the step is solved again
+                while True:
+                    block[:, :] = block0
+                    border[:, :] = border0
+                    diag[:] = diag0
+                    _freeze(frozen, grad, block, border, diag, rhs)
+                    solved = _solve_arrowhead(block, border, diag, rhs,
+                                              damping, step)
+                    if not solved:
+                        break
+                    more = False
+                    for k in range(n_state):
+                        if not frozen[k] and (
+                                (z[k] <= z_lower[k] and step[k] > 0.) or
+                                (z[k] >= z_upper[k] and step[k] < 0.)):
+                            frozen[k] = True
+                            more = True
+                    if not more:
+                        break
+                if solved:
+                    # Projected step and, if that doesn't lower the
+                    # cost, the step cut short at the first bound it
+                    # crosses (clipping a single soil term undoes the
+                    # trade-off with `C` that the step relies on)
+                    alpha = 1.
+                    for k in range(n_state):
+                        z_try[k] = min(max(z[k] - step[k], z_lower[k]),
+                                       z_upper[k])
+                        if step[k] > 0. and z[k] - step[k] < z_lower[k]:
+                            alpha = min(alpha, (z[k] - z_lower[k])/step[k])
+                        elif step[k] < 0. and z[k] - step[k] > z_upper[k]:
+                            alpha = min(alpha, (z[k] - z_upper[k])/step[k])
+                    _to_state(z_try, log_var, sign, lower, upper, n_obs,
+                              x_try)
+                    f_try = _cost_kernel(x_try, svh[pix], svv[pix],
+                                         cos_theta[pix], sigma, jac, block,
+                                         border, diag, False, False)
+                    if not f_try < f and 0. < alpha < 1.:
+                        for k in range(n_state):
+                            z_try[k] = min(max(z[k] - alpha*step[k],
+                                               z_lower[k]), z_upper[k])
+                        _to_state(z_try, log_var, sign, lower, upper, n_obs,
+                                  x_try)
+                        f_try = _cost_kernel(x_try, svh[pix], svv[pix],
+                                             cos_theta[pix], sigma, jac,
+                                             block, border, diag, False,
+                                             False)
+                    if f_try < f:
+                        accepted = True
+                        damping = max(damping/10., 1e-10)
+                        break
+                damping *= 10.
+            if not accepted:
+                # No damping lowers the cost, but the projected gradient
+                # is still above gtol
+                failed[pix] = True
+                break
+            # Along the valleys of the cost (`A` and `B` trade off
+            # against each other), accepted steps are often too short:
+            # keep doubling them while the cost goes down
+            for k in range(n_state):
+                step[k] = z_try[k] - z[k]
+            for _ in range(max_extend):
+                for k in range(n_state):
+                    step[k] *= 2.
+                    z_ext[k] = min(max(z[k] + step[k], z_lower[k]),
+                                   z_upper[k])
+                _to_state(z_ext, log_var, sign, lower, upper, n_obs, x_try)
+                f_ext = _cost_kernel(x_try, svh[pix], svv[pix],
+                                     cos_theta[pix], sigma, jac, block,
+                                     border, diag, False, False)
+                if not f_ext < f_try:
+                    break
+                z_try[:] = z_ext
+                f_try = f_ext
+            z[:] = z_try
+            _to_state(z, log_var, sign, lower, upper, n_obs, x_full)
+            f = _cost_kernel(x_full, svh[pix], svv[pix], cos_theta[pix],
+                             sigma, jac, block, border, diag, True, False)
+            n_iter[pix] += 1
+        cost[pix] = f
+        for k in range(n_state):
+            x[pix, k] = x_full[k if k < 6 else k + 2*n_obs]
+
+
+def newton_arrowhead(x0, lai, svh, svv, theta, sigma=0.5, bounds=WCM_BOUNDS,
+                     max_iter=100, gtol=1e-5, max_backtrack=20,
+                     max_extend=4, cos_theta=None):
+    """Minimises the WCM cost function with respect to the six
+    polarisation constants and the soil terms for a stack of pixels, with
+    the vegetation terms (`V1` and `V2`) set to the LAI. Uses a bounded
+    (projected) Newton method that exploits the arrowhead structure of
+    the Hessian. The solver works on the logarithm of `A` and `B` (of
+    their magnitude, as long as their bounds don't straddle zero): the
+    cost depends mostly on their product, so that the curved valley
+    `A*B = const` becomes a straight line.
+
+    Arguments:
+        x0 [array] -- `(n_pix, 6+n_obs)` starting point: Avv, Bvv, Cvv,
+                      Avh, Bvh, Cvh and the soil terms.
+        lai [array] -- `(n_pix, n_obs)` LAI
+        svh [array] -- `(n_pix, n_obs)` VH backscatter
+        svv [array] -- `(n_pix, n_obs)` VV backscatter
+        theta [array] -- Angle of incidence
+
+    Keyword Arguments:
+        sigma {float} -- Backscatter uncertainty (default: 0.5)
+        bounds {tuple} -- Lower and upper bounds for the six constants
+                          and the soil term (default: WCM_BOUNDS)
+        max_iter {int} -- Maximum number of iterations (default: 100)
+        gtol {float} -- Projected gradient convergence threshold
+        max_backtrack {int} -- Number of damping increases per iteration
+        max_extend {int} -- Number of times an accepted step can be
+                            doubled, while the cost goes down
+        cos_theta {array} -- Precomputed cosine of `theta`
+
+    Returns:
+        WCMSolution -- Solution `(n_pix, 6+n_obs)`, cost, convergence
+                       flag (projected gradient below `gtol`), failure
+                       flag (no damping could lower the cost) and number
+                       of iterations, per pixel. Pixels that are neither
+                       converged nor failed ran out of iterations.
+    """
+    svv = np.atleast_2d(np.asarray(svv, dtype=np.float64))
+    svh = np.atleast_2d(np.asarray(svh, dtype=np.float64))
+    n_pix, n_obs = svv.shape
+    m = _cos_theta(theta, cos_theta)
+    m = np.ascontiguousarray(np.broadcast_to(m, (n_pix, n_obs)),
+                             dtype=np.float64)
+    lai = np.ascontiguousarray(np.broadcast_to(lai, (n_pix, n_obs)),
+                               dtype=np.float64)
+    x = np.array(np.broadcast_to(x0, (n_pix, 6 + n_obs)), dtype=np.float64)
+    lower = np.r_[bounds[0][:6], np.broadcast_to(bounds[0][6:], (n_obs,))]
+    upper = np.r_[bounds[1][:6], np.broadcast_to(bounds[1][6:], (n_obs,))]
+    log_var = np.zeros(6 + n_obs, dtype=bool)
+    log_var[[0, 1, 3, 4]] = lower[[0, 1, 3, 4]]*upper[[0, 1, 3, 4]] > 0
+    cost_out = np.zeros(n_pix)
+    converged = np.zeros(n_pix, dtype=bool)
+    failed = np.zeros(n_pix, dtype=bool)
+    n_iter = np.zeros(n_pix, dtype=np.int64)
+    _newton_arrowhead_batch(x, lai, svh, svv, m, float(sigma),
+                            lower.astype(np.float64),
+                            upper.astype(np.float64), log_var, max_iter,
+                            gtol, max_backtrack, max_extend, cost_out,
+                            converged, failed, n_iter)
+    return WCMSolution(x, cost_out, converged, failed, n_iter)
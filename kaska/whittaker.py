@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""A weighted Whittaker smoother for irregularly sampled time series.
+
+`KaSKA._run_smoother` fills the gaps in the first pass retrievals by
+linear interpolation, smooths them on the (irregular) observation dates
+as if they were evenly spaced, and interpolates the result onto the
+output time grid. Here, the smoothed series is defined directly on the
+output time grid, and linked to the observations by linear
+interpolation, so the problem for every pixel is
+
+    min_z sum_k w_k (y_k - (H z)_k)**2 + lmbda*|D z|**2,
+
+with `H` the (`n_obs`, `n_grid`) interpolation matrix and `D` the second
+order divided differences on the grid (scaled by the mean grid spacing,
+so that on a regular grid they're the usual `z[i-1] - 2z[i] + z[i+1]`).
+Each row of `H` only touches two neighbouring grid nodes, so the normal
+equations are pentadiagonal, and are solved for all the pixels with the
+banded Cholesky kernels in `gauss_newton.py`, at O(n_grid) per pixel.
+Missing observations (NaN) get a zero weight.
+"""
+import numpy as np
+import scipy.sparse as sp
+
+from .gauss_newton import cholesky_banded_batch, cho_solve_banded_batch
+
+
+def _interpolation_weights(doys, doy_grid):
+    """Grid node to the left of each date, and the linear interpolation
+    weight of the node to its right"""
+    doys = np.asarray(doys, dtype=float)
+    doy_grid = np.asarray(doy_grid, dtype=float)
+    j = np.clip(np.searchsorted(doy_grid, doys) - 1, 0, doy_grid.size - 2)
+    a = np.clip((doys - doy_grid[j])/(doy_grid[j + 1] - doy_grid[j]), 0, 1)
+    return j, a
+
+
+def interpolation_matrix(doys, doy_grid):
+    """Sparse linear interpolation matrix from a grid to a set of dates.
+    Dates outside the grid take the value of the closest end.
+
+    Parameters
+    ----------
+    doys : array
+        The `n_obs` dates to interpolate to.
+    doy_grid : array
+        The `n_grid` grid dates, sorted.
+
+    Returns
+    -------
+    sparse matrix
+        `(n_obs, n_grid)` CSR matrix.
+    """
+    j, a = _interpolation_weights(doys, doy_grid)
+    n_obs = j.size
+    rows = np.r_[np.arange(n_obs), np.arange(n_obs)]
+    return sp.csr_matrix((np.r_[1 - a, a], (rows, np.r_[j, j + 1])),
+                         shape=(n_obs, len(doy_grid)))
+
+
+def difference_matrix(doy_grid):
+    """Second order divided differences on a (possibly irregular) grid,
+    scaled by the squared mean grid spacing.
+
+    Parameters
+    ----------
+    doy_grid : array
+        The `n_grid` grid dates, sorted.
+
+    Returns
+    -------
+    sparse matrix
+        `(n_grid-2, n_grid)` CSR matrix.
+    """
+    doy_grid = np.asarray(doy_grid, dtype=float)
+    h = np.diff(doy_grid)
+    h1, h2 = h[:-1], h[1:]
+    scale = np.mean(h)**2
+    n = doy_grid.size - 2
+    return sp.diags([2*scale/(h1*(h1 + h2)), -2*scale/(h1*h2),
+                     2*scale/(h2*(h1 + h2))], [0, 1, 2],
+                    shape=(n, n + 2), format="csr")
+
+
+def _bisquare_weights(r, w):
+    """Bisquare robust weights from the residuals of each pixel (along
+    the first axis), scaled by their own median absolute deviation."""
+    r = np.where(w > 0, r, np.nan)
+    # pixels without observations don't need weights
+    r[:, ~np.any(w > 0, axis=0)] = 0.
+    mad = np.nanmedian(np.abs(r - np.nanmedian(r, axis=0)), axis=0)
+    u = np.abs(r/(4.685*1.4826*np.maximum(mad, 1e-12)))
+    return np.where(u < 1, (1 - u**2)**2, 0.)
+
+
+def whittaker_smooth(doys, y, doy_grid, lmbda, weights=None, robust=False,
+                     n_robust=2, ridge=1e-8):
+    """Smooths irregularly sampled time series with a weighted Whittaker
+    smoother, and returns them on an output time grid.
+
+    Parameters
+    ----------
+    doys : array
+        The `n_obs` observation dates (e.g. days of year).
+    y : array
+        `(n_obs, ...)` observations. NaNs are treated as missing.
+    doy_grid : array
+        The `n_grid` output dates, sorted and in the same units as
+        `doys`.
+    lmbda : float or array
+        Smoothing parameter. Either a scalar, or one value per pixel
+        (with the shape of `y[0]`).
+    weights : array, optional
+        `(n_obs, ...)` observation weights, by default 1.
+    robust : bool, optional
+        Whether to downweight outliers with bisquare weights, computed
+        from the residuals of each pixel, by default False.
+    n_robust : int, optional
+        Number of robust re-weighting steps, by default 2.
+    ridge : float, optional
+        Relative ridge added to the normal equations, so that pixels with
+        fewer than two observations still have a (flat) solution.
+
+    Returns
+    -------
+    array
+        `(n_grid, ...)` smoothed series. Pixels without any observations
+        are NaN.
+    """
+    y = np.asarray(y, dtype=float)
+    n_obs = y.shape[0]
+    pixel_shape = y.shape[1:]
+    y = y.reshape(n_obs, -1)
+    w = np.ones_like(y) if weights is None else \
+        np.asarray(weights, dtype=float).reshape(n_obs, -1).copy()
+    w[~np.isfinite(y) | ~np.isfinite(w)] = 0.
+    y = np.where(w > 0, y, 0.)
+    lmbda = np.broadcast_to(np.asarray(lmbda, dtype=float),
+                            pixel_shape).reshape(-1)
+
+    H = interpolation_matrix(doys, doy_grid)
+    n_grid = H.shape[1]
+    first, a = _interpolation_weights(doys, doy_grid)
+    D = difference_matrix(doy_grid)
+    DtD = (D.T @ D).toarray()
+    penalty = np.zeros((3, n_grid))
+    for k in range(3):
+        penalty[k, :n_grid - k] = np.diag(DtD, -k)
+    # Each observation k touches the grid nodes j_k (weight 1-a_k) and
+    # j_k + 1 (weight a_k)
+    P0 = sp.csr_matrix((np.ones(n_obs), (first, np.arange(n_obs))),
+                       shape=(n_grid, n_obs))
+    P1 = sp.csr_matrix((np.ones(n_obs), (first + 1, np.arange(n_obs))),
+                       shape=(n_grid, n_obs))
+    a = a[:, None]
+
+    robust_w = np.ones_like(w)
+    for step in range(n_robust + 1 if robust else 1):
+        wt = w*robust_w
+        ab = np.zeros((y.shape[1], 3, n_grid))
+        ab[:, 0] = (P0 @ (wt*(1 - a)**2) + P1 @ (wt*a**2)).T
+        ab[:, 1] = (P0 @ (wt*a*(1 - a))).T
+        ab += lmbda[:, None, None]*penalty
+        ab[:, 0] += ridge*(1 + ab[:, 0].max(axis=1))[:, None]
+        rhs = (P0 @ (wt*(1 - a)*y) + P1 @ (wt*a*y)).T
+        chol, _ = cholesky_banded_batch(ab)
+        z = cho_solve_banded_batch(chol, np.ascontiguousarray(rhs)).T
+        if robust:
+            robust_w = _bisquare_weights(y - H @ z, w)
+    z = np.ascontiguousarray(z)
+    z[:, ~np.any(w > 0, axis=0)] = np.nan
+    return z.reshape((n_grid, ) + pixel_shape)